@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -93,6 +94,29 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/ref/settings/#caches
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "git-tracker",
+    },
+    # Shared by every process on the host, so statistics invalidated by
+    # sync_repo and process_jobs show up in the web server right away
+    "stats": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache" / "stats",
+    },
+}
+# The test suite keeps statistics in memory instead of the working tree
+if sys.argv[1:2] == ["test"]:
+    CACHES["stats"] = {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "git-tracker-stats",
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -160,4 +184,58 @@ DEFAULT_FROM_EMAIL = "no-reply@example.com"  # Replace with your default from em
 
 
 # Webhook config
-WEBHOOK_URL = "https://localhost:8000/tracker/webhook/"
\ No newline at end of file
+WEBHOOK_URL = "https://localhost:8000/tracker/webhook/"
+
+
+# Sync config
+# Number of commits upserted per transaction while syncing
+SYNC_BATCH_SIZE = 500
+# Requests kept in reserve on every token before the sync moves elsewhere
+SYNC_RATE_LIMIT_RESERVE = 50
+# Remaining requests below which a token is paced to last until its reset,
+# above it requests are sent as fast as the workers can
+SYNC_RATE_LIMIT_PACE_BELOW = 1000
+# Requests a paced token may burst before pacing to its remaining quota
+SYNC_RATE_LIMIT_BURST = 100
+# Revalidate GitHub API responses with ETag/Last-Modified, 304s are free
+GITHUB_RESPONSE_CACHE = True
+# Seconds a cached response is kept without being stored again, after which
+# prune_response_cache deletes it
+GITHUB_RESPONSE_CACHE_TTL = 7 * 24 * 3600
+# Commit detail (stats and files) requests sent concurrently per repository
+SYNC_DETAIL_WORKERS = 8
+# Where commits come from: "api" (REST API) or "git" (local bare mirrors)
+SYNC_ENGINE = "api"
+# Directory holding the bare mirrors of the "git" sync engine
+GIT_MIRROR_ROOT = BASE_DIR / "mirrors"
+# Authors kept in the process-wide author cache of sync and webhooks
+SYNC_AUTHOR_CACHE_SIZE = 10000
+# Pages of commits the pager may fetch ahead of the database writer
+SYNC_PIPELINE_DEPTH = 4
+# Seconds a repository sync lease lasts without a heartbeat, a crashed sync
+# holds its repositories this long at most
+SYNC_LEASE_TTL = 600
+
+
+# Webhook job queue
+# Attempts before a failing webhook job is given up
+WEBHOOK_JOB_MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled for every further attempt
+WEBHOOK_JOB_BACKOFF = 30
+WEBHOOK_JOB_MAX_BACKOFF = 3600
+# Seconds after which a running job of a dead worker is claimed again
+WEBHOOK_JOB_CLAIM_TIMEOUT = 900
+# Seconds a push job waits for further pushes to the same repository to
+# merge into it
+WEBHOOK_COALESCE_WINDOW = 10
+# Seconds the token used for a repository's webhook jobs is cached per process
+GITHUB_CLIENT_TOKEN_TTL = 300
+
+
+# Stats cache
+# Cache holding the dashboard and repository statistics
+STATS_CACHE_ALIAS = "stats"
+# Seconds statistics are kept, new commits replace them earlier
+STATS_CACHE_TIMEOUT = 300
+# Seconds concurrent requests wait for the one computing a missing entry
+STATS_CACHE_LOCK_TIMEOUT = 30
@@ -0,0 +1,47 @@
+import time
+
+from tracker import models
+
+# Owner of the throwaway repositories of the benchmark commands
+OWNER_GIT_ID = -1
+
+
+def create_repository(label, suffix):
+    """
+    Create a throwaway repository so a benchmark never touches real rows.
+    """
+    owner, _ = models.Author.objects.get_or_create(
+        git_id=OWNER_GIT_ID,
+        defaults={
+            "username": "benchmark-owner",
+            "avatar_url": "http://example.com/avatar.png",
+            "html_url": "http://example.com",
+        },
+    )
+    return models.Repository.objects.create(
+        git_id=-int(time.time() * 1000) - suffix,
+        name=f"benchmark-{label}-{suffix}",
+        full_name=f"benchmark/{label}-{suffix}",
+        owner=owner,
+        html_url="http://example.com/repo",
+        default_branch="main",
+    )
+
+
+def delete_repositories(repositories):
+    """
+    Delete the throwaway repositories with their commits, then the patch
+    blobs and the owner they leave unreferenced.
+    """
+    pks = [repository.pk for repository in repositories]
+    blob_ids = set(
+        models.CommitFile.objects.filter(
+            commit__repository__in=pks, patch_blob__isnull=False
+        ).values_list("patch_blob", flat=True)
+    )
+    models.Repository.objects.filter(pk__in=pks).delete()
+    # Real commits may share a blob with identical patch text
+    models.PatchBlob.objects.filter(pk__in=blob_ids, commitfile__isnull=True).delete()
+    models.Author.objects.filter(
+        git_id=OWNER_GIT_ID, repository__isnull=True
+    ).delete()
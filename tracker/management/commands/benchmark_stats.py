@@ -0,0 +1,131 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from tracker import models
+from tracker.views import DashboardView, RepositoryChartView, evaluate
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the queries and latency of computing the dashboard and "
+        "repository statistics on a seeded dataset, bypassing the stats cache"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repositories", type=int, default=50)
+        parser.add_argument("--authors", type=int, default=20)
+        parser.add_argument("--days", type=int, default=365)
+        parser.add_argument("--runs", type=int, default=5)
+
+    def seed(self, options):
+        """
+        Create throwaway repositories with rollups for every author and day,
+        so the benchmark never touches real rows.
+        """
+        suffix = int(time.time() * 1000)
+        authors = models.Author.objects.bulk_create(
+            [
+                models.Author(
+                    git_id=-suffix - i,
+                    username=f"benchmark-stats-{suffix}-{i}",
+                    avatar_url="http://example.com/avatar.png",
+                    html_url="http://example.com",
+                )
+                for i in range(options["authors"])
+            ]
+        )
+        today = timezone.localdate()
+        days = [today - timedelta(days=i) for i in range(options["days"])]
+        per_repository = len(authors) * len(days)
+        repositories = models.Repository.objects.bulk_create(
+            [
+                models.Repository(
+                    git_id=-suffix - i,
+                    name=f"benchmark-stats-{i}",
+                    full_name=f"benchmark/stats-{suffix}-{i}",
+                    owner=authors[0],
+                    html_url="http://example.com/repo",
+                    default_branch="main",
+                    language=["Python", "Go", "Rust", None][i % 4],
+                    commit_count=per_repository,
+                    contributor_count=len(authors),
+                    total_additions=per_repository * 10,
+                    total_deletions=per_repository * 2,
+                    first_commit_date=timezone.now() - timedelta(days=len(days)),
+                    last_commit_date=timezone.now(),
+                )
+                for i in range(options["repositories"])
+            ]
+        )
+        for repository in repositories:
+            models.CommitRollup.objects.bulk_create(
+                [
+                    models.CommitRollup(
+                        repository=repository,
+                        author=author,
+                        day=day,
+                        commits=1,
+                        additions=10,
+                        deletions=2,
+                        hours=[1 if hour == 10 else 0 for hour in range(24)],
+                    )
+                    for author in authors
+                    for day in days
+                ],
+                batch_size=2000,
+            )
+        return authors, repositories
+
+    def measure(self, label, compute, runs):
+        timings = []
+        for _ in range(runs):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                compute()
+                timings.append(time.perf_counter() - started)
+        self.stdout.write(
+            f"{label:<18} {len(queries.captured_queries):3d} queries "
+            f"{statistics.median(timings) * 1000:10.1f}ms median "
+            f"{min(timings) * 1000:10.1f}ms best"
+        )
+
+    def dashboard(self, author=None):
+        view = DashboardView()
+        view.setup(RequestFactory().get("/"))
+        # Skips the lookup by username
+        view._author = author or False
+        # The page and its charts together
+        return evaluate(view.get_generic_stats()), view.get_activity()
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"Backend: {connection.vendor}, {options['repositories']} repositories x "
+            f"{options['authors']} authors x {options['days']} days of rollups"
+        )
+        authors, repositories = self.seed(options)
+        try:
+            self.measure("dashboard", self.dashboard, options["runs"])
+            self.measure(
+                "dashboard author",
+                lambda: self.dashboard(authors[0]),
+                options["runs"],
+            )
+            self.measure(
+                "repository stats",
+                lambda: RepositoryChartView().get_stats(repositories[0]),
+                options["runs"],
+            )
+        finally:
+            models.Repository.objects.filter(
+                pk__in=[repository.pk for repository in repositories]
+            ).delete()
+            models.Author.objects.filter(
+                pk__in=[author.pk for author in authors]
+            ).delete()
@@ -0,0 +1,135 @@
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from tracker import models
+from tracker.management.benchmark import create_repository, delete_repositories
+from tracker.services.repository import RepositorySyncService
+
+
+class FakeUser:
+    def __init__(self, git_id):
+        self.id = git_id
+        self.login = f"benchmark-user-{-git_id}"
+        self.avatar_url = "http://example.com/avatar.png"
+        self.html_url = "http://example.com"
+
+
+class FakeFile:
+    def __init__(self, index):
+        self.filename = f"src/file_{index}.py"
+        self.status = "modified"
+        self.additions = 5
+        self.deletions = 1
+        self.changes = 6
+        self.patch = f"@@ -1,2 +1,2 @@\n-old {index}\n+new {index}\n" * 20
+
+
+class FakeStats:
+    additions = 15
+    deletions = 3
+    total = 18
+
+
+class FakeSignature:
+    def __init__(self, when):
+        self.date = when
+
+
+class FakeCommitInfo:
+    def __init__(self, message, when):
+        self.message = message
+        self.author = self.committer = FakeSignature(when)
+
+
+class FakeGitCommit:
+    """
+    The parts of a GitHub commit the sync reads.
+    """
+
+    def __init__(self, index, files, author, when):
+        self.sha = f"{index:040x}"
+        self.html_url = "http://example.com/commit"
+        self.author = self.committer = author
+        self.commit = FakeCommitInfo(f"Benchmark commit {index}", when)
+        self.stats = FakeStats()
+        self.files = [FakeFile(j) for j in range(files)]
+
+
+class FakeRepository:
+    """
+    Lists a synthetic history of the given length, newest first, building
+    each commit on demand so the benchmark itself holds no history.
+    """
+
+    def __init__(self, commits, files, authors):
+        self.commits = commits
+        self.files = files
+        self.authors = [FakeUser(-1000 - i) for i in range(authors)]
+
+    def get_commits(self, **kwargs):
+        now = timezone.now()
+        for i in range(self.commits, 0, -1):
+            yield FakeGitCommit(i, self.files, self.authors[i % len(self.authors)], now)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure peak Python memory of a commit sync over synthetic histories "
+        "of growing length on the configured database. With the streaming "
+        "pipeline the peak should stay flat as the history grows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--commits",
+            type=int,
+            nargs="+",
+            default=[1000, 4000, 16000],
+            help="History lengths to sync",
+        )
+        parser.add_argument("--files", type=int, default=3, help="Files per commit")
+        parser.add_argument("--authors", type=int, default=50)
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def measure(self, repository, commits, options):
+        service = RepositorySyncService(
+            repository=FakeRepository(commits, options["files"], options["authors"]),
+            repo_obj=repository,
+            batch_size=options["batch_size"],
+        )
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            result = service.fetch_commits(full=True)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{commits:>8} commits {result.commits:>8} written "
+            f"{peak / 1024 / 1024:8.1f} MiB peak {elapsed:8.2f}s"
+        )
+
+    def handle(self, *args, **options):
+        # With DEBUG every query is kept on the connection, which would be
+        # measured as growth of the sync itself
+        settings.DEBUG = False
+        self.stdout.write(
+            f"Backend: {connection.vendor}, {options['files']} files per commit, "
+            f"batches of {options['batch_size']}"
+        )
+        repositories = []
+        try:
+            for suffix, commits in enumerate(options["commits"]):
+                repositories.append(create_repository("memory", suffix))
+                self.measure(repositories[-1], commits, options)
+        finally:
+            delete_repositories(repositories)
+            models.Author.objects.filter(
+                git_id__lte=-1000, commit__isnull=True
+            ).delete()
@@ -0,0 +1,104 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from tracker import models
+from tracker.management.benchmark import create_repository, delete_repositories
+from tracker.services.repository import CommitWriter
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure commit write throughput of per-row upserts against the batched "
+        "CommitWriter on the configured database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--commits", type=int, default=2000)
+        parser.add_argument("--files", type=int, default=3, help="Files per commit")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def generate(self, count, files):
+        now = timezone.now()
+        for i in range(count):
+            commit = {
+                "sha": f"{i:040x}",
+                "message": f"Benchmark commit {i}",
+                "date": now,
+                "commited_at": now,
+                "url": "http://example.com/commit",
+                "additions": 10,
+                "deletions": 2,
+                "total": 12,
+            }
+            commit_files = [
+                {
+                    "filename": f"src/file_{j}.py",
+                    "status": "modified",
+                    "additions": 5,
+                    "deletions": 1,
+                    "changes": 6,
+                    "patch": "@@ -1,2 +1,2 @@\n-old\n+new\n" * 20,
+                }
+                for j in range(files)
+            ]
+            yield commit, commit_files
+
+    def run_per_row(self, repository, rows):
+        for commit_data, files in rows:
+            sha = commit_data.pop("sha")
+            commit, _ = models.Commit.objects.update_or_create(
+                repository=repository, sha=sha, defaults=commit_data
+            )
+            for file in files:
+                filename = file.pop("filename")
+                models.CommitFile.objects.update_or_create(
+                    commit=commit, filename=filename, defaults=file
+                )
+
+    def run_batched(self, repository, rows, batch_size):
+        writer = CommitWriter(repository, batch_size=batch_size)
+        for commit_data, files in rows:
+            writer.add(
+                models.Commit(repository=repository, **commit_data),
+                [models.CommitFile(**file) for file in files],
+            )
+        writer.flush()
+
+    def measure(self, label, run):
+        # Run twice so the second pass measures updates of existing rows
+        for phase in ("insert", "update"):
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{label:<10} {phase:<7} {elapsed:8.2f}s "
+                f"{self.commits / elapsed:10.1f} commits/s"
+            )
+
+    def handle(self, *args, **options):
+        self.commits = options["commits"]
+        files = options["files"]
+        self.stdout.write(
+            f"Backend: {connection.vendor}, {self.commits} commits x {files} files"
+        )
+        repositories = [create_repository("writer", suffix) for suffix in (0, 1)]
+        try:
+            self.measure(
+                "per-row",
+                lambda: self.run_per_row(
+                    repositories[0], self.generate(self.commits, files)
+                ),
+            )
+            self.measure(
+                "batched",
+                lambda: self.run_batched(
+                    repositories[1],
+                    self.generate(self.commits, files),
+                    options["batch_size"],
+                ),
+            )
+        finally:
+            delete_repositories(repositories)
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Length
+
+from tracker import models
+
+
+class Command(BaseCommand):
+    help = (
+        "Move inline CommitFile patches into compressed, content addressed "
+        "PatchBlob rows in batches"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of commit files converted per transaction",
+        )
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help="Also delete blobs no commit file refers to anymore",
+        )
+
+    def convert_batch(self, batch_size):
+        """
+        Convert one batch of inline patches, returning the size in
+        characters of the patches that were moved.
+        """
+        with transaction.atomic():
+            files = list(
+                models.CommitFile.objects.filter(inline_patch__isnull=False)
+                .order_by("pk")
+                .only("pk", "inline_patch")[:batch_size]
+            )
+            for file in files:
+                file.patch = file.inline_patch
+            models.CommitFile.store_patches(files)
+            models.CommitFile.objects.bulk_update(
+                files, ["inline_patch", "patch_blob"], batch_size=batch_size
+            )
+        return len(files), sum(len(file.patch) for file in files)
+
+    def handle(self, *args, **options):
+        converted = 0
+        moved = 0
+        while True:
+            count, size = self.convert_batch(options["batch_size"])
+            if not count:
+                break
+            converted += count
+            moved += size
+            self.stdout.write(f"Converted {converted} commit files")
+        if options["prune"]:
+            pruned, _ = models.PatchBlob.objects.filter(
+                commitfile__isnull=True
+            ).delete()
+            self.stdout.write(f"Pruned {pruned} unreferenced blobs")
+        blobs = models.PatchBlob.objects.aggregate(
+            count=Count("id"), size=Sum("size"), stored=Sum(Length("data"))
+        )
+        self.stdout.write(
+            f"Converted {converted} commit files ({moved} characters of patches). "
+            f"{blobs['count']} blobs hold {blobs['size'] or 0} characters "
+            f"in {blobs['stored'] or 0} compressed bytes.",
+            self.style.SUCCESS,
+        )
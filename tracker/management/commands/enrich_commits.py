@@ -0,0 +1,119 @@
+from django.core.management.base import BaseCommand
+
+from tracker import models
+from tracker.services.leases import LeaseBusy, RepositoryLease
+from tracker.services.ratelimit import RateLimitScheduler
+from tracker.services.repository import RepositorySyncService
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill stats and files of commits stored by sync_repo --metadata-only, "
+        "newest first. Safe to stop and rerun, progress is kept per batch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of commits enriched and committed at a time",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="Stop after enriching this many commits",
+        )
+        parser.add_argument(
+            "--repository",
+            type=int,
+            default=None,
+            help="Only enrich commits of the repository with this id",
+        )
+        parser.add_argument(
+            "--lease-wait",
+            type=float,
+            default=60,
+            help="Seconds to wait for a repository that is being synced",
+        )
+
+    def get_service(self, repository: models.Repository):
+        """
+        Return a sync service for the repository, or None when no active
+        token can see it.
+        """
+        if repository.pk not in self.services:
+            token = models.GitToken.objects.filter(
+                user__repositories=repository, is_active=True
+            ).first()
+            if token is None:
+                self.stderr.write(f"No active token found for {repository}")
+                self.services[repository.pk] = None
+            else:
+                client = self.scheduler.client_for(token)
+                self.services[repository.pk] = RepositorySyncService(
+                    repository=client.get_repo(repository.full_name),
+                    repo_obj=repository,
+                    token=token,
+                    scheduler=self.scheduler,
+                )
+        return self.services[repository.pk]
+
+    def handle(self, *args, **options):
+        self.scheduler = RateLimitScheduler()
+        self.services = {}
+        # Commits whose detail could not be fetched are retried by the next
+        # run, not by every batch of this one
+        failed = set()
+        queryset = models.Commit.objects.filter(is_enriched=False)
+        if options["repository"]:
+            queryset = queryset.filter(repository_id=options["repository"])
+        enriched = 0
+        while options["limit"] is None or enriched < options["limit"]:
+            size = options["batch_size"]
+            if options["limit"] is not None:
+                size = min(size, options["limit"] - enriched)
+            # Repositories without a usable token or busy with a sync are
+            # left for a later run
+            skipped = [pk for pk, service in self.services.items() if service is None]
+            batch = list(
+                queryset.exclude(repository_id__in=skipped)
+                .exclude(pk__in=failed)
+                .select_related("repository")
+                .order_by("-commited_at")[:size]
+            )
+            if not batch:
+                break
+            by_repository = {}
+            for commit in batch:
+                by_repository.setdefault(commit.repository, []).append(commit)
+            for repository, commits in by_repository.items():
+                service = self.get_service(repository)
+                if service is None:
+                    continue
+                # The rollup and counter deltas of the writer are only exact
+                # while nothing else writes the repository
+                try:
+                    with RepositoryLease(repository, wait=options["lease_wait"]):
+                        written, errors = service.enrich_commits(commits)
+                except LeaseBusy as e:
+                    self.stderr.write(f"{e}, left for a later run")
+                    self.services[repository.pk] = None
+                    continue
+                enriched += written
+                for commit, error in errors:
+                    failed.add(commit.pk)
+                    self.stderr.write(
+                        f"Skipped commit {commit.sha} of {repository.full_name}: "
+                        f"{error}"
+                    )
+                self.stdout.write(
+                    f"Enriched {written} commits of {repository.full_name}"
+                )
+        remaining = queryset.count()
+        self.stdout.write(
+            f"Enriched {enriched} commits, {remaining} left "
+            f"({len(failed)} failed)",
+            self.style.SUCCESS,
+        )
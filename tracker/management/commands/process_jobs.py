@@ -0,0 +1,112 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from tracker.services.jobs import JobQueue, PushJobRunner
+from tracker.services.leases import LeaseBusy, RepositoryLease
+
+
+class Command(BaseCommand):
+    help = (
+        "Process queued webhook jobs with concurrent workers, retrying failed "
+        "jobs with exponential backoff"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=2,
+            help="Number of jobs processed concurrently",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once no job is due instead of waiting for new ones",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5,
+            help="Seconds an idle worker waits before looking for jobs again",
+        )
+        parser.add_argument(
+            "--depth",
+            action="store_true",
+            help="Only print the queue depth per status",
+        )
+
+    def write_depth(self):
+        depth = self.queue.depth()
+        self.stdout.write(
+            "Queue depth: " + ", ".join(f"{depth[key]} {key}" for key in depth)
+        )
+        savings = self.queue.savings()
+        self.stdout.write(
+            f"Syncs saved: {savings['saved']} ({savings['duplicates']} duplicate "
+            f"deliveries, {savings['coalesced']} coalesced pushes)"
+        )
+        leases = RepositoryLease.contention()
+        self.stdout.write(
+            f"Sync leases: {leases['acquisitions']} taken, "
+            f"{leases['contentions']} found busy"
+        )
+
+    def work(self, worker):
+        """
+        Claim and run jobs until none is due and --once is set, or until
+        the command is stopped.
+        """
+        try:
+            while not self.stopped.is_set():
+                job = self.queue.claim()
+                if job is None:
+                    if self.once:
+                        return
+                    self.stopped.wait(self.poll_interval)
+                    continue
+                try:
+                    result = self.runner.run(job)
+                except LeaseBusy as e:
+                    # The running sync may predate this push, run it again
+                    # once the repository is free
+                    self.queue.defer(job)
+                    self.stdout.write(f"[{worker}] Job {job.pk} deferred: {e}")
+                except Exception as e:
+                    self.queue.fail(job, e)
+                    self.stderr.write(f"[{worker}] Job {job.pk} failed: {e}")
+                else:
+                    self.queue.complete(job)
+                    self.stdout.write(
+                        f"[{worker}] Job {job.pk} done - {job.repository} ({result})",
+                        self.style.SUCCESS,
+                    )
+        finally:
+            connections.close_all()
+
+    def handle(self, *args, **options):
+        self.queue = JobQueue()
+        if options["depth"]:
+            self.write_depth()
+            return
+        self.runner = PushJobRunner()
+        self.once = options["once"]
+        self.poll_interval = options["poll_interval"]
+        self.stopped = threading.Event()
+        workers = max(options["workers"], 1)
+        started_at = time.monotonic()
+        self.write_depth()
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="process-jobs"
+        ) as executor:
+            futures = [executor.submit(self.work, worker) for worker in range(workers)]
+            try:
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                self.stopped.set()
+        self.stdout.write(f"Stopped after {time.monotonic() - started_at:.1f}s")
+        self.write_depth()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from tracker.services.http_cache import prune_response_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete GitHub response cache entries that were not stored for longer "
+        "than GITHUB_RESPONSE_CACHE_TTL, and entries of URLs no longer cached"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age",
+            type=int,
+            default=None,
+            help="Age in seconds after which entries are deleted",
+        )
+
+    def handle(self, *args, **options):
+        deleted = prune_response_cache(options["max_age"])
+        self.stdout.write(
+            f"Deleted {deleted} response cache entries", self.style.SUCCESS
+        )
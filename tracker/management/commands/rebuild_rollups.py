@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tracker import models
+from tracker.services.db import write_lock
+from tracker.services.leases import LeaseBusy, RepositoryLease
+from tracker.services.rollups import ROLLUP_FIELDS, RollupDelta, count_commits
+from tracker.services.stats_cache import stats_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the daily commit rollups of every repository from the raw "
+        "commits, to backfill them or repair them after manual changes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repository",
+            type=int,
+            default=None,
+            help="Only rebuild the rollups of the repository with this id",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Number of commits read per query",
+        )
+        parser.add_argument(
+            "--lease-wait",
+            type=float,
+            default=60,
+            help="Seconds to wait for a repository that is being synced",
+        )
+
+    def rebuild(self, repository: models.Repository, chunk_size):
+        """
+        Replace the rollups and counters of a repository, returning the
+        commits counted.
+        """
+        rollups = RollupDelta(repository)
+        commits = 0
+        for values in (
+            models.Commit.objects.filter(repository=repository)
+            .order_by()
+            .values_list(*ROLLUP_FIELDS)
+            .iterator(chunk_size=chunk_size)
+        ):
+            rollups.add(*values)
+            commits += 1
+        repositories = models.Repository.objects.filter(pk=repository.pk)
+        counters = count_commits(repositories)[repository.pk]
+        with write_lock(), transaction.atomic():
+            stored = models.CommitRollup.objects.filter(repository=repository)
+            authors = set(stored.values_list("author_id", flat=True))
+            authors.update(author_id for author_id, _ in rollups.changes)
+            stored.delete()
+            # The delta holds the full totals, adding them onto the stored
+            # counters would count every commit twice
+            rollups.apply(counters=False)
+            repositories.update(**counters)
+            stats_cache.invalidate_on_commit(
+                "all",
+                f"repository:{repository.pk}",
+                *[f"author:{author_id}" for author_id in authors if author_id],
+            )
+        return commits
+
+    def handle(self, *args, **options):
+        repositories = models.Repository.objects.order_by("pk")
+        if options["repository"]:
+            repositories = repositories.filter(pk=options["repository"])
+            if not repositories.exists():
+                raise CommandError(f"Repository {options['repository']} not found")
+        rebuilt = 0
+        busy = []
+        for repository in repositories:
+            # A sync writing the repository meanwhile would be counted twice
+            try:
+                with RepositoryLease(repository, wait=options["lease_wait"]):
+                    commits = self.rebuild(repository, options["chunk_size"])
+            except LeaseBusy as e:
+                self.stderr.write(str(e))
+                busy.append(repository)
+                continue
+            rebuilt += 1
+            self.stdout.write(f"Rebuilt {repository} ({commits} commits)")
+        self.stdout.write(
+            f"Rebuilt the rollups of {rebuilt} repositories", self.style.SUCCESS
+        )
+        if busy:
+            raise CommandError(
+                f"{len(busy)} repositories were busy, run the command again"
+            )
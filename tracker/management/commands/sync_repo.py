@@ -1,13 +1,120 @@
 import json
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from django.utils import timezone
-from github import Github, GithubException, Hook
+from github import GithubException, Hook
 
 from tracker import models
+from tracker.services.ratelimit import RateLimitScheduler
+from tracker.services.db import write_lock
+from tracker.services.git_mirror import GitMirrorSyncService
+from tracker.services.http_cache import cache_stats
+from tracker.services.leases import LeaseBusy, RepositoryLease
+from tracker.services.planner import SyncPlan
+from tracker.services.authors import author_resolver
 from tracker.services.repository import RepositorySyncService
+from tracker.services.sharding import Shard
+
+
+class SyncProgress:
+    """
+    Progress counters shared by every sync worker.
+    """
+
+    def __init__(self, stdout, style):
+        self.stdout = stdout
+        self.style = style
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.commits = 0
+        self.skipped = 0
+        self.busy = 0
+        self.started_at = time.monotonic()
+
+    def add_repositories(self, count):
+        with self.lock:
+            self.total += count
+
+    def started(self, name):
+        self.stdout.write(f"Syncing - {name}", self.style.WARNING)
+
+    def finished(self, name, commits):
+        with self.lock:
+            self.done += 1
+            self.commits += commits
+            line = f"[{self.done}/{self.total}] Synced - {name} ({commits} commits)"
+        self.stdout.write(line, self.style.SUCCESS)
+
+    def unchanged(self, name):
+        with self.lock:
+            self.done += 1
+            self.skipped += 1
+            line = f"[{self.done}/{self.total}] Unchanged - {name}"
+        self.stdout.write(line)
+
+    def held(self, name, holder):
+        with self.lock:
+            self.done += 1
+            self.busy += 1
+            line = f"[{self.done}/{self.total}] Busy - {name} (synced by {holder})"
+        self.stdout.write(line, self.style.WARNING)
+
+    def counters(self):
+        return {
+            "repositories": self.done,
+            "commits": self.commits,
+            "skipped": self.skipped,
+            "busy": self.busy,
+            "elapsed": time.monotonic() - self.started_at,
+            "cache_hits": cache_stats.hits,
+            "cache_misses": cache_stats.misses,
+        }
+
+    @staticmethod
+    def merge(summaries, elapsed):
+        """
+        Add up the counters of several shard processes.
+        """
+        merged = {
+            key: sum(summary[key] for summary in summaries)
+            for key in (
+                "repositories",
+                "commits",
+                "skipped",
+                "busy",
+                "cache_hits",
+                "cache_misses",
+            )
+        }
+        merged["elapsed"] = elapsed
+        return merged
+
+    def summary(self, counters=None, title=None):
+        counters = counters or self.counters()
+        self.stdout.write("-------------------------------------------------")
+        if title:
+            self.stdout.write(title)
+        self.stdout.write(
+            f"Synced {counters['repositories']} repositories and "
+            f"{counters['commits']} commits in {counters['elapsed']:.1f}s "
+            f"({counters['skipped']} unchanged repositories skipped, "
+            f"{counters['busy']} busy with another sync)",
+            self.style.SUCCESS,
+        )
+        self.stdout.write(
+            f"Response cache: {counters['cache_hits']} hits, "
+            f"{counters['cache_misses']} misses"
+        )
 
 
 class Command(BaseCommand):
@@ -25,53 +132,33 @@ class Command(BaseCommand):
             print(f"Failed to fetch user details: {e}")
             return None
 
-    def insert_or_update_author(self, author, owners={}):
-        # if author is not in owners, create a new author object
-        if author.id not in owners:
-            # Insert or update the author in the database
-            # if an author with the same git_id exists, update it
-            owner, _ = models.Author.objects.get_or_create(
-                git_id=author.id,
-                defaults={
-                    "username": author.login,
-                    "avatar_url": author.avatar_url,
-                    "html_url": author.html_url,
-                },
-            )
-            # Append the author to the owners dictionary
-            # to avoid creating duplicate author objects and to use the existing author object
-            owners[author.id] = owner
-        else:
-            owner = owners[author.id]
-        return owner
-
-    def insert_or_update_repository(self, token: models.GitToken, repo, owners={}):
+    def insert_or_update_repository(self, token: models.GitToken, repo):
         """
         Insert or update a repository in the database.
         """
-        owner = self.insert_or_update_author(repo.owner, owners)
+        owner = self.authors.resolve(repo.owner)
         # if a repository with the same git_id and owner exists, update it
         # else create a new repository
         # values passed in defaults will be updated if the repository already exists
         # else a new repository will be created with the values passed in defaults
-        obj, created = models.Repository.objects.update_or_create(
-            git_id=repo.id,
-            owner=owner,
-            defaults={
-                "name": repo.name,
-                "full_name": repo.full_name,
-                "private": repo.private,
-                "html_url": repo.html_url,
-                "description": repo.description,
-                "language": repo.language,
-                "license": repo.license,
-                "default_branch": repo.default_branch,
-                "created_at": repo.created_at,
-                "updated_at": repo.updated_at,
-                "pushed_at": repo.pushed_at,
-                "last_synced_at": timezone.now(),
-            },
-        )
+        with write_lock():
+            obj, created = models.Repository.objects.update_or_create(
+                git_id=repo.id,
+                owner=owner,
+                defaults={
+                    "name": repo.name,
+                    "full_name": repo.full_name,
+                    "private": repo.private,
+                    "html_url": repo.html_url,
+                    "description": repo.description,
+                    "language": repo.language,
+                    "license": repo.license,
+                    "default_branch": repo.default_branch,
+                    "created_at": repo.created_at,
+                    "updated_at": repo.updated_at,
+                    "last_synced_at": timezone.now(),
+                },
+            )
         if created:
             # if new repository is created, create a webhook for the repository
             EVENTS = ["push"]
@@ -85,52 +172,286 @@ class Command(BaseCommand):
                   active=True,
               )
               obj.webhook_id = hook.id
-              obj.save()
+              with write_lock():
+                  obj.save()
             except Exception as e:
               self.stderr.write(f"Failed to create webhook for repo {obj.name}: {e}")
               
         return obj, created
 
-    def fetch_repositories(
-        self,
-        token: models.GitToken,
-        git_user
-    ):
-        """
-        Fetch and print repositories for the authenticated user.
-        """
-        # try:
-        _repos = git_user.get_repos()
-        owners = {}
-        repositories = []
-        for repo in _repos:
-            self.stdout.write(f"Syncing - {repo.name}", self.style.WARNING)
-            # Create a new repository object
-            repository, _ = self.insert_or_update_repository(token, repo, owners)
-            repositories.append(repository)
-            # Instantiate the RepositorySyncService for syncing commits
-            sync_service = RepositorySyncService(repository=repo,repo_obj=repository)
-            # Fetch commits for the repository
-            commits = sync_service.fetch_commits(owners=owners)
-            self.stdout.write(
-                f"Synced commits - {len(commits)}", self.style.SUCCESS
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Walk the whole commit history instead of only new commits",
+        )
+        parser.add_argument(
+            "--metadata-only",
+            action="store_true",
+            help=(
+                "Only store commits from the listing, without stats and files. "
+                "Run enrich_commits afterwards to fill them in"
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Number of commits written per transaction",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of repositories (and tokens) synced concurrently",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue interrupted repository syncs from their checkpoint",
+        )
+        parser.add_argument(
+            "--shard",
+            type=Shard.parse,
+            default=None,
+            help=(
+                "Only sync slice K of N (K/N), repositories are split by a "
+                "hash of their id so separate processes or hosts never overlap"
+            ),
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Launch this many sync_repo --shard processes and merge their summaries",
+        )
+        parser.add_argument(
+            "--summary-file",
+            default=None,
+            help="Also write the summary counters as JSON to this file",
+        )
+        parser.add_argument(
+            "--lease-wait",
+            type=float,
+            default=0,
+            help=(
+                "Seconds to wait for a repository another sync is working on, "
+                "it is skipped afterwards"
+            ),
+        )
+        parser.add_argument(
+            "--engine",
+            choices=["api", "git"],
+            default=None,
+            help=(
+                "Read commits from the REST API or from local bare git mirrors "
+                "(defaults to the SYNC_ENGINE setting)"
+            ),
+        )
+
+    def run_concurrently(self, func, items, executor=None):
+        """
+        Call func for every item, on the executor's threads when one is given.
+        Worker threads get their own database connection from Django, which
+        is closed once the item is done so connections do not pile up.
+        """
+        if executor is None:
+            return [func(item) for item in items]
+
+        def run(item):
+            try:
+                return func(item)
+            finally:
+                connections.close_all()
+
+        return list(executor.map(run, items))
+
+    def find_unchanged(self, repo):
+        """
+        Return the stored repository when GitHub reports no push or update
+        since its last complete sync, None when it has to be synced.
+        """
+        if self.full or repo.pushed_at is None:
+            return None
+        return models.Repository.objects.filter(
+            git_id=repo.id,
+            pushed_at=repo.pushed_at,
+            updated_at=repo.updated_at,
+            sync_checkpoint__phase=models.SyncCheckpoint.PHASE_COMPLETE,
+        ).first()
+
+    def sync_repository(self, token: models.GitToken, repo):
+        """
+        Insert or update a repository and sync its commits.
+        Untouched repositories only get their sync timestamp moved.
+        The push time is only stored once the commits are synced, so a
+        repository that was busy is not taken for unchanged next time.
+        """
+        with write_lock():
+            repository = self.find_unchanged(repo)
+            if repository is not None:
+                models.Repository.objects.filter(pk=repository.pk).update(
+                    last_synced_at=timezone.now()
+                )
+        if repository is not None:
+            self.progress.unchanged(repo.full_name)
+            return repository
+        self.progress.started(repo.full_name)
+        # Create a new repository object
+        repository, _ = self.insert_or_update_repository(token, repo)
+        # Instantiate the sync service of the chosen engine for syncing commits
+        service_class = (
+            GitMirrorSyncService if self.engine == "git" else RepositorySyncService
+        )
+        sync_service = service_class(
+            repository=repo,
+            repo_obj=repository,
+            authors=self.authors,
+            batch_size=self.batch_size,
+            token=token,
+            scheduler=self.scheduler,
+        )
+        # Fetch commits for the repository, unless a webhook job or another
+        # sync_repo is already doing so
+        try:
+            with RepositoryLease(repository, wait=self.lease_wait):
+                result = sync_service.fetch_commits(
+                    full=self.full,
+                    metadata_only=self.metadata_only,
+                    resume=self.resume,
+                )
+        except LeaseBusy as e:
+            self.progress.held(repo.full_name, e.holder)
+            return repository
+        repository.pushed_at = repo.pushed_at
+        with write_lock():
+            models.Repository.objects.filter(pk=repository.pk).update(
+                pushed_at=repo.pushed_at
             )
-            self.stdout.write(f"Synced - {repo.name}", self.style.SUCCESS)
-            self.stdout.write("-------------------------------------------------")
-        token.user.repositories.set(repositories)
-        return repositories
-        # except GithubException as e:
-        #     self.stderr.write(f"Failed to fetch repositories: {e}")
-        #     return []
-
-  
+        self.progress.finished(repo.full_name, result.commits)
+        return repository
+
+    def list_repositories(self, token: models.GitToken):
+        """
+        Add the repositories the token can see to the cycle's plan.
+        """
+        # Authenticate with the token, the scheduler paces its requests
+        github_client = self.scheduler.client_for(token)
+        # Fetch user details and fetch repositories for the user
+        git_user = self.fetch_user_details(github_client)
+        if git_user:
+            repos = list(git_user.get_repos())
+            # The listing brought the token's remaining quota up to date
+            self.scheduler.record(token)
+            with self.plan_lock:
+                self.plan.add_listing(token, repos)
+
+    def run_cycle(self, tokens, executor=None):
+        """
+        List the repositories of every token, then sync each repository
+        once with the token that has the most quota left.
+        """
+        self.plan = SyncPlan(self.shard)
+        self.plan_lock = threading.Lock()
+        self.run_concurrently(self.list_repositories, tokens, executor)
+        remaining = {
+            token: self.scheduler.quota(token).remaining
+            for token in self.plan.listings
+        }
+        assignments = self.plan.assign(remaining)
+        self.progress.add_repositories(len(assignments))
+        repositories = self.run_concurrently(
+            lambda assignment: self.sync_repository(*assignment), assignments, executor
+        )
+        with write_lock():
+            self.plan.update_memberships(
+                {repository.git_id: repository for repository in repositories}
+            )
+
+    def shard_arguments(self, options):
+        """
+        The command line options every shard process is started with.
+        """
+        arguments = ["--workers", str(options["workers"])]
+        for option in ("full", "metadata_only", "resume"):
+            if options[option]:
+                arguments.append("--" + option.replace("_", "-"))
+        if options["batch_size"]:
+            arguments += ["--batch-size", str(options["batch_size"])]
+        if options["engine"]:
+            arguments += ["--engine", options["engine"]]
+        if options["lease_wait"]:
+            arguments += ["--lease-wait", str(options["lease_wait"])]
+        # --settings reaches the children through DJANGO_SETTINGS_MODULE
+        if options["pythonpath"]:
+            arguments += ["--pythonpath", options["pythonpath"]]
+        return arguments
+
+    def launch_shards(self, processes, options):
+        """
+        Run one sync_repo --shard K/N process per shard, on their own cores,
+        and merge their summaries once every process exited.
+        """
+        started_at = time.monotonic()
+        arguments = self.shard_arguments(options)
+        summaries = []
+        failed = []
+        with tempfile.TemporaryDirectory() as summary_dir:
+            children = []
+            for index in range(1, processes + 1):
+                summary_file = os.path.join(summary_dir, f"shard-{index}.json")
+                command = [
+                    sys.executable,
+                    str(settings.BASE_DIR / "manage.py"),
+                    "sync_repo",
+                    "--shard",
+                    f"{index}/{processes}",
+                    "--summary-file",
+                    summary_file,
+                    *arguments,
+                ]
+                children.append((index, summary_file, subprocess.Popen(command)))
+            for index, summary_file, child in children:
+                if child.wait() != 0:
+                    failed.append(index)
+                    continue
+                with open(summary_file) as f:
+                    summaries.append(json.load(f))
+        progress = SyncProgress(self.stdout, self.style)
+        progress.summary(
+            SyncProgress.merge(summaries, time.monotonic() - started_at),
+            title=f"All {processes} shards",
+        )
+        if failed:
+            raise CommandError(
+                f"Shards {', '.join(f'{index}/{processes}' for index in failed)} failed"
+            )
+
     def handle(self, *args, **options):
+        if options["processes"] > 1:
+            return self.launch_shards(options["processes"], options)
+        self.shard = options["shard"]
+        self.full = options["full"]
+        self.metadata_only = options["metadata_only"]
+        self.resume = options["resume"]
+        self.batch_size = options["batch_size"]
+        self.lease_wait = options["lease_wait"]
+        self.engine = options["engine"] or getattr(settings, "SYNC_ENGINE", "api")
+        workers = max(options["workers"], 1)
+        # Authors are shared by every worker so each one is only created once
+        self.authors = author_resolver
+        self.progress = SyncProgress(self.stdout, self.style)
+        self.scheduler = RateLimitScheduler()
         # Get all active tokens
-        tokens = models.GitToken.objects.filter(is_active=True)
-        for token in tokens:
-            # Authenticate with the token
-            github_client = Github(token.token)
-            # Fetch user details and fetch repositories for the user
-            git_user = self.fetch_user_details(github_client)
-            if git_user:
-                self.fetch_repositories(token, git_user)
+        tokens = list(models.GitToken.objects.filter(is_active=True))
+        if workers == 1:
+            self.run_cycle(tokens)
+        else:
+            with ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="sync-repository"
+            ) as executor:
+                self.run_cycle(tokens, executor)
+        self.progress.summary(title=f"Shard {self.shard}" if self.shard else None)
+        if options["summary_file"]:
+            with open(options["summary_file"], "w") as f:
+                json.dump(self.progress.counters(), f)
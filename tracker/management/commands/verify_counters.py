@@ -0,0 +1,118 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tracker import models
+from tracker.services.db import write_lock
+from tracker.services.leases import LeaseBusy, RepositoryLease
+from tracker.services.rollups import COUNTER_FIELDS, count_commits
+from tracker.services.stats_cache import stats_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the commit counters stored on every repository with their "
+        "commits, and with --repair overwrite the ones that drifted"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repair",
+            action="store_true",
+            help="Store the recomputed counters of drifted repositories",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of repositories verified per query",
+        )
+        parser.add_argument(
+            "--lease-wait",
+            type=float,
+            default=60,
+            help="Seconds to wait for a repository that is being synced",
+        )
+
+    def repair(self, repository: models.Repository, lease_wait):
+        """
+        Store the counters of a repository recounted under its sync lease,
+        so no sync moves them between the count and the write.
+        """
+        with RepositoryLease(repository, wait=lease_wait):
+            repositories = models.Repository.objects.filter(pk=repository.pk)
+            counters = count_commits(repositories)[repository.pk]
+            with write_lock(), transaction.atomic():
+                repositories.update(**counters)
+                stats_cache.invalidate_on_commit("all", f"repository:{repository.pk}")
+
+    def verify_batch(self, repositories, repair, lease_wait=0):
+        """
+        Return the repositories of the batch whose counters drifted,
+        repairing them when asked to.
+        """
+        counted = count_commits(
+            models.Repository.objects.filter(
+                pk__in=[repository.pk for repository in repositories]
+            )
+        )
+        drifted = []
+        for repository in repositories:
+            counters = counted[repository.pk]
+            wrong = [
+                field
+                for field in COUNTER_FIELDS
+                if getattr(repository, field) != counters[field]
+            ]
+            if not wrong:
+                continue
+            self.stdout.write(
+                f"{repository}: "
+                + ", ".join(
+                    f"{field} {getattr(repository, field)} != {counters[field]}"
+                    for field in wrong
+                ),
+                self.style.WARNING,
+            )
+            drifted.append(repository)
+            if repair:
+                try:
+                    self.repair(repository, lease_wait)
+                except LeaseBusy as e:
+                    self.stderr.write(str(e))
+                    self.busy.append(repository)
+        return drifted
+
+    def handle(self, *args, **options):
+        repositories = models.Repository.objects.order_by("pk").only(
+            "pk", "full_name", *COUNTER_FIELDS
+        )
+        size = options["batch_size"]
+        self.busy = []
+        checked = 0
+        drifted = 0
+        last_pk = 0
+        while True:
+            batch = list(repositories.filter(pk__gt=last_pk)[:size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            checked += len(batch)
+            drifted += len(
+                self.verify_batch(batch, options["repair"], options["lease_wait"])
+            )
+        if drifted and not options["repair"]:
+            raise CommandError(
+                f"{drifted} of {checked} repositories have drifted counters, "
+                "run with --repair to fix them"
+            )
+        if options["repair"]:
+            drifted -= len(self.busy)
+        self.stdout.write(
+            f"Verified {checked} repositories, "
+            f"{drifted} {'repaired' if options['repair'] else 'drifted'}",
+            self.style.SUCCESS,
+        )
+        if self.busy:
+            raise CommandError(
+                f"{len(self.busy)} repositories were busy, run the command again"
+            )
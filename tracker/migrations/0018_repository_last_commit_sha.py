@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0017_alter_repository_unique_together_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='last_commit_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='last_commit_sha',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0019_responsecacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commit',
+            name='is_enriched',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0020_commit_is_enriched'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatchBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('data', models.BinaryField()),
+                ('size', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RenameField(
+            model_name='commitfile',
+            old_name='patch',
+            new_name='inline_patch',
+        ),
+        migrations.AddField(
+            model_name='commitfile',
+            name='patch_blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='tracker.patchblob'),
+        ),
+    ]
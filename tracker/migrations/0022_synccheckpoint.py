@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0021_patchblob_commitfile_patch_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phase', models.CharField(choices=[('commits', 'Syncing commits'), ('complete', 'Complete')], default='commits', max_length=20)),
+                ('full', models.BooleanField(default=False)),
+                ('metadata_only', models.BooleanField(default=False)),
+                ('head_sha', models.CharField(blank=True, max_length=255, null=True)),
+                ('head_at', models.DateTimeField(blank=True, null=True)),
+                ('cursor_sha', models.CharField(blank=True, max_length=255, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('repository', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_checkpoint', to='tracker.repository')),
+            ],
+        ),
+    ]
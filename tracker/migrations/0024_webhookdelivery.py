@@ -0,0 +1,44 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_delivery_ids(apps, schema_editor):
+    WebhookJob = apps.get_model("tracker", "WebhookJob")
+    WebhookDelivery = apps.get_model("tracker", "WebhookDelivery")
+    WebhookDelivery.objects.bulk_create(
+        [
+            WebhookDelivery(delivery_id=delivery_id, job_id=job_id)
+            for job_id, delivery_id in WebhookJob.objects.values_list("pk", "delivery_id")
+        ],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0023_webhookjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivery_id', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('duplicates', models.PositiveIntegerField(default=0)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='tracker.webhookjob')),
+            ],
+            options={
+                'verbose_name_plural': 'Webhook Deliveries',
+            },
+        ),
+        migrations.RunPython(copy_delivery_ids, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='webhookjob',
+            name='delivery_id',
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0024_webhookdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(blank=True, max_length=32, null=True)),
+                ('holder', models.CharField(blank=True, max_length=255, null=True)),
+                ('acquired_at', models.DateTimeField(blank=True, null=True)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('acquisitions', models.PositiveIntegerField(default=0)),
+                ('contentions', models.PositiveIntegerField(default=0)),
+                ('last_contended_at', models.DateTimeField(blank=True, null=True)),
+                ('repository', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_lease', to='tracker.repository')),
+            ],
+        ),
+    ]
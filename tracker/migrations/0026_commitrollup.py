@@ -0,0 +1,31 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0025_synclease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommitRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('commits', models.BigIntegerField(default=0)),
+                ('additions', models.BigIntegerField(default=0)),
+                ('deletions', models.BigIntegerField(default=0)),
+                ('hours', models.JSONField(default=list)),
+                ('author', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='tracker.author')),
+                ('repository', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracker.repository')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='tracker_com_day_3053d7_idx')],
+                'unique_together': {('repository', 'author', 'day')},
+            },
+        ),
+    ]
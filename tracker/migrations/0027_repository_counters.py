@@ -0,0 +1,43 @@
+# Generated by Django 5.0.7 on 2026-10-18 02:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0026_commitrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='commit_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='contributor_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='first_commit_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='last_commit_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='total_additions',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='total_deletions',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
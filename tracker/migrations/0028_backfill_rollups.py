@@ -0,0 +1,80 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def backfill(apps, schema_editor):
+    """
+    Rebuild the rollups and the counters of every repository from the same
+    pass over its commits, so the writer's recount of contributor_count from
+    the rollups agrees with the backfilled counters.
+    """
+    Repository = apps.get_model("tracker", "Repository")
+    Commit = apps.get_model("tracker", "Commit")
+    CommitRollup = apps.get_model("tracker", "CommitRollup")
+    CommitRollup.objects.all().delete()
+    for repository in Repository.objects.order_by("pk").iterator():
+        rollups = {}
+        counters = {
+            "commit_count": 0,
+            "contributor_count": 0,
+            "total_additions": 0,
+            "total_deletions": 0,
+            "first_commit_date": None,
+            "last_commit_date": None,
+        }
+        authors = set()
+        for author_id, date, commited_at, additions, deletions in (
+            Commit.objects.filter(repository=repository)
+            .order_by()
+            .values_list("author_id", "date", "commited_at", "additions", "deletions")
+            .iterator(chunk_size=2000)
+        ):
+            additions, deletions = additions or 0, deletions or 0
+            # Same day and hour as RollupDelta.add
+            key = (author_id, timezone.localtime(date).date())
+            rollup = rollups.setdefault(key, [0, 0, 0, [0] * 24])
+            rollup[0] += 1
+            rollup[1] += additions
+            rollup[2] += deletions
+            rollup[3][timezone.localtime(commited_at).hour] += 1
+            counters["commit_count"] += 1
+            counters["total_additions"] += additions
+            counters["total_deletions"] += deletions
+            counters["first_commit_date"] = min(
+                filter(None, [counters["first_commit_date"], date])
+            )
+            counters["last_commit_date"] = max(
+                filter(None, [counters["last_commit_date"], date])
+            )
+            if author_id is not None:
+                authors.add(author_id)
+        counters["contributor_count"] = len(authors)
+        CommitRollup.objects.bulk_create(
+            [
+                CommitRollup(
+                    repository=repository,
+                    author_id=author_id,
+                    day=day,
+                    commits=commits,
+                    additions=additions,
+                    deletions=deletions,
+                    hours=hours,
+                )
+                for (author_id, day), (commits, additions, deletions, hours) in (
+                    rollups.items()
+                )
+            ],
+            batch_size=1000,
+        )
+        Repository.objects.filter(pk=repository.pk).update(**counters)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tracker", "0027_repository_counters"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
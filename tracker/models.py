@@ -1,4 +1,7 @@
+import hashlib
+import zlib
 from enum import Enum
+
 from django.conf import settings
 from django.db import models
 from django.urls import reverse
@@ -66,6 +69,18 @@ class Repository(models.Model):
     updated_at = models.DateTimeField(null=True, blank=True)
     pushed_at = models.DateTimeField(null=True, blank=True)
     last_synced_at = models.DateTimeField(null=True, blank=True)
+    # High-water mark of the last complete commit sync, incremental syncs
+    # only request commits newer than this and stop once they reach it
+    last_commit_sha = models.CharField(max_length=255, null=True, blank=True)
+    last_commit_at = models.DateTimeField(null=True, blank=True)
+    # Totals over the stored commits, updated with every batch the commit
+    # writer stores and recomputed by verify_counters --repair
+    commit_count = models.BigIntegerField(default=0)
+    contributor_count = models.IntegerField(default=0)
+    total_additions = models.BigIntegerField(default=0)
+    total_deletions = models.BigIntegerField(default=0)
+    first_commit_date = models.DateTimeField(null=True, blank=True)
+    last_commit_date = models.DateTimeField(null=True, blank=True)
     users = models.ManyToManyField(
         settings.AUTH_USER_MODEL, related_name="repositories"
     )
@@ -115,6 +130,9 @@ class Commit(models.Model):
     additions = models.BigIntegerField(default=0)
     deletions = models.BigIntegerField(default=0)
     total = models.BigIntegerField(default=0)
+    # False while only the listing metadata is stored, the stats and files
+    # are filled in later by the enrich_commits command
+    is_enriched = models.BooleanField(default=True, db_index=True)
 
     def get_action_url(self, action):
         if action == CommitAction.VIEW_COMMIT_DETAIL:
@@ -136,6 +154,56 @@ class Commit(models.Model):
         ordering = ["-commited_at"]
 
 
+class PatchBlob(models.Model):
+    """
+    A zlib compressed patch keyed by the sha256 of its text, so identical
+    patches across forks and copied assignments are stored once.
+    """
+
+    hash = models.CharField(max_length=64, unique=True)
+    data = models.BinaryField()
+    size = models.BigIntegerField(default=0)
+
+    # Keeps the IN (...) lookups below SQLite's variable limit
+    LOOKUP_BATCH_SIZE = 500
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @property
+    def text(self):
+        return zlib.decompress(bytes(self.data)).decode()
+
+    @classmethod
+    def store(cls, texts):
+        """
+        Store every distinct text that is not stored yet.
+        Returns a mapping of text hash to blob id.
+        """
+        by_hash = {cls.hash_text(text): text for text in texts}
+        cls.objects.bulk_create(
+            [
+                cls(hash=key, data=zlib.compress(text.encode()), size=len(text))
+                for key, text in by_hash.items()
+            ],
+            ignore_conflicts=True,
+            batch_size=cls.LOOKUP_BATCH_SIZE,
+        )
+        hashes = list(by_hash)
+        ids = {}
+        for i in range(0, len(hashes), cls.LOOKUP_BATCH_SIZE):
+            ids.update(
+                cls.objects.filter(
+                    hash__in=hashes[i : i + cls.LOOKUP_BATCH_SIZE]
+                ).values_list("hash", "id")
+            )
+        return ids
+
+    def __str__(self) -> str:
+        return self.hash
+
+
 class CommitFile(models.Model):
     commit = models.ForeignKey(Commit, on_delete=models.CASCADE)
     filename = models.TextField()
@@ -143,8 +211,51 @@ class CommitFile(models.Model):
     additions = models.BigIntegerField(default=0)
     deletions = models.BigIntegerField(default=0)
     changes = models.BigIntegerField(default=0)
-    patch = models.TextField(null=True, blank=True)
-    
+    # Patches written before blob storage, moved by compress_patches
+    inline_patch = models.TextField(null=True, blank=True)
+    patch_blob = models.ForeignKey(
+        PatchBlob, on_delete=models.PROTECT, null=True, blank=True
+    )
+
+    @property
+    def patch(self):
+        """
+        The patch text, wherever it is stored.
+        """
+        if "_patch" in self.__dict__:
+            return self._patch
+        if self.patch_blob_id:
+            return self.patch_blob.text
+        return self.inline_patch
+
+    @patch.setter
+    def patch(self, value):
+        # Stored as a blob on save, or by store_patches for bulk writes
+        self._patch = value
+        self._patch_pending = True
+
+    @classmethod
+    def store_patches(cls, files):
+        """
+        Move the pending patches of the given files into blobs.
+        """
+        pending = [file for file in files if file.__dict__.get("_patch_pending")]
+        ids = PatchBlob.store(
+            [file._patch for file in pending if file._patch is not None]
+        )
+        for file in pending:
+            file.patch_blob_id = (
+                ids[PatchBlob.hash_text(file._patch)]
+                if file._patch is not None
+                else None
+            )
+            file.inline_patch = None
+            file._patch_pending = False
+
+    def save(self, *args, **kwargs):
+        self.store_patches([self])
+        super().save(*args, **kwargs)
+
     def __str__(self) -> str:
         return self.filename
 
@@ -194,3 +305,183 @@ class Notification(models.Model):
 
     def __str__(self):
         return f"Notification for {self.instructor.username} - {self.anomaly}"
+
+
+class ResponseCacheEntry(models.Model):
+    """
+    A cached GitHub API response, revalidated with If-None-Match or
+    If-Modified-Since so unchanged resources are answered with a 304.
+    """
+
+    # sha256 of the request's Authorization header and URL
+    key = models.CharField(max_length=64, unique=True)
+    url = models.TextField()
+    etag = models.CharField(max_length=255, null=True, blank=True)
+    last_modified = models.CharField(max_length=255, null=True, blank=True)
+    headers = models.JSONField(default=dict)
+    body = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.url
+
+    class Meta:
+        verbose_name_plural = "Response Cache Entries"
+
+
+class CommitRollup(models.Model):
+    """
+    Commits of one author in one repository on one day, kept up to date by
+    the commit writer so the dashboards never aggregate the raw commits.
+    Commits without a known author are rolled up with author None.
+    """
+
+    repository = models.ForeignKey(Repository, on_delete=models.CASCADE)
+    author = models.ForeignKey(Author, on_delete=models.CASCADE, null=True, blank=True)
+    # Day of the commit date, in the current time zone like TruncDay
+    day = models.DateField()
+    commits = models.BigIntegerField(default=0)
+    additions = models.BigIntegerField(default=0)
+    deletions = models.BigIntegerField(default=0)
+    # Commits per hour of the day they were committed at, 24 counts
+    hours = models.JSONField(default=list)
+
+    def __str__(self) -> str:
+        return f"{self.repository} - {self.author} - {self.day}"
+
+    class Meta:
+        unique_together = (("repository", "author", "day"),)
+        indexes = [models.Index(fields=["day"])]
+
+
+class SyncCheckpoint(models.Model):
+    """
+    Progress of the commit sync of a repository, saved in the same
+    transaction as every batch of commits so an interrupted sync can be
+    resumed with sync_repo --resume.
+    """
+
+    PHASE_COMMITS = "commits"
+    PHASE_COMPLETE = "complete"
+    PHASES = (
+        (PHASE_COMMITS, "Syncing commits"),
+        (PHASE_COMPLETE, "Complete"),
+    )
+
+    repository = models.OneToOneField(
+        Repository, on_delete=models.CASCADE, related_name="sync_checkpoint"
+    )
+    phase = models.CharField(max_length=20, choices=PHASES, default=PHASE_COMMITS)
+    # Options of the run, a resumed run keeps them
+    full = models.BooleanField(default=False)
+    metadata_only = models.BooleanField(default=False)
+    # Newest commit of the run, it becomes the high-water mark once the
+    # walk completes
+    head_sha = models.CharField(max_length=255, null=True, blank=True)
+    head_at = models.DateTimeField(null=True, blank=True)
+    # Oldest commit written so far, the walk continues after it
+    cursor_sha = models.CharField(max_length=255, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_resumable(self):
+        return self.phase == self.PHASE_COMMITS
+
+    def advance(self, sha):
+        """
+        Move the cursor past a written batch, the caller's transaction
+        commits it together with the batch.
+        """
+        self.cursor_sha = sha
+        self.save(update_fields=["cursor_sha", "head_sha", "head_at", "updated_at"])
+
+    def complete(self):
+        self.phase = self.PHASE_COMPLETE
+        self.save(update_fields=["phase", "updated_at"])
+
+    def __str__(self) -> str:
+        return f"{self.repository} - {self.get_phase_display()}"
+
+
+class SyncLease(models.Model):
+    """
+    Lease on the commit sync of a repository, held by at most one sync
+    across processes and hosts until it is released or expires.
+    Counts how often syncs found it held by another sync.
+    """
+
+    repository = models.OneToOneField(
+        Repository, on_delete=models.CASCADE, related_name="sync_lease"
+    )
+    # Token of the current holder, None while the lease is free
+    token = models.CharField(max_length=32, null=True, blank=True)
+    holder = models.CharField(max_length=255, null=True, blank=True)
+    acquired_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    acquisitions = models.PositiveIntegerField(default=0)
+    contentions = models.PositiveIntegerField(default=0)
+    last_contended_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.repository} - {self.holder or 'free'}"
+
+
+class WebhookJob(models.Model):
+    """
+    A webhook delivery waiting to be processed by process_jobs.
+    Workers claim a job by switching it to running with their claim token,
+    failed jobs go back to pending with a later run_after until they run
+    out of attempts.
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUSES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    repository = models.ForeignKey(Repository, on_delete=models.CASCADE)
+    event = models.CharField(max_length=50)
+    # Push payloads of a burst are merged into one job, see WebhookDelivery
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUSES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField()
+    claim_token = models.CharField(max_length=64, null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.event} - {self.repository} ({self.get_status_display()})"
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+
+class WebhookDelivery(models.Model):
+    """
+    A webhook request received from GitHub and the job it was queued in.
+    Several deliveries share a job when their pushes were coalesced, and
+    a redelivered request only counts as a duplicate.
+    """
+
+    # X-GitHub-Delivery of the webhook request
+    delivery_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    job = models.ForeignKey(
+        WebhookJob, on_delete=models.CASCADE, related_name="deliveries"
+    )
+    duplicates = models.PositiveIntegerField(default=0)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.delivery_id or f"Delivery {self.pk}"
+
+    class Meta:
+        verbose_name_plural = "Webhook Deliveries"
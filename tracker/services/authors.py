@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from tracker import models
+from tracker.services.db import write_lock
+
+
+class AuthorResolver:
+    """
+    Maps GitHub users to Author rows.
+    The users of a whole page of commits are resolved together, with one
+    query for the known authors and one bulk insert for the new ones.
+    Resolved authors are kept in a size-capped LRU that is safe to share
+    between threads, so long-lived processes do not grow without bound.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or getattr(settings, "SYNC_AUTHOR_CACHE_SIZE", 10000)
+        self.lock = threading.Lock()
+        # git_id -> Author, least recently used first
+        self.authors = OrderedDict()
+
+    def cached(self, git_ids):
+        with self.lock:
+            found = {}
+            for git_id in git_ids:
+                if git_id in self.authors:
+                    self.authors.move_to_end(git_id)
+                    found[git_id] = self.authors[git_id]
+            return found
+
+    def remember(self, authors):
+        with self.lock:
+            for author in authors:
+                self.authors[author.git_id] = author
+                self.authors.move_to_end(author.git_id)
+            while len(self.authors) > self.max_size:
+                self.authors.popitem(last=False)
+
+    def lookup(self, git_ids):
+        return {
+            author.git_id: author
+            for author in models.Author.objects.filter(git_id__in=git_ids)
+        }
+
+    def resolve_many(self, users):
+        """
+        Return {git_id: Author} for GitHub users, None entries are skipped.
+        """
+        users = {user.id: user for user in users if user is not None}
+        found = self.cached(users)
+        missing = [git_id for git_id in users if git_id not in found]
+        if missing:
+            with write_lock():
+                fetched = self.lookup(missing)
+                new = [git_id for git_id in missing if git_id not in fetched]
+                if new:
+                    # Another process may insert the same authors meanwhile
+                    models.Author.objects.bulk_create(
+                        [
+                            models.Author(
+                                git_id=git_id,
+                                username=users[git_id].login,
+                                avatar_url=users[git_id].avatar_url,
+                                html_url=users[git_id].html_url,
+                            )
+                            for git_id in new
+                        ],
+                        ignore_conflicts=True,
+                    )
+                    # Users whose login is still held by a stale author
+                    # stay unresolved, as the insert was skipped for them
+                    fetched.update(self.lookup(new))
+            self.remember(fetched.values())
+            found.update(fetched)
+        return found
+
+    def resolve(self, user):
+        """
+        Return the Author of a single GitHub user, or None.
+        """
+        if user is None:
+            return None
+        return self.resolve_many([user]).get(user.id)
+
+    def clear(self):
+        with self.lock:
+            self.authors.clear()
+
+
+# Shared by the sync commands and the webhook handler
+author_resolver = AuthorResolver()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from django.conf import settings
+from github import Github
+
+from tracker import models
+from tracker.services.http_cache import build_client
+
+
+class ClientRegistry:
+    """
+    Keeps one long-lived GitHub client per token, so its keep-alive
+    connection pool (and TLS session) is reused by every sync and webhook
+    job of the process instead of being set up per call.
+    Also caches which token webhook jobs of a repository run with, for
+    token_ttl seconds, so other processes pick up token changes too.
+    """
+
+    def __init__(self, token_ttl=None, clock=time.monotonic):
+        self.token_ttl = (
+            token_ttl
+            if token_ttl is not None
+            else getattr(settings, "GITHUB_CLIENT_TOKEN_TTL", 300)
+        )
+        self.clock = clock
+        self.lock = threading.Lock()
+        # token pk -> (token value, client)
+        self.clients = {}
+        # repository pk -> (GitToken, expires_at)
+        self.tokens = {}
+
+    def build_client(self, token: models.GitToken) -> Github:
+        # Requests are paced by the rate limit scheduler, so PyGithub's own
+        # fixed spacing between requests is turned off; the pool is sized
+        # for the threads fetching commit details at the same time
+        return build_client(
+            token.token,
+            seconds_between_requests=None,
+            pool_size=getattr(settings, "SYNC_DETAIL_WORKERS", 8),
+        )
+
+    def client_for(self, token: models.GitToken) -> Github:
+        with self.lock:
+            value, client = self.clients.get(token.pk, (None, None))
+            # A token edited in another process shows up with a new value
+            if client is None or value != token.token:
+                client = self.build_client(token)
+                self.clients[token.pk] = (token.token, client)
+            return client
+
+    def token_for(self, repository: models.Repository):
+        """
+        Return the first active token of one of the repository's users, or
+        None when there is none.
+        """
+        now = self.clock()
+        with self.lock:
+            token, expires_at = self.tokens.get(repository.pk, (None, 0))
+        if token is not None and expires_at > now:
+            return token
+        token = models.GitToken.objects.filter(
+            user__repositories=repository, is_active=True
+        ).first()
+        if token is not None:
+            with self.lock:
+                self.tokens[repository.pk] = (token, now + self.token_ttl)
+        return token
+
+    def forget_repository(self, repository: models.Repository):
+        with self.lock:
+            self.tokens.pop(repository.pk, None)
+
+    def invalidate(self, token: models.GitToken):
+        """
+        Drop the client of an edited or deleted token, and every repository
+        mapped to it.
+        """
+        with self.lock:
+            self.clients.pop(token.pk, None)
+            self.tokens = {
+                repository_pk: entry
+                for repository_pk, entry in self.tokens.items()
+                if entry[0].pk != token.pk
+            }
+
+    def clear(self):
+        with self.lock:
+            self.clients.clear()
+            self.tokens.clear()
+
+
+# Shared by the sync commands, the job workers and the token views
+client_registry = ClientRegistry()
@@ -0,0 +1,20 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import connection
+
+# SQLite allows a single writer at a time, concurrent sync workers take turns
+# instead of failing with "database is locked"
+_sqlite_write_lock = threading.RLock()
+
+
+@contextmanager
+def write_lock():
+    """
+    Serialise database writes between threads when running on SQLite.
+    """
+    if connection.vendor != "sqlite":
+        yield
+        return
+    with _sqlite_write_lock:
+        yield
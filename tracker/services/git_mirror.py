@@ -0,0 +1,391 @@
+import base64
+import os
+import re
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from tracker import models
+from tracker.services.repository import (
+    CommitWriter,
+    RepositorySyncService,
+    SyncResult,
+)
+
+# Field and record separators of the git log format below
+FIELD = "\x1f"
+RECORD = "\x1e"
+LOG_FORMAT = FIELD.join(["%H", "%aI", "%cI", "%an", "%ae", "%cn", "%ce", "%B", ""])
+NUMSTAT = re.compile(r"^(\d+|-)\t(\d+|-)\t(.*)$")
+NOREPLY_EMAIL = re.compile(r"^(?:(\d+)\+)?([^@]+)@users\.noreply\.github\.com$")
+
+
+class LogFile:
+    """
+    A file changed by a commit, as parsed from git log.
+    """
+
+    def __init__(self, filename, additions, deletions):
+        self.filename = filename
+        self.additions = additions
+        self.deletions = deletions
+        self.changes = additions + deletions
+        self.status = "modified"
+        self.patch = None
+
+
+class LogCommit:
+    """
+    A commit parsed from git log.
+    """
+
+    def __init__(self, sha, date, commited_at, author, committer, message, files):
+        self.sha = sha
+        self.date = date
+        self.commited_at = commited_at
+        # (name, email) pairs
+        self.author = author
+        self.committer = committer
+        self.message = message
+        self.files = files
+        self.additions = sum(file.additions for file in files)
+        self.deletions = sum(file.deletions for file in files)
+        self.total = self.additions + self.deletions
+
+
+class NoreplyUser:
+    """
+    The GitHub user behind a noreply email, shaped like the users the
+    author resolver gets from the API.
+    """
+
+    def __init__(self, git_id, login):
+        self.id = git_id
+        self.login = login
+        self.avatar_url = f"https://avatars.githubusercontent.com/u/{git_id}"
+        self.html_url = f"https://github.com/{login}"
+
+
+def parse_changes(text):
+    """
+    Parse the --numstat and --patch output that follows a commit header.
+    """
+    files = []
+    blocks = []
+    # Patches may hold characters splitlines() also breaks on
+    for line in text.split("\n"):
+        if line.startswith("diff --git "):
+            blocks.append([])
+        elif blocks:
+            blocks[-1].append(line)
+        else:
+            match = NUMSTAT.match(line)
+            if match:
+                additions, deletions, filename = match.groups()
+                files.append(
+                    LogFile(
+                        filename,
+                        0 if additions == "-" else int(additions),
+                        0 if deletions == "-" else int(deletions),
+                    )
+                )
+    # With --no-renames the patches come in the same order as the numstat
+    for file, block in zip(files, blocks):
+        hunk = next(
+            (i for i, line in enumerate(block) if line.startswith("@@")), None
+        )
+        header = block if hunk is None else block[:hunk]
+        if any(line.startswith("new file mode") for line in header):
+            file.status = "added"
+        elif any(line.startswith("deleted file mode") for line in header):
+            file.status = "removed"
+        if hunk is not None:
+            file.patch = "\n".join(block[hunk:])
+    return files
+
+
+def parse_record(record):
+    sha, date, commited_at, author, author_email, committer, committer_email, message, changes = record.split(
+        FIELD, 8
+    )
+    return LogCommit(
+        sha=sha.strip(),
+        date=datetime.fromisoformat(date),
+        commited_at=datetime.fromisoformat(commited_at),
+        author=(author, author_email),
+        committer=(committer, committer_email),
+        message=message.rstrip("\n"),
+        files=parse_changes(changes),
+    )
+
+
+def parse_log(lines):
+    """
+    Stream LogCommits out of git log output, holding one commit at a time.
+    """
+    record = []
+    for line in lines:
+        if line.startswith(RECORD):
+            if record:
+                yield parse_record("".join(record))
+            record = [line[1:]]
+        elif record:
+            record.append(line)
+    if record:
+        yield parse_record("".join(record))
+
+
+class GitMirrorSyncService(RepositorySyncService):
+    """
+    Syncs commits from a local bare mirror of the repository, kept up to
+    date with git fetch, instead of the REST API. Syncing is then bound by
+    local I/O and uses no API quota.
+    Git only knows names and emails, so authors are matched through GitHub
+    noreply addresses and left empty otherwise.
+    """
+
+    # Authors from the API are better than what git can tell, keep them
+    UPDATE_FIELDS = [
+        field
+        for field in CommitWriter.COMMIT_UPDATE_FIELDS
+        if field not in ("author", "committer", "url")
+    ]
+
+    def __init__(self, *args, remote_url=None, mirror_root=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.remote_url = remote_url or f"{self.repo_obj.html_url}.git"
+        self.mirror_root = Path(
+            mirror_root or getattr(settings, "GIT_MIRROR_ROOT", "mirrors")
+        )
+
+    @property
+    def mirror_path(self):
+        return self.mirror_root / f"{self.repo_obj.git_id}.git"
+
+    def git_env(self):
+        """
+        Pass the token as an HTTP header through the environment, so it is
+        neither stored in the mirror config nor visible in the process list.
+        """
+        env = os.environ.copy()
+        if self.token is not None:
+            credentials = base64.b64encode(
+                f"x-access-token:{self.token.token}".encode()
+            ).decode()
+            env.update(
+                {
+                    "GIT_CONFIG_COUNT": "1",
+                    "GIT_CONFIG_KEY_0": "http.extraHeader",
+                    "GIT_CONFIG_VALUE_0": f"Authorization: Basic {credentials}",
+                }
+            )
+        env["GIT_TERMINAL_PROMPT"] = "0"
+        return env
+
+    def git(self, *args, **kwargs):
+        return subprocess.run(
+            ["git", "--git-dir", str(self.mirror_path), *args],
+            env=self.git_env(),
+            capture_output=True,
+            text=True,
+            **kwargs,
+        )
+
+    def update_mirror(self):
+        """
+        Create the bare mirror on first use and fetch new commits into it.
+        """
+        if not self.mirror_path.exists():
+            self.mirror_root.mkdir(parents=True, exist_ok=True)
+            subprocess.run(
+                ["git", "init", "--bare", "--quiet", str(self.mirror_path)],
+                check=True,
+            )
+        result = self.git(
+            "fetch",
+            "--prune",
+            "--no-tags",
+            "--quiet",
+            self.remote_url,
+            "+refs/heads/*:refs/heads/*",
+        )
+        if result.returncode:
+            raise CommandError(result.stderr.strip())
+
+    def has_commit(self, sha):
+        return self.git("cat-file", "-e", f"{sha}^{{commit}}").returncode == 0
+
+    def log_range(self, full=False, head_sha=None):
+        branch = head_sha or f"refs/heads/{self.repo_obj.default_branch}"
+        mark = self.repo_obj.last_commit_sha
+        # After a force push the mark may no longer be in the mirror
+        if full or not mark or not self.has_commit(mark):
+            return branch
+        return f"{mark}..{branch}"
+
+    def iter_log(self, full=False, metadata_only=False, head_sha=None, cursor_sha=None):
+        """
+        Stream the commits of the branch, or of a resumed run pinned to its
+        head_sha, skipping those up to cursor_sha. Reading them again from
+        the mirror is cheap, writing them is the work being saved.
+        """
+        commits = self._iter_log(full, metadata_only, head_sha)
+        if cursor_sha:
+            for log_commit in commits:
+                if log_commit.sha == cursor_sha:
+                    break
+        yield from commits
+
+    def _iter_log(self, full, metadata_only, head_sha):
+        args = [
+            "git",
+            "-c",
+            "core.quotePath=false",
+            "--git-dir",
+            str(self.mirror_path),
+            "log",
+            self.log_range(full=full, head_sha=head_sha),
+            f"--format={RECORD}{LOG_FORMAT}",
+            "--no-color",
+        ]
+        if not metadata_only:
+            args += ["--numstat", "--patch", "--no-renames", "--diff-merges=first-parent"]
+        # stderr goes to a file, an unread pipe could fill up and block git
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                text=True,
+                encoding="utf-8",
+                errors="replace",
+            )
+            try:
+                yield from parse_log(process.stdout)
+            finally:
+                process.stdout.close()
+                process.wait()
+            # Only reached when the log was read to the end, a missing branch
+            # must not look like a repository without new commits
+            if process.returncode:
+                stderr.seek(0)
+                raise CommandError(
+                    f"git log failed with exit status {process.returncode}: "
+                    f"{stderr.read().decode(errors='replace').strip()}"
+                )
+
+    def resolve_identities(self, emails):
+        """
+        Match the git emails of a batch of commits to Authors through GitHub
+        noreply addresses and return {email: Author}. Addresses with a user
+        id go through the author resolver, login-only ones are looked up
+        with a single query.
+        """
+        users = {}
+        logins = {}
+        for email in set(emails):
+            match = NOREPLY_EMAIL.match(email or "")
+            if not match:
+                continue
+            git_id, login = match.groups()
+            if git_id is None:
+                logins[email] = login
+            else:
+                users[email] = NoreplyUser(int(git_id), login)
+        resolved = self.authors.resolve_many(users.values())
+        authors = {email: resolved.get(user.id) for email, user in users.items()}
+        if logins:
+            by_login = {
+                author.username: author
+                for author in models.Author.objects.filter(
+                    username__in=set(logins.values())
+                )
+            }
+            authors.update(
+                {email: by_login.get(login) for email, login in logins.items()}
+            )
+        return authors
+
+    def write_batch(self, writer, batch):
+        """
+        Resolve the authors of a batch of commits at once and queue them.
+        """
+        authors = self.resolve_identities(
+            email for _, _, emails in batch for email in emails
+        )
+        for commit, files, (author_email, committer_email) in batch:
+            commit.author = authors.get(author_email)
+            commit.committer = authors.get(committer_email)
+            writer.add(commit, files)
+
+    def fetch_commits(self, full=False, metadata_only=False, resume=False):
+        """
+        Fetch the mirror and store the commits git log reports, streaming
+        them from git into the writer one commit at a time.
+        """
+        try:
+            self.update_mirror()
+            checkpoint = self.start_checkpoint(full, metadata_only, resume)
+            full, metadata_only = checkpoint.full, checkpoint.metadata_only
+            writer = CommitWriter(
+                self.repo_obj,
+                batch_size=self.batch_size,
+                update_fields=(
+                    CommitWriter.METADATA_UPDATE_FIELDS
+                    if metadata_only
+                    else self.UPDATE_FIELDS
+                ),
+                checkpoint=checkpoint,
+            )
+            log = self.iter_log(
+                full=full,
+                metadata_only=metadata_only,
+                head_sha=checkpoint.head_sha,
+                cursor_sha=checkpoint.cursor_sha,
+            )
+            # Commits wait here for their authors, one writer batch at a time
+            batch = []
+            for log_commit in log:
+                if checkpoint.head_sha is None:
+                    checkpoint.head_sha = log_commit.sha
+                    checkpoint.head_at = log_commit.commited_at
+                commit = models.Commit(
+                    repository=self.repo_obj,
+                    sha=log_commit.sha,
+                    message=log_commit.message,
+                    date=log_commit.date,
+                    commited_at=log_commit.commited_at,
+                    url=f"{self.repo_obj.html_url}/commit/{log_commit.sha}",
+                    additions=log_commit.additions,
+                    deletions=log_commit.deletions,
+                    total=log_commit.total,
+                    is_enriched=not metadata_only,
+                )
+                files = [
+                    models.CommitFile(
+                        filename=file.filename,
+                        status=file.status,
+                        additions=file.additions,
+                        deletions=file.deletions,
+                        changes=file.changes,
+                        patch=file.patch,
+                    )
+                    for file in log_commit.files
+                ]
+                emails = (log_commit.author[1], log_commit.committer[1])
+                batch.append((commit, files, emails))
+                if len(batch) >= writer.batch_size:
+                    self.write_batch(writer, batch)
+                    batch = []
+            self.write_batch(writer, batch)
+            writer.flush()
+            self.complete_checkpoint(checkpoint)
+            return SyncResult.from_writer(writer)
+        except Exception as e:
+            raise CommandError(
+                f"Failed to fetch commits for repository {self.repo_obj.name}: {e}"
+            )
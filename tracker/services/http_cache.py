@@ -0,0 +1,211 @@
+import hashlib
+import re
+import threading
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.utils import timezone
+from github import Github
+from github.Requester import (
+    HTTPRequestsConnectionClass,
+    HTTPSRequestsConnectionClass,
+    Requester,
+)
+
+from tracker import models
+from tracker.services.db import write_lock
+
+
+class CacheStats:
+    """
+    Hit and miss counters of the response cache.
+    A hit is a 304 answered from the cache, which costs no rate limit quota.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def reset(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
+
+
+cache_stats = CacheStats()
+
+# Listings that every sync revalidates: the user and their repositories, a
+# repository, its branches and its commit list pages. Commit details and
+# compares carry full patches and are never requested twice, so they are
+# not cached.
+CACHEABLE_PATH = re.compile(
+    r"^/(user(/repos)?|repos/[^/]+/[^/]+(/branches(/.+)?|/commits)?)/?$"
+)
+
+
+def is_cacheable(url):
+    return bool(CACHEABLE_PATH.match(urlsplit(url).path))
+
+
+def prune_response_cache(max_age=None):
+    """
+    Delete entries not stored for longer than `max_age` (seconds, the
+    GITHUB_RESPONSE_CACHE_TTL setting by default) and entries of URLs that
+    are no longer cached, returning how many were deleted.
+    """
+    if max_age is None:
+        max_age = getattr(settings, "GITHUB_RESPONSE_CACHE_TTL", 7 * 24 * 3600)
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    entries = models.ResponseCacheEntry.objects.all()
+    stale = list(entries.filter(updated_at__lt=cutoff).values_list("pk", flat=True))
+    stale += [
+        pk
+        for pk, url in entries.filter(updated_at__gte=cutoff).values_list("pk", "url")
+        if not is_cacheable(url)
+    ]
+    deleted = 0
+    # Keep the deletes small, the table is written by running syncs
+    for start in range(0, len(stale), 500):
+        with write_lock():
+            deleted += models.ResponseCacheEntry.objects.filter(
+                pk__in=stale[start : start + 500]
+            ).delete()[0]
+    return deleted
+
+
+class CachedResponse:
+    """
+    A cached body served in place of a 304, mimicking RequestsResponse.
+    """
+
+    def __init__(self, entry: models.ResponseCacheEntry, headers):
+        self.status = 200
+        # Keep the fresh rate limit headers of the 304 so quota tracking
+        # stays accurate
+        self.headers = {**entry.headers, **headers}
+        self.text = entry.body
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.text
+
+
+def _thread_local(name):
+    return property(
+        lambda self: getattr(self._local, name),
+        lambda self, value: setattr(self._local, name, value),
+    )
+
+
+class ThreadLocalRequestMixin:
+    """
+    PyGithub reuses one connection object per client and stores the pending
+    request on it between request() and getresponse(). Keeping that state
+    per thread lets several threads share a client (and its keep-alive
+    session) without sending each other's requests.
+    """
+
+    verb = _thread_local("verb")
+    url = _thread_local("url")
+    input = _thread_local("input")
+    headers = _thread_local("headers")
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super().__init__(*args, **kwargs)
+
+
+class ResponseCacheMixin:
+    """
+    Stores ETag/Last-Modified of listing GETs per token and URL, and
+    revalidates them with conditional requests.
+    """
+
+    def cache_key(self):
+        authorization = self.headers.get("Authorization", "")
+        return hashlib.sha256(f"{authorization} {self.url}".encode()).hexdigest()
+
+    def getresponse(self):
+        if self.verb != "GET" or not is_cacheable(self.url):
+            return super().getresponse()
+        key = self.cache_key()
+        entry = models.ResponseCacheEntry.objects.filter(key=key).first()
+        if entry:
+            self.headers = dict(self.headers)
+            if entry.etag:
+                self.headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                self.headers["If-Modified-Since"] = entry.last_modified
+        response = super().getresponse()
+        if response.status == 304 and entry:
+            cache_stats.hit()
+            return CachedResponse(entry, dict(response.headers))
+        cache_stats.miss()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status == 200 and (etag or last_modified):
+            with write_lock():
+                models.ResponseCacheEntry.objects.update_or_create(
+                    key=key,
+                    defaults={
+                        "url": self.url,
+                        "etag": etag,
+                        "last_modified": last_modified,
+                        "headers": dict(response.headers),
+                        "body": response.text,
+                    },
+                )
+        return response
+
+
+class ConcurrentHTTPConnection(ThreadLocalRequestMixin, HTTPRequestsConnectionClass):
+    pass
+
+
+class ConcurrentHTTPSConnection(ThreadLocalRequestMixin, HTTPSRequestsConnectionClass):
+    pass
+
+
+class CachedHTTPConnection(ResponseCacheMixin, ConcurrentHTTPConnection):
+    pass
+
+
+class CachedHTTPSConnection(ResponseCacheMixin, ConcurrentHTTPSConnection):
+    pass
+
+
+# Connection classes are swapped on the Requester class while a client is
+# built, so the swap must not interleave between threads
+_build_lock = threading.Lock()
+
+
+def build_client(token: str, **kwargs) -> Github:
+    """
+    Build a GitHub client that can be shared between threads, backed by the
+    response cache when GITHUB_RESPONSE_CACHE is enabled.
+    """
+    if getattr(settings, "GITHUB_RESPONSE_CACHE", False):
+        connection_classes = (CachedHTTPConnection, CachedHTTPSConnection)
+    else:
+        connection_classes = (ConcurrentHTTPConnection, ConcurrentHTTPSConnection)
+    with _build_lock:
+        Requester.injectConnectionClasses(*connection_classes)
+        try:
+            return Github(token, **kwargs)
+        finally:
+            Requester.resetConnectionClasses()
@@ -0,0 +1,269 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from tracker import models
+from tracker.services.authors import author_resolver
+from tracker.services.clients import ClientRegistry, client_registry
+from tracker.services.db import write_lock
+from tracker.services.leases import LeaseBusy, RepositoryLease
+from tracker.services.ratelimit import RateLimitScheduler
+from tracker.services.repository import RepositorySyncService
+
+
+class JobQueue:
+    """
+    A durable queue of webhook jobs kept in the WebhookJob table.
+    A job is claimed with a conditional UPDATE that only succeeds for the
+    worker that moves it out of pending first, which works the same on
+    SQLite and on server databases without row locking. Jobs claimed by a
+    worker that died are claimed again once claim_timeout seconds passed.
+    Redelivered requests are recognised by their X-GitHub-Delivery id, and
+    a push for a repository that already has a pending push job is merged
+    into it. Push jobs wait coalesce_window seconds so a burst of pushes
+    ends up in one sync.
+    """
+
+    def __init__(
+        self,
+        max_attempts=None,
+        backoff=None,
+        max_backoff=None,
+        claim_timeout=None,
+        coalesce_window=None,
+    ):
+        self.max_attempts = max_attempts or getattr(
+            settings, "WEBHOOK_JOB_MAX_ATTEMPTS", 5
+        )
+        self.backoff = backoff or getattr(settings, "WEBHOOK_JOB_BACKOFF", 30)
+        self.max_backoff = max_backoff or getattr(
+            settings, "WEBHOOK_JOB_MAX_BACKOFF", 3600
+        )
+        self.claim_timeout = claim_timeout or getattr(
+            settings, "WEBHOOK_JOB_CLAIM_TIMEOUT", 900
+        )
+        self.coalesce_window = (
+            coalesce_window
+            if coalesce_window is not None
+            else getattr(settings, "WEBHOOK_COALESCE_WINDOW", 10)
+        )
+
+    @staticmethod
+    def merge_pushes(queued, pushed):
+        """
+        Merge two push payloads into one covering both ranges.
+        """
+        merged = dict(pushed)
+        merged["before"] = queued["before"]
+        merged["commits"] = queued.get("commits", []) + pushed.get("commits", [])
+        # A push that does not continue the queued one rewrote its history
+        merged["forced"] = (
+            queued.get("forced", False)
+            or pushed.get("forced", False)
+            or pushed["before"] != queued["after"]
+        )
+        return merged
+
+    def coalesce(self, repository: models.Repository, payload):
+        """
+        Merge a push into the pending push job of the repository, returning
+        that job, or None when there is none to merge into.
+        """
+        job = (
+            models.WebhookJob.objects.select_for_update()
+            .filter(
+                repository=repository,
+                event="push",
+                status=models.WebhookJob.STATUS_PENDING,
+            )
+            .order_by("pk")
+            .last()
+        )
+        if job is None:
+            return None
+        # The job is only merged into while no worker claimed it meanwhile
+        merged = models.WebhookJob.objects.filter(
+            pk=job.pk,
+            status=models.WebhookJob.STATUS_PENDING,
+            claim_token=job.claim_token,
+        ).update(payload=self.merge_pushes(job.payload, payload))
+        return job if merged else None
+
+    def enqueue(
+        self, repository: models.Repository, event, payload, delivery_id=None
+    ):
+        """
+        Queue a webhook delivery and return its job.
+        """
+        with write_lock(), transaction.atomic():
+            if delivery_id:
+                delivery = (
+                    models.WebhookDelivery.objects.select_for_update()
+                    .filter(delivery_id=delivery_id)
+                    .select_related("job")
+                    .first()
+                )
+                if delivery is not None:
+                    models.WebhookDelivery.objects.filter(pk=delivery.pk).update(
+                        duplicates=F("duplicates") + 1
+                    )
+                    return delivery.job
+            job = self.coalesce(repository, payload) if event == "push" else None
+            if job is None:
+                job = models.WebhookJob.objects.create(
+                    repository=repository,
+                    event=event,
+                    payload=payload,
+                    run_after=timezone.now()
+                    + timedelta(seconds=self.coalesce_window),
+                )
+            models.WebhookDelivery.objects.create(delivery_id=delivery_id, job=job)
+        return job
+
+    def claimable(self):
+        now = timezone.now()
+        return models.WebhookJob.objects.filter(
+            Q(status=models.WebhookJob.STATUS_PENDING, run_after__lte=now)
+            | Q(
+                status=models.WebhookJob.STATUS_RUNNING,
+                claimed_at__lt=now - timedelta(seconds=self.claim_timeout),
+            )
+        )
+
+    def claim(self):
+        """
+        Claim the next due job, or return None when there is none.
+        """
+        while True:
+            with write_lock():
+                candidates = list(
+                    self.claimable()
+                    .order_by("run_after", "pk")
+                    .values_list("pk", "status", "claim_token")[:10]
+                )
+                if not candidates:
+                    return None
+                for pk, status, claim_token in candidates:
+                    # Only one worker sees its UPDATE match the old state
+                    claimed = models.WebhookJob.objects.filter(
+                        pk=pk, status=status, claim_token=claim_token
+                    ).update(
+                        status=models.WebhookJob.STATUS_RUNNING,
+                        claim_token=uuid.uuid4().hex,
+                        claimed_at=timezone.now(),
+                    )
+                    if claimed:
+                        return models.WebhookJob.objects.get(pk=pk)
+
+    def complete(self, job: models.WebhookJob):
+        with write_lock():
+            models.WebhookJob.objects.filter(
+                pk=job.pk, claim_token=job.claim_token
+            ).update(status=models.WebhookJob.STATUS_DONE, last_error=None)
+
+    def fail(self, job: models.WebhookJob, error):
+        """
+        Put a failed job back with exponential backoff, or give up on it
+        after max_attempts.
+        """
+        attempts = job.attempts + 1
+        if attempts >= self.max_attempts:
+            status = models.WebhookJob.STATUS_FAILED
+        else:
+            status = models.WebhookJob.STATUS_PENDING
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        with write_lock():
+            models.WebhookJob.objects.filter(
+                pk=job.pk, claim_token=job.claim_token
+            ).update(
+                status=status,
+                attempts=attempts,
+                run_after=timezone.now() + timedelta(seconds=delay),
+                last_error=str(error),
+            )
+
+    def defer(self, job: models.WebhookJob, delay=None):
+        """
+        Put a job back for later without counting an attempt, for pushes
+        whose repository is being synced by someone else right now.
+        """
+        delay = self.backoff if delay is None else delay
+        with write_lock():
+            models.WebhookJob.objects.filter(
+                pk=job.pk, claim_token=job.claim_token
+            ).update(
+                status=models.WebhookJob.STATUS_PENDING,
+                run_after=timezone.now() + timedelta(seconds=delay),
+            )
+
+    def depth(self):
+        """
+        Number of jobs per status, with how many pending jobs are due.
+        """
+        counts = dict.fromkeys(
+            [status for status, _ in models.WebhookJob.STATUSES], 0
+        )
+        counts.update(
+            models.WebhookJob.objects.values_list("status").annotate(Count("pk"))
+        )
+        counts["due"] = models.WebhookJob.objects.filter(
+            status=models.WebhookJob.STATUS_PENDING, run_after__lte=timezone.now()
+        ).count()
+        return counts
+
+    def savings(self):
+        """
+        Syncs saved by deduplicating redeliveries and coalescing pushes.
+        """
+        deliveries = models.WebhookDelivery.objects.aggregate(
+            count=Count("pk"), duplicates=Sum("duplicates")
+        )
+        jobs = models.WebhookJob.objects.filter(deliveries__isnull=False).distinct()
+        duplicates = deliveries["duplicates"] or 0
+        coalesced = deliveries["count"] - jobs.count()
+        return {
+            "duplicates": duplicates,
+            "coalesced": coalesced,
+            "saved": duplicates + coalesced,
+        }
+
+
+class PushJobRunner:
+    """
+    Applies push jobs to their repository with the first active token of
+    one of its users, through the pooled client of that token.
+    """
+
+    def __init__(
+        self, scheduler: RateLimitScheduler = None, clients: ClientRegistry = None
+    ):
+        self.clients = clients or client_registry
+        self.scheduler = scheduler or RateLimitScheduler(clients=self.clients)
+
+    def run(self, job: models.WebhookJob):
+        repository = job.repository
+        token = self.clients.token_for(repository)
+        if not token:
+            raise Exception("No active token found")
+        try:
+            client = self.scheduler.client_for(token)
+            sync_service = RepositorySyncService(
+                repository=client.get_repo(repository.full_name),
+                repo_obj=repository,
+                authors=author_resolver,
+                token=token,
+                scheduler=self.scheduler,
+            )
+            # Raises LeaseBusy while another sync works on the repository
+            with RepositoryLease(repository):
+                return sync_service.ingest_push(job.payload)
+        except LeaseBusy:
+            raise
+        except Exception:
+            # The token may have been revoked, look it up again on retry
+            self.clients.forget_repository(repository)
+            raise
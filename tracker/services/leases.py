@@ -0,0 +1,138 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from tracker import models
+from tracker.services.db import write_lock
+
+
+class LeaseBusy(Exception):
+    """
+    Raised when the sync lease of a repository is held by another sync.
+    """
+
+    def __init__(self, repository: models.Repository, holder=None):
+        super().__init__(f"{repository} is being synced by {holder or 'another sync'}")
+        self.repository = repository
+        self.holder = holder
+
+
+class RepositoryLease:
+    """
+    Exclusive lease on the commit sync of a repository, kept in the
+    SyncLease table so it works across processes and hosts on SQLite and
+    server databases alike. It is taken with a conditional UPDATE that only
+    matches a free or expired lease, kept alive by a heartbeat thread while
+    held, and taken over by the next sync if its holder died.
+    """
+
+    def __init__(
+        self, repository: models.Repository, ttl=None, wait=0, poll_interval=1
+    ):
+        self.repository = repository
+        self.ttl = ttl or getattr(settings, "SYNC_LEASE_TTL", 600)
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self.holder = (
+            f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        )
+        self.token = None
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def try_acquire(self):
+        now = timezone.now()
+        token = uuid.uuid4().hex
+        with write_lock():
+            models.SyncLease.objects.bulk_create(
+                [models.SyncLease(repository=self.repository)], ignore_conflicts=True
+            )
+            leases = models.SyncLease.objects.filter(repository=self.repository)
+            acquired = leases.filter(
+                Q(token__isnull=True) | Q(expires_at__lte=now)
+            ).update(
+                token=token,
+                holder=self.holder,
+                acquired_at=now,
+                expires_at=now + timedelta(seconds=self.ttl),
+                acquisitions=F("acquisitions") + 1,
+            )
+            if not acquired:
+                leases.update(
+                    contentions=F("contentions") + 1, last_contended_at=now
+                )
+                return False
+        self.token = token
+        return True
+
+    def acquire(self):
+        """
+        Take the lease, waiting up to `wait` seconds for the holder to
+        release it. Raises LeaseBusy when it stays held.
+        """
+        deadline = time.monotonic() + self.wait
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                holder = (
+                    models.SyncLease.objects.filter(repository=self.repository)
+                    .values_list("holder", flat=True)
+                    .first()
+                )
+                raise LeaseBusy(self.repository, holder)
+            time.sleep(self.poll_interval)
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(
+            target=self.renew_until_released,
+            name=f"lease-{self.repository.pk}",
+            daemon=True,
+        )
+        self.heartbeat.start()
+
+    def renew(self):
+        with write_lock():
+            return models.SyncLease.objects.filter(
+                repository=self.repository, token=self.token
+            ).update(expires_at=timezone.now() + timedelta(seconds=self.ttl))
+
+    def renew_until_released(self):
+        try:
+            while not self.stopped.wait(self.ttl / 3):
+                self.renew()
+        finally:
+            connections.close_all()
+
+    def release(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        with write_lock():
+            models.SyncLease.objects.filter(
+                repository=self.repository, token=self.token
+            ).update(token=None, holder=None, expires_at=None)
+        self.token = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @staticmethod
+    def contention():
+        """
+        How often leases were taken and how often a sync found one held.
+        """
+        totals = models.SyncLease.objects.aggregate(
+            acquisitions=Sum("acquisitions"), contentions=Sum("contentions")
+        )
+        return {key: value or 0 for key, value in totals.items()}
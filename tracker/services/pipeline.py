@@ -0,0 +1,66 @@
+import queue
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+
+class PagePipeline:
+    """
+    Runs a page producer, such as the commit pager, on its own thread and
+    hands its pages to the consuming thread through a bounded queue.
+    The producer fetches the next pages while the consumer writes the
+    previous ones, and stalls once `depth` pages wait, so memory stays
+    bounded by the queue however long the history is.
+    """
+
+    DONE = object()
+
+    def __init__(self, pages, depth=None, name="page-producer"):
+        self.pages = pages
+        self.depth = depth or getattr(settings, "SYNC_PIPELINE_DEPTH", 4)
+        self.name = name
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def put(self, item):
+        """
+        Queue an item, giving up once the consumer has stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(self):
+        try:
+            for page in self.pages:
+                if not self.put(page):
+                    break
+        except BaseException as e:
+            # Raised again on the consumer's thread
+            self.error = e
+        finally:
+            if hasattr(self.pages, "close"):
+                self.pages.close()
+            self.put(self.DONE)
+            connections.close_all()
+
+    def __iter__(self):
+        thread = threading.Thread(target=self.produce, name=self.name, daemon=True)
+        thread.start()
+        try:
+            while True:
+                page = self.queue.get()
+                if page is self.DONE:
+                    break
+                yield page
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.stopped.set()
+            thread.join()
@@ -0,0 +1,79 @@
+from tracker import models
+from tracker.services.sharding import Shard
+
+
+class SyncPlan:
+    """
+    One sync_repo cycle over every active token.
+    Tokens list their repositories first, then each repository is synced
+    once, by the token that can see it with the most quota left, however
+    many tokens see it. Memberships of the users are written in bulk at
+    the end of the cycle.
+    """
+
+    def __init__(self, shard: Shard = None):
+        self.shard = shard
+        # token -> repositories it listed, tokens whose listing failed are
+        # left out so their users keep their memberships
+        self.listings = {}
+
+    def add_listing(self, token: models.GitToken, repos):
+        self.listings[token] = list(repos)
+
+    def visibility(self):
+        """
+        Map of GitHub repository id to {token: repository as listed by it}.
+        """
+        visible = {}
+        for token, repos in self.listings.items():
+            for repo in repos:
+                if self.shard is None or self.shard.contains(repo.id):
+                    visible.setdefault(repo.id, {})[token] = repo
+        return visible
+
+    def assign(self, remaining):
+        """
+        Pick the token for every repository from the quota `remaining` per
+        token. Every repository given to a token costs it at least one
+        request, so repositories seen by equally rich tokens are spread
+        over them instead of piling onto one.
+        """
+        budget = {token: remaining.get(token) or 0 for token in self.listings}
+        assignments = []
+        for repos in self.visibility().values():
+            token = max(repos, key=lambda token: budget[token])
+            budget[token] -= 1
+            assignments.append((token, repos[token]))
+        return assignments
+
+    def update_memberships(self, stored):
+        """
+        Make the users of the listed tokens members of exactly the
+        repositories they can see, given {GitHub id: stored Repository}.
+        Inside a shard, memberships of other shards are left alone.
+        """
+        Membership = models.Repository.users.through
+        wanted = set()
+        for token, repos in self.listings.items():
+            for repo in repos:
+                if repo.id in stored:
+                    wanted.add((token.user_id, stored[repo.id].pk))
+        users = {token.user_id for token in self.listings}
+        existing = Membership.objects.filter(user__in=users).values_list(
+            "pk", "user_id", "repository_id", "repository__git_id"
+        )
+        current = set()
+        stale = []
+        for pk, user_id, repository_id, git_id in existing:
+            if (user_id, repository_id) in wanted:
+                current.add((user_id, repository_id))
+            elif self.shard is None or self.shard.contains(git_id):
+                stale.append(pk)
+        Membership.objects.filter(pk__in=stale).delete()
+        Membership.objects.bulk_create(
+            [
+                Membership(user_id=user_id, repository_id=repository_id)
+                for user_id, repository_id in wanted - current
+            ],
+            ignore_conflicts=True,
+        )
@@ -0,0 +1,191 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from github import Github
+
+from tracker import models
+from tracker.services.clients import ClientRegistry, client_registry
+
+
+class QuotaExhausted(Exception):
+    """
+    Raised when a token is down to its reserved quota and work should move
+    to another token.
+    """
+
+    def __init__(self, token: models.GitToken):
+        super().__init__(f"Rate limit quota exhausted for token {token}")
+        self.token = token
+
+
+class TokenBucket:
+    """
+    A token bucket that paces requests.
+    take() reserves a slot and sleeps until it is available, so concurrent
+    callers queue behind each other instead of bursting past the rate.
+    A rate of None leaves requests unpaced and keeps the bucket full.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        if self.rate is None:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+        self.updated_at = now
+
+    def take(self):
+        with self.lock:
+            self.refill()
+            if self.rate is None:
+                return
+            wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        if wait:
+            self.sleep(wait)
+
+
+class TokenQuota:
+    """
+    Remaining GitHub quota of a single token, read from the X-RateLimit-*
+    headers PyGithub records on the client after every request.
+    Requests go out unpaced until the quota drops to pace_below.
+    """
+
+    def __init__(
+        self, token: models.GitToken, client: Github, burst, pace_below, clock
+    ):
+        self.token = token
+        self.client = client
+        self.clock = clock
+        self.pace_below = pace_below
+        self.remaining = None
+        self.limit = None
+        self.reset_at = 0
+        self.bucket = TokenBucket(rate=None, capacity=burst)
+
+    def update(self):
+        self.remaining, self.limit = self.client.rate_limiting
+        self.reset_at = self.client.rate_limiting_resettime
+        if self.remaining > self.pace_below:
+            self.bucket.rate = None
+            return
+        # Spread what is left of the quota over the time until it resets
+        seconds_left = max(self.reset_at - self.clock(), 1)
+        self.bucket.rate = max(self.remaining, 1) / seconds_left
+
+    def refresh(self):
+        # /rate_limit does not count against the quota, and its response
+        # headers bring the client's recorded quota up to date
+        self.client.get_rate_limit()
+        self.update()
+
+    def is_exhausted(self, reserve):
+        return self.remaining is not None and self.remaining <= reserve
+
+
+class RateLimitScheduler:
+    """
+    Hands out GitHub clients for tokens and paces their requests.
+    When a token runs dry the work moves to another active token that can
+    see the same repository, or waits until the earliest quota reset.
+    """
+
+    def __init__(
+        self,
+        reserve=None,
+        burst=None,
+        pace_below=None,
+        clock=time.time,
+        sleep=time.sleep,
+        clients: ClientRegistry = None,
+    ):
+        self.reserve = (
+            reserve
+            if reserve is not None
+            else getattr(settings, "SYNC_RATE_LIMIT_RESERVE", 50)
+        )
+        self.burst = burst or getattr(settings, "SYNC_RATE_LIMIT_BURST", 100)
+        self.pace_below = (
+            pace_below
+            if pace_below is not None
+            else getattr(settings, "SYNC_RATE_LIMIT_PACE_BELOW", 1000)
+        )
+        self.clock = clock
+        self.sleep = sleep
+        self.clients = clients or client_registry
+        self.lock = threading.Lock()
+        self.quotas = {}
+
+    def quota(self, token: models.GitToken) -> TokenQuota:
+        client = self.clients.client_for(token)
+        with self.lock:
+            quota = self.quotas.get(token.pk)
+            # Start over when the registry replaced the token's client
+            if quota is None or quota.client is not client:
+                quota = self.quotas[token.pk] = TokenQuota(
+                    token, client, self.burst, self.pace_below, self.clock
+                )
+            return quota
+
+    def client_for(self, token: models.GitToken) -> Github:
+        return self.quota(token).client
+
+    def acquire(self, token: models.GitToken):
+        """
+        Wait for the token's bucket before sending a request.
+        Raises QuotaExhausted once only the reserve is left.
+        """
+        quota = self.quota(token)
+        if quota.is_exhausted(self.reserve):
+            raise QuotaExhausted(token)
+        quota.bucket.take()
+
+    def record(self, token: models.GitToken):
+        """
+        Refresh the token's quota after a request was sent.
+        """
+        self.quota(token).update()
+
+    def candidates(self, token: models.GitToken, repo_obj: models.Repository):
+        """
+        Active tokens whose owner can see the repository.
+        """
+        return list(
+            models.GitToken.objects.filter(
+                Q(user__repositories=repo_obj) | Q(pk=token.pk), is_active=True
+            ).distinct()
+        )
+
+    def failover(self, token: models.GitToken, repo_obj: models.Repository):
+        """
+        Pick the token with the most quota left for the repository, sleeping
+        until the earliest reset when every candidate is dry.
+        """
+        quotas = [
+            self.quota(candidate) for candidate in self.candidates(token, repo_obj)
+        ]
+        if not quotas:
+            raise QuotaExhausted(token)
+        for quota in quotas:
+            quota.refresh()
+        usable = [quota for quota in quotas if not quota.is_exhausted(self.reserve)]
+        if usable:
+            return max(usable, key=lambda quota: quota.remaining).token
+        soonest = min(quotas, key=lambda quota: quota.reset_at)
+        self.sleep(max(soonest.reset_at - self.clock(), 0) + 1)
+        soonest.refresh()
+        return soonest.token
@@ -1,51 +1,187 @@
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
 from django.utils import timezone
-from github import Hook, Repository
+from github import (
+    GithubException,
+    Hook,
+    RateLimitExceededException,
+    Repository,
+    UnknownObjectException,
+)
 
 from tracker import models
+from tracker.services.authors import AuthorResolver, author_resolver
+from tracker.services.db import write_lock
+from tracker.services.pipeline import PagePipeline
+from tracker.services.ratelimit import QuotaExhausted, RateLimitScheduler
+from tracker.services.rollups import ROLLUP_FIELDS, RollupDelta
 
+# The before or after sha of a push that creates or deletes a branch
+NULL_SHA = "0" * 40
 
-class RepositorySyncService:
+
+class SyncResult:
     """
-    A service class to sync repositories and commits
+    Counters of a commit sync. Commits are streamed to the database, so
+    this is all a caller gets back.
     """
 
-    repository: Repository
-    repo_obj: models.Repository
+    def __init__(self, commits=0, files=0):
+        self.commits = commits
+        self.files = files
+
+    @classmethod
+    def from_writer(cls, writer: "CommitWriter"):
+        return cls(commits=writer.commits_written, files=writer.files_written)
+
+    def __str__(self) -> str:
+        return f"{self.commits} commits, {self.files} files"
+
+
+class CommitWriter:
+    """
+    Collects commits with their files and upserts them in batches.
+    Each batch is written with bulk_create(update_conflicts=True) inside a
+    single transaction, so a page of commits costs a handful of queries
+    instead of a SELECT and INSERT/UPDATE per commit and per file.
+    """
+
+    COMMIT_UPDATE_FIELDS = [
+        "message",
+        "date",
+        "commited_at",
+        "author",
+        "committer",
+        "url",
+        "additions",
+        "deletions",
+        "total",
+        "is_enriched",
+    ]
+    # A metadata-only pass must not reset the stats of enriched commits
+    METADATA_UPDATE_FIELDS = [
+        "message",
+        "date",
+        "commited_at",
+        "author",
+        "committer",
+        "url",
+    ]
+    FILE_UPDATE_FIELDS = [
+        "status",
+        "additions",
+        "deletions",
+        "changes",
+        "inline_patch",
+        "patch_blob",
+    ]
+
+    def __init__(
+        self,
+        repo_obj: models.Repository,
+        batch_size=None,
+        update_fields=None,
+        checkpoint: models.SyncCheckpoint = None,
+    ):
+        self.repo_obj = repo_obj
+        self.batch_size = batch_size or getattr(settings, "SYNC_BATCH_SIZE", 500)
+        self.update_fields = update_fields or self.COMMIT_UPDATE_FIELDS
+        # Advanced to the last commit of every batch, in the same transaction
+        self.checkpoint = checkpoint
+        # sha -> (Commit, [CommitFile]) waiting to be written
+        self.pending = {}
+        self.commits_written = 0
+        self.files_written = 0
+
+    def conflict_options(self, unique_fields, update_fields):
+        # MySQL upserts on any unique key and rejects an explicit target
+        options = {"update_conflicts": True, "update_fields": update_fields}
+        if connection.features.supports_update_conflicts_with_target:
+            options["unique_fields"] = unique_fields
+        return options
 
-    def insert_or_update_author(self, author, owners={}):
+    def add(self, commit: models.Commit, files):
         """
-        A method to insert or update an author in the database
+        Queue a commit and its files, writing the batch once it is full.
         """
-        if author.id not in owners:
-            owner, _ = models.Author.objects.get_or_create(
-                git_id=author.id,
-                defaults={
-                    "username": author.login,
-                    "avatar_url": author.avatar_url,
-                    "html_url": author.html_url,
-                },
+        self.pending[commit.sha] = (commit, files)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every queued commit and file in one transaction.
+        """
+        if not self.pending:
+            return
+        batch = list(self.pending.values())
+        self.pending = {}
+        stored = models.Commit.objects.filter(
+            repository=self.repo_obj, sha__in=[commit.sha for commit, _ in batch]
+        ).order_by()
+        rollups = RollupDelta(self.repo_obj)
+        with write_lock(), transaction.atomic():
+            # Rewritten commits leave the rollups with their old values
+            for values in stored.values_list(*ROLLUP_FIELDS):
+                rollups.remove(*values)
+            models.Commit.objects.bulk_create(
+                [commit for commit, _ in batch],
+                **self.conflict_options(["repository", "sha"], self.update_fields),
             )
-            owners[author.id] = owner
-        else:
-            owner = owners[author.id]
-        return owner
+            # Not every backend returns primary keys for upserted rows,
+            # so read them back with a single query
+            ids = {}
+            for sha, pk, *values in stored.values_list("sha", "id", *ROLLUP_FIELDS):
+                ids[sha] = pk
+                rollups.add(*values)
+            rollups.apply()
+            files = {}
+            for commit, commit_files in batch:
+                commit.pk = ids[commit.sha]
+                for file in commit_files:
+                    file.commit = commit
+                    files[(commit.pk, file.filename)] = file
+            if files:
+                # Patches go to the content addressed blob table first
+                models.CommitFile.store_patches(files.values())
+                models.CommitFile.objects.bulk_create(
+                    list(files.values()),
+                    **self.conflict_options(
+                        ["commit", "filename"], self.FILE_UPDATE_FIELDS
+                    ),
+                )
+            if self.checkpoint is not None:
+                self.checkpoint.advance(batch[-1][0].sha)
+        self.commits_written += len(batch)
+        self.files_written += len(files)
+
+
+class RepositorySyncService:
+    """
+    A service class to sync repositories and commits
+    """
+
+    repository: Repository
+    repo_obj: models.Repository
 
-    def insert_or_update_repository(self, token: models.GitToken, repo, owners={}):
+    def insert_or_update_repository(self, token: models.GitToken, repo):
         """
         Insert or update a repository in the database.
         """
-        owner = self.insert_or_update_author(repo.owner, owners)
+        owner = self.authors.resolve(repo.owner)
         source, _ = (
-            self.insert_or_update_repository(token, repo.source, owners)
+            self.insert_or_update_repository(token, repo.source)
             if repo.source
             else (None, None)
         )
         parent, _ = (
-            self.insert_or_update_repository(token, repo.parent, owners)
+            self.insert_or_update_repository(token, repo.parent)
             if repo.parent
             else (None, None)
         )
@@ -87,66 +223,435 @@ class RepositorySyncService:
 
         return obj, created
 
-    def fetch_commits(self, owners={}):
+    def get_commit_listing(self, full=False, sha=None):
         """
-        Fetch and print commits for a given repository.
+        Return the commit listing to walk, newest first.
+        A full sync walks the whole history, an incremental sync compares
+        the high-water mark of the last complete sync with the head, which
+        lists every commit the head reaches and the mark does not, including
+        those merged in from branches with older dates. The compare lists
+        them oldest first and cannot be walked backwards, so the listing of
+        every new commit is read before the walk starts. Only the commits
+        still to be walked are held, those yielded are let go with their
+        details, but a catch-up over a very long range still holds its
+        whole listing; sync_repo --full streams instead.
+        When sha is given the listing starts at that commit. If the mark
+        is gone, after a force push, the whole history is walked.
         """
+        kwargs = {"sha": sha} if sha else {}
+        mark = self.repo_obj.last_commit_sha
+        if full or not mark:
+            return self.repository.get_commits(**kwargs)
         try:
-            git_commits = self.repository.get_commits()
-            _commits = []
-            for _commit in git_commits:
-                # Create or update author and committer
-                author = (
-                    self.insert_or_update_author(_commit.author, self.owners)
-                    if _commit.author
-                    else None
-                )
-                committer = (
-                    self.insert_or_update_author(_commit.committer, owners)
-                    if _commit.committer
-                    else None
-                )
-                # Create or update commit
-                #  if a commit with the same sha exists, update it
-                commit, _ = models.Commit.objects.update_or_create(
-                    repository=self.repo_obj,
-                    sha=_commit.sha,
-                    defaults={
-                        "message": _commit.commit.message,
-                        "date": _commit.commit.author.date,
-                        "commited_at": _commit.commit.committer.date,
-                        "author": author,
-                        "committer": committer,
-                        "url": _commit.html_url,
-                        "additions": _commit.stats.additions,
-                        "deletions": _commit.stats.deletions,
-                        "total": _commit.stats.total,
-                    },
-                )
-                # Create file entries for the commit
-                for file in _commit.files:
-                    models.CommitFile.objects.update_or_create(
-                        commit=commit,
-                        filename=file.filename,
-                        defaults={
-                            "status": file.status,
-                            "additions": file.additions,
-                            "deletions": file.deletions,
-                            "changes": file.changes,
-                            "patch": file.patch,
-                        },
-                    )
-                _commits.append(commit)
-            return _commits
+            comparison = self.repository.compare(
+                mark, sha or self.repo_obj.default_branch
+            )
+        except UnknownObjectException:
+            return self.repository.get_commits(**kwargs)
+        commits = list(comparison.commits)
+
+        def newest_first():
+            while commits:
+                yield commits.pop()
+
+        return newest_first()
+
+    def switch_token(self):
+        """
+        Move the sync to the token the scheduler picks for this repository.
+        """
+        self.token = self.scheduler.failover(self.token, self.repo_obj)
+        client = self.scheduler.client_for(self.token)
+        self.repository = client.get_repo(self.repo_obj.full_name)
+
+    def load_commit_detail(self, _commit):
+        """
+        Load the lazy stats and files of a listed commit, one request each.
+        """
+        if self.scheduler:
+            self.scheduler.acquire(self.token)
+        _commit.stats
+        if self.scheduler:
+            self.scheduler.record(self.token)
+
+    def iter_pages(self, listing, stop_sha=None, skip_sha=None):
+        """
+        Group the listing into pages of detail_batch commits, ending at the
+        high-water mark so no detail is fetched for a stored commit.
+        A resumed listing starts again at the head and skips the commits up
+        to and including skip_sha, the commits after it in the listing are
+        not all its ancestors once branches were merged.
+        """
+        page = []
+        skipping = skip_sha is not None
+        for _commit in listing:
+            if _commit.sha == stop_sha:
+                break
+            if skipping:
+                skipping = _commit.sha != skip_sha
+                continue
+            page.append(_commit)
+            if len(page) >= self.detail_batch:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def iter_commit_pages(
+        self, full=False, metadata_only=False, head_sha=None, cursor_sha=None
+    ):
+        """
+        Walk the commit listing and yield pages of commits with their
+        details loaded, or as listed when metadata_only is set.
+        The detail of every commit is its own request, so each page of
+        commits has its details fetched concurrently. Requests are paced
+        through the rate limit scheduler when one is set, and if the token
+        runs out of quota the walk resumes on another token from the last
+        page it yielded. An earlier walk is continued by listing from its
+        head_sha again and skipping the commits up to its cursor_sha.
+        """
+        stop_sha = None if full else self.repo_obj.last_commit_sha
+        listing = self.get_commit_listing(full=full, sha=head_sha)
+        last_sha = cursor_sha
+        with ThreadPoolExecutor(
+            max_workers=self.detail_workers, thread_name_prefix="commit-detail"
+        ) as executor:
+            while True:
+                try:
+                    for page in self.iter_pages(listing, stop_sha, last_sha):
+                        # Load the details here so a quota error is raised
+                        # inside this loop rather than in the caller
+                        if not metadata_only:
+                            list(executor.map(self.load_commit_detail, page))
+                        # Pin the head, the walk goes on from it after a
+                        # token switch even if the branch moves meanwhile
+                        head_sha = head_sha or page[0].sha
+                        yield page
+                        last_sha = page[-1].sha
+                    return
+                except (QuotaExhausted, RateLimitExceededException):
+                    if not self.scheduler:
+                        raise
+                    self.switch_token()
+                    listing = self.get_commit_listing(full=full, sha=head_sha)
+
+    def start_checkpoint(self, full=False, metadata_only=False, resume=False):
+        """
+        Return the checkpoint of this sync run. With resume an interrupted
+        run is continued with its own options, otherwise a new run starts.
+        """
+        with write_lock():
+            checkpoint = models.SyncCheckpoint.objects.filter(
+                repository=self.repo_obj
+            ).first()
+            if resume and checkpoint is not None and checkpoint.is_resumable:
+                return checkpoint
+            checkpoint, _ = models.SyncCheckpoint.objects.update_or_create(
+                repository=self.repo_obj,
+                defaults={
+                    "phase": models.SyncCheckpoint.PHASE_COMMITS,
+                    "full": full,
+                    "metadata_only": metadata_only,
+                    "head_sha": None,
+                    "head_at": None,
+                    "cursor_sha": None,
+                },
+            )
+        return checkpoint
+
+    def complete_checkpoint(self, checkpoint: models.SyncCheckpoint):
+        """
+        Record the newest commit of a sync that walked to completion as the
+        high-water mark and close its checkpoint.
+        """
+        with write_lock(), transaction.atomic():
+            if checkpoint.head_sha:
+                self.set_high_water_mark(checkpoint.head_sha, checkpoint.head_at)
+            checkpoint.complete()
+
+    def set_high_water_mark(self, sha, committed_at):
+        self.repo_obj.last_commit_sha = sha
+        self.repo_obj.last_commit_at = committed_at
+        with write_lock():
+            self.repo_obj.save(update_fields=["last_commit_sha", "last_commit_at"])
+
+    def resolve_authors(self, page):
+        """
+        Resolve the authors and committers of a page of commits at once.
+        """
+        return self.authors.resolve_many(
+            user for _commit in page for user in (_commit.author, _commit.committer)
+        )
+
+    def build_commit(self, _commit, authors, metadata_only=False):
+        """
+        Build an unsaved Commit from a GitHub commit, with its author and
+        committer looked up in the resolved authors.
+        """
+        author = authors.get(_commit.author.id) if _commit.author else None
+        committer = authors.get(_commit.committer.id) if _commit.committer else None
+        commit = models.Commit(
+            repository=self.repo_obj,
+            sha=_commit.sha,
+            message=_commit.commit.message,
+            date=_commit.commit.author.date,
+            commited_at=_commit.commit.committer.date,
+            author=author,
+            committer=committer,
+            url=_commit.html_url,
+            is_enriched=not metadata_only,
+        )
+        if not metadata_only:
+            self.set_stats(commit, _commit)
+        return commit
+
+    def set_stats(self, commit: models.Commit, _commit):
+        commit.additions = _commit.stats.additions
+        commit.deletions = _commit.stats.deletions
+        commit.total = _commit.stats.total
+        commit.is_enriched = True
+
+    def build_files(self, _commit):
+        """
+        Build unsaved CommitFile rows for the files of a GitHub commit.
+        """
+        return [
+            models.CommitFile(
+                filename=file.filename,
+                status=file.status,
+                additions=file.additions,
+                deletions=file.deletions,
+                changes=file.changes,
+                patch=file.patch,
+            )
+            for file in _commit.files
+        ]
+
+    def fetch_commits(self, full=False, metadata_only=False, resume=False):
+        """
+        Fetch the commits of the repository and return a SyncResult.
+        The pager runs ahead on its own thread and feeds pages through a
+        bounded queue to this thread, which writes them in batches, so only
+        a few pages and one batch are held in memory at any time.
+        Unless full is set, paging stops at the last known commit sha.
+        With metadata_only only the listing is stored, without stats and
+        files, and the commits are left for enrich_commits.
+        With resume an interrupted sync continues from its checkpoint.
+        """
+        try:
+            checkpoint = self.start_checkpoint(full, metadata_only, resume)
+            full, metadata_only = checkpoint.full, checkpoint.metadata_only
+            pages = PagePipeline(
+                self.iter_commit_pages(
+                    full=full,
+                    metadata_only=metadata_only,
+                    head_sha=checkpoint.head_sha,
+                    cursor_sha=checkpoint.cursor_sha,
+                ),
+                name="commit-pager",
+            )
+            writer = CommitWriter(
+                self.repo_obj,
+                batch_size=self.batch_size,
+                update_fields=(
+                    CommitWriter.METADATA_UPDATE_FIELDS if metadata_only else None
+                ),
+                checkpoint=checkpoint,
+            )
+            for page in pages:
+                if checkpoint.head_sha is None:
+                    checkpoint.head_sha = page[0].sha
+                    checkpoint.head_at = page[0].commit.committer.date
+                authors = self.resolve_authors(page)
+                for _commit in page:
+                    # Queue the commit and its files, the writer upserts
+                    # them in batches instead of one query pair per row
+                    commit = self.build_commit(_commit, authors, metadata_only)
+                    files = [] if metadata_only else self.build_files(_commit)
+                    writer.add(commit, files)
+            writer.flush()
+            # Only move the mark once the walk finished, an interrupted sync
+            # must not hide the commits it never reached
+            self.complete_checkpoint(checkpoint)
+            return SyncResult.from_writer(writer)
         except Exception as e:
             raise CommandError(
                 f"Failed to fetch commits for repository {self.repo_obj.name}: {e}"
             )
 
-    def __init__(self, repository: Repository, repo_obj: models.Repository, owners={}):
+    def ingest_push(self, payload):
+        """
+        Store the commits of a push webhook payload and return a SyncResult.
+        The pushed range before...after is read with one compare call, which
+        lists the new commits with their authors, so a push costs requests
+        in proportion to its new commits instead of the history. The stats
+        and files of a single-commit push come with the compare, those of
+        larger pushes are fetched per commit.
+        A forced push also drops the stored commits its new head no longer
+        reaches. When the stored history does not end at `before`, pushes
+        were missed and an incremental sync runs instead.
+        """
+        before, after = payload["before"], payload["after"]
+        if payload.get("deleted") or after == NULL_SHA:
+            return SyncResult()
+        if before == NULL_SHA or self.repo_obj.last_commit_sha != before:
+            return self.fetch_commits()
+        try:
+            if payload.get("forced"):
+                # The commits of the old head that the new one does not reach
+                # were rewritten away
+                rewritten = self.repository.compare(after, before).commits
+                self.drop_commits([_commit.sha for _commit in rewritten])
+            # For a forced push GitHub compares from the merge base of the
+            # old and new head, so only the commits of the new history are
+            # listed
+            comparison = self.repository.compare(before, after)
+            commits = list(comparison.commits)
+            authors = self.resolve_authors(commits)
+            built = [
+                self.build_commit(_commit, authors, metadata_only=True)
+                for _commit in commits
+            ]
+            if len(built) == 1:
+                writer = CommitWriter(self.repo_obj, batch_size=self.batch_size)
+                commit = built[0]
+                files = self.build_files(comparison)
+                commit.additions = sum(file.additions for file in files)
+                commit.deletions = sum(file.deletions for file in files)
+                commit.total = commit.additions + commit.deletions
+                commit.is_enriched = True
+                writer.add(commit, files)
+                writer.flush()
+                result = SyncResult.from_writer(writer)
+            else:
+                writer, failed = self.write_details(built)
+                # Stored without their stats, for enrich_commits to retry
+                missing = CommitWriter(
+                    self.repo_obj,
+                    batch_size=self.batch_size,
+                    update_fields=CommitWriter.METADATA_UPDATE_FIELDS,
+                )
+                for commit, _ in failed:
+                    missing.add(commit, [])
+                missing.flush()
+                result = SyncResult.from_writer(writer)
+                result.commits += missing.commits_written
+            # A forced push may also only drop commits, the merge base is
+            # then the new head
+            head = commits[-1] if commits else comparison.merge_base_commit
+            self.set_high_water_mark(after, head.commit.committer.date)
+            return result
+        except Exception as e:
+            raise CommandError(
+                f"Failed to ingest push for repository {self.repo_obj.name}: {e}"
+            )
+
+    def fetch_commit_detail(self, sha):
+        """
+        Fetch the detail of a single commit, moving to another token when
+        the current one runs out of quota.
+        """
+        while True:
+            try:
+                if self.scheduler:
+                    self.scheduler.acquire(self.token)
+                _commit = self.repository.get_commit(sha)
+                if self.scheduler:
+                    self.scheduler.record(self.token)
+                return _commit
+            except (QuotaExhausted, RateLimitExceededException):
+                if not self.scheduler:
+                    raise
+                with self.switch_lock:
+                    self.switch_token()
+
+    def drop_commits(self, shas):
+        """
+        Delete stored commits, taking them out of the rollups and counters,
+        and return how many were deleted.
+        """
+        with write_lock(), transaction.atomic():
+            stored = models.Commit.objects.filter(
+                repository=self.repo_obj, sha__in=shas
+            )
+            rollups = RollupDelta(self.repo_obj)
+            for values in stored.order_by().values_list(*ROLLUP_FIELDS):
+                rollups.remove(*values)
+            dropped = stored.count()
+            if not dropped:
+                return 0
+            stored.delete()
+            rollups.apply()
+            # The counters only ever widen the date range, narrow it again
+            dates = models.Commit.objects.filter(repository=self.repo_obj).aggregate(
+                first_commit_date=Min("date"), last_commit_date=Max("date")
+            )
+            models.Repository.objects.filter(pk=self.repo_obj.pk).update(**dates)
+        return dropped
+
+    def enrich_commits(self, commits):
+        """
+        Fill the stats and files of commits stored by a metadata-only pass.
+        Each batch is committed with its is_enriched flags, so an
+        interrupted run picks up where it stopped.
+        Returns the number of commits written and the [(commit, error)]
+        whose detail could not be fetched, which are left as they were.
+        """
+        writer, failed = self.write_details(commits)
+        return writer.commits_written, failed
+
+    def try_fetch_commit_detail(self, sha):
+        try:
+            return self.fetch_commit_detail(sha), None
+        except GithubException as e:
+            return None, e
+
+    def write_details(self, commits):
+        """
+        Fetch the stats and files of commits in parallel and write them.
+        A commit whose detail fails, e.g. a 404 after a force push, is left
+        out instead of failing the others.
+        Returns the flushed writer and the [(commit, error)] left out.
+        """
+        writer = CommitWriter(self.repo_obj, batch_size=self.batch_size)
+        failed = []
+        with ThreadPoolExecutor(
+            max_workers=self.detail_workers, thread_name_prefix="commit-detail"
+        ) as executor:
+            details = executor.map(
+                self.try_fetch_commit_detail, [commit.sha for commit in commits]
+            )
+            for commit, (_commit, error) in zip(commits, details):
+                if error is not None:
+                    failed.append((commit, error))
+                    continue
+                self.set_stats(commit, _commit)
+                writer.add(commit, self.build_files(_commit))
+        writer.flush()
+        return writer, failed
+
+    def __init__(
+        self,
+        repository: Repository,
+        repo_obj: models.Repository,
+        authors: AuthorResolver = None,
+        batch_size=None,
+        token: models.GitToken = None,
+        scheduler: RateLimitScheduler = None,
+        detail_workers=None,
+    ):
         self.repository = repository
         self.repo_obj = repo_obj
-        self.owners = owners
+        self.authors = authors or author_resolver
+        self.batch_size = batch_size
+        self.token = token
+        self.scheduler = scheduler
+        self.detail_workers = detail_workers or getattr(
+            settings, "SYNC_DETAIL_WORKERS", 8
+        )
+        # Commits whose details are fetched together
+        self.detail_batch = self.detail_workers * 4
+        self.switch_lock = threading.Lock()
 
 
 # self.repository = repository
@@ -0,0 +1,191 @@
+from django.db.models import Count, F, Max, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from tracker import models
+from tracker.services.stats_cache import stats_cache
+
+# Commit columns a rollup is computed from
+ROLLUP_FIELDS = ("author_id", "date", "commited_at", "additions", "deletions")
+# Repository columns maintained alongside the rollups
+COUNTER_FIELDS = (
+    "commit_count",
+    "contributor_count",
+    "total_additions",
+    "total_deletions",
+    "first_commit_date",
+    "last_commit_date",
+)
+
+
+class RollupDelta:
+    """
+    Changes to the daily rollups of one repository, collected while commits
+    are written and applied with a handful of queries, together with the
+    counters on the repository itself.
+    A rewritten commit is removed with its old values and added with its
+    new ones, so reruns and enrichment never count a commit twice.
+    """
+
+    def __init__(self, repository: models.Repository):
+        self.repository = repository
+        # (author_id, day) -> [commits, additions, deletions, hours]
+        self.changes = {}
+        # Range of the commit dates added, the stored range only widens
+        self.first_date = None
+        self.last_date = None
+
+    def add(self, author_id, date, commited_at, additions, deletions, sign=1):
+        key = (author_id, timezone.localtime(date).date())
+        change = self.changes.setdefault(key, [0, 0, 0, [0] * 24])
+        change[0] += sign
+        change[1] += sign * (additions or 0)
+        change[2] += sign * (deletions or 0)
+        change[3][timezone.localtime(commited_at).hour] += sign
+        if sign > 0:
+            self.first_date = min(filter(None, [self.first_date, date]))
+            self.last_date = max(filter(None, [self.last_date, date]))
+
+    def remove(self, *values):
+        self.add(*values, sign=-1)
+
+    def apply(self, counters=True):
+        """
+        Write the collected changes, in the caller's transaction. With
+        counters=False only the rollups are written, for callers that store
+        the repository's counters themselves.
+        """
+        changes = {
+            key: change
+            for key, change in self.changes.items()
+            if change[0] or change[1] or change[2] or any(change[3])
+        }
+        self.changes = {}
+        if not changes:
+            return
+        self.apply_rollups(changes)
+        if counters:
+            self.apply_counters(changes)
+        authors = {author_id for author_id, _ in changes if author_id is not None}
+        stats_cache.invalidate_on_commit(
+            "all",
+            f"repository:{self.repository.pk}",
+            *[f"author:{author_id}" for author_id in authors],
+        )
+
+    def apply_rollups(self, changes):
+        existing = {
+            (rollup.author_id, rollup.day): rollup
+            for rollup in models.CommitRollup.objects.filter(
+                repository=self.repository,
+                day__in={day for _, day in changes},
+            )
+        }
+        created, updated, emptied = [], [], []
+        for (author_id, day), (commits, additions, deletions, hours) in changes.items():
+            rollup = existing.get((author_id, day))
+            if rollup is None:
+                rollup = models.CommitRollup(
+                    repository=self.repository,
+                    author_id=author_id,
+                    day=day,
+                    hours=[0] * 24,
+                )
+                created.append(rollup)
+            elif rollup.commits + commits <= 0:
+                emptied.append(rollup.pk)
+                continue
+            else:
+                updated.append(rollup)
+            rollup.commits += commits
+            rollup.additions += additions
+            rollup.deletions += deletions
+            rollup.hours = [a + b for a, b in zip(rollup.hours, hours)]
+        models.CommitRollup.objects.filter(pk__in=emptied).delete()
+        models.CommitRollup.objects.bulk_create(created)
+        models.CommitRollup.objects.bulk_update(
+            updated, ["commits", "additions", "deletions", "hours"]
+        )
+
+    def apply_counters(self, changes):
+        """
+        Move the repository's counters by the changes in a single UPDATE.
+        """
+        counters = {
+            "commit_count": F("commit_count")
+            + sum(change[0] for change in changes.values()),
+            "total_additions": F("total_additions")
+            + sum(change[1] for change in changes.values()),
+            "total_deletions": F("total_deletions")
+            + sum(change[2] for change in changes.values()),
+            # Counted from the rollups, which already hold the changes
+            "contributor_count": Coalesce(
+                Subquery(
+                    models.CommitRollup.objects.filter(
+                        repository=OuterRef("pk"), author__isnull=False
+                    )
+                    .order_by()
+                    .values("repository")
+                    .annotate(count=Count("author", distinct=True))
+                    .values("count")
+                ),
+                0,
+            ),
+        }
+        if self.first_date is not None:
+            counters["first_commit_date"] = Least(
+                Coalesce("first_commit_date", self.first_date), self.first_date
+            )
+            counters["last_commit_date"] = Greatest(
+                Coalesce("last_commit_date", self.last_date), self.last_date
+            )
+        models.Repository.objects.filter(pk=self.repository.pk).update(**counters)
+
+
+def count_commits(repositories):
+    """
+    Recompute the counters of the repositories from their raw commits,
+    returning {repository pk: {counter: value}}.
+    """
+    counted = {
+        repository_pk: {
+            "commit_count": 0,
+            "contributor_count": 0,
+            "total_additions": 0,
+            "total_deletions": 0,
+            "first_commit_date": None,
+            "last_commit_date": None,
+        }
+        for repository_pk in repositories.values_list("pk", flat=True)
+    }
+    totals = (
+        models.Commit.objects.filter(repository__in=repositories)
+        .order_by()
+        .values("repository")
+        .annotate(
+            commit_count=Count("pk"),
+            contributor_count=Count("author", distinct=True),
+            total_additions=Coalesce(Sum("additions"), 0),
+            total_deletions=Coalesce(Sum("deletions"), 0),
+            first_commit_date=Min("date"),
+            last_commit_date=Max("date"),
+        )
+    )
+    for counters in totals:
+        counted[counters.pop("repository")] = counters
+    return counted
+
+
+def hour_histogram(hours):
+    """
+    Add up the hour-of-day counts of rollups, an iterable of their `hours`,
+    into [{"hour": hour, "commit_count": count}] for hours with commits.
+    """
+    totals = [0] * 24
+    for counts in hours:
+        totals = [a + b for a, b in zip(totals, counts)]
+    return [
+        {"hour": hour, "commit_count": count}
+        for hour, count in enumerate(totals)
+        if count
+    ]
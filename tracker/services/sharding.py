@@ -0,0 +1,42 @@
+import argparse
+import zlib
+
+
+class Shard:
+    """
+    One of `count` disjoint slices of the repositories, numbered from 1.
+    A repository belongs to the slice picked by a stable hash of its GitHub
+    id, so independent processes or hosts agree on the split without
+    talking to each other.
+    """
+
+    def __init__(self, index, count):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError(f"Invalid shard {index}/{count}")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parse "K/N", usable as an argparse type.
+        """
+        try:
+            index, count = (int(part) for part in value.split("/"))
+            return cls(index, count)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"Expected K/N with 1 <= K <= N, got {value!r}"
+            )
+
+    @staticmethod
+    def slot(git_id, count):
+        # crc32 rather than hash(), which is not stable across processes
+        # for every type
+        return zlib.crc32(str(git_id).encode()) % count + 1
+
+    def contains(self, git_id):
+        return self.slot(git_id, self.count) == self.index
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
@@ -0,0 +1,93 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+MISSING = object()
+
+
+class StatsCache:
+    """
+    Caches computed statistics per scope: "all", "author:<pk>" or
+    "repository:<pk>". Every scope has a version stored in the cache that
+    the commit writer replaces once new commits are committed, so entries
+    of older versions are never read again and simply expire.
+    A miss is computed by the request that takes the scope's lock first,
+    concurrent requests for it wait for that result instead of running
+    the same aggregates at the same time.
+    Works with any cache backend; the local-memory one is per process,
+    so syncs in other processes only show once the entries time out.
+    """
+
+    def __init__(
+        self, alias=None, timeout=None, lock_timeout=None, poll_interval=0.05
+    ):
+        self.alias = alias
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    @property
+    def cache(self):
+        alias = self.alias or getattr(settings, "STATS_CACHE_ALIAS", "default")
+        return caches[alias]
+
+    def get_timeout(self):
+        return self.timeout or getattr(settings, "STATS_CACHE_TIMEOUT", 300)
+
+    def get_lock_timeout(self):
+        return self.lock_timeout or getattr(
+            settings, "STATS_CACHE_LOCK_TIMEOUT", 30
+        )
+
+    def version(self, scope):
+        key = f"stats:version:{scope}"
+        self.cache.add(key, time.time_ns(), None)
+        return self.cache.get(key)
+
+    def invalidate(self, *scopes):
+        # A fresh value rather than an increment, so a version that was
+        # evicted from the cache can never come back and match old entries
+        self.cache.set_many(
+            {f"stats:version:{scope}": time.time_ns() for scope in scopes}, None
+        )
+
+    def invalidate_on_commit(self, *scopes):
+        """
+        Invalidate once the caller's transaction committed, so no request
+        caches the data of before the commit under the new version.
+        """
+        transaction.on_commit(lambda: self.invalidate(*scopes))
+
+    def get_or_compute(self, scope, name, compute):
+        """
+        Return the cached `name` statistics of the scope, computing and
+        storing them with compute() on a miss.
+        """
+        key = f"stats:{scope}:{self.version(scope)}:{name}"
+        value = self.cache.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        lock = f"{key}:lock"
+        if self.cache.add(lock, True, self.get_lock_timeout()):
+            try:
+                value = compute()
+                self.cache.set(key, value, self.get_timeout())
+                return value
+            finally:
+                self.cache.delete(lock)
+        # Another request is computing it, wait for its result
+        deadline = time.monotonic() + self.get_lock_timeout()
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            value = self.cache.get(key, MISSING)
+            if value is not MISSING:
+                return value
+            if self.cache.get(lock) is None:
+                break
+        return compute()
+
+
+# Shared by the stats views and the commit writer
+stats_cache = StatsCache()
@@ -1,12 +1,33 @@
+import argparse
 import json
-from unittest.mock import patch
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest.mock import MagicMock, patch
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
 from django.http import HttpResponse
-from django.test import TestCase
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
+from github import UnknownObjectException
+from github.Requester import HTTPSRequestsConnectionClass, Requester
+from requests.structures import CaseInsensitiveDict
 
 from tracker.models import (
     Anomaly,
@@ -14,11 +35,33 @@ from tracker.models import (
     Commit,
     CommitAnalysis,
     CommitFile,
+    CommitRollup,
     GitToken,
     Notification,
+    PatchBlob,
     Repository,
+    ResponseCacheEntry,
+    SyncCheckpoint,
+    SyncLease,
+    WebhookJob,
+)
+from tracker.services.authors import AuthorResolver, author_resolver
+from tracker.services.clients import ClientRegistry, client_registry
+from tracker.services.git_mirror import GitMirrorSyncService
+from tracker.services.http_cache import (
+    CachedHTTPSConnection,
+    build_client,
+    cache_stats,
+    prune_response_cache,
 )
-from tracker.services.repository import RepositorySyncService
+from tracker.services.jobs import JobQueue
+from tracker.services.leases import LeaseBusy, RepositoryLease
+from tracker.services.pipeline import PagePipeline
+from tracker.services.planner import SyncPlan
+from tracker.services.ratelimit import QuotaExhausted, RateLimitScheduler, TokenBucket
+from tracker.services.repository import CommitWriter, RepositorySyncService
+from tracker.services.sharding import Shard
+from tracker.services.stats_cache import StatsCache, stats_cache
 
 User = get_user_model()
 
@@ -608,3 +651,1723 @@ class DashboardViewTestCase(TestCase):
         response = self.client.get(reverse("tracker:dashboard"))
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "dashboard.html")
+
+
+def make_git_author(git_id, login):
+    return MagicMock(
+        id=git_id,
+        login=login,
+        avatar_url=f"http://example.com/{login}.png",
+        html_url=f"http://example.com/{login}",
+    )
+
+
+def make_git_commit(sha, when, author=None, files=()):
+    git_commit = MagicMock(sha=sha, author=author, committer=author)
+    git_commit.html_url = f"http://example.com/commit/{sha}"
+    git_commit.commit.message = f"commit {sha}"
+    git_commit.commit.author.date = when
+    git_commit.commit.committer.date = when
+    git_commit.stats.additions = 1
+    git_commit.stats.deletions = 1
+    git_commit.stats.total = 2
+    git_commit.files = list(files)
+    return git_commit
+
+
+class RepositorySyncServiceTestCase(TestCase):
+    def setUp(self):
+        # Authors cached by an earlier test were rolled back with it
+        self.addCleanup(author_resolver.clear)
+        self.author = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=67890,
+            name="testrepo",
+            full_name="testrepo/full",
+            owner=self.author,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+        self.git_author = make_git_author(12345, "testauthor")
+        self.now = timezone.now()
+
+    def sync(self, git_commits, full=False, metadata_only=False):
+        git_repository = MagicMock()
+        git_repository.get_commits.return_value = git_commits
+        service = RepositorySyncService(
+            repository=git_repository, repo_obj=self.repository
+        )
+        return git_repository, service.fetch_commits(
+            full=full, metadata_only=metadata_only
+        )
+
+    def test_first_sync_walks_history_and_sets_mark(self):
+        git_repository, result = self.sync(
+            [
+                make_git_commit("c2", self.now, self.git_author),
+                make_git_commit("c1", self.now - timedelta(days=1), self.git_author),
+            ]
+        )
+        git_repository.get_commits.assert_called_once_with()
+        self.assertEqual(result.commits, 2)
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "c2")
+
+    def test_incremental_sync_compares_mark_with_head(self):
+        self.repository.last_commit_sha = "c1"
+        self.repository.last_commit_at = self.now - timedelta(days=1)
+        self.repository.save()
+        git_repository = MagicMock()
+        # Oldest first, c0 was merged in from a branch with an older date
+        git_repository.compare.return_value.commits = [
+            make_git_commit("c0", self.now - timedelta(days=2), self.git_author),
+            make_git_commit("c3", self.now, self.git_author),
+        ]
+        service = RepositorySyncService(
+            repository=git_repository, repo_obj=self.repository
+        )
+        result = service.fetch_commits()
+        git_repository.compare.assert_called_once_with("c1", "main")
+        git_repository.get_commits.assert_not_called()
+        self.assertEqual(result.commits, 2)
+        self.assertEqual(
+            sorted(Commit.objects.values_list("sha", flat=True)), ["c0", "c3"]
+        )
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "c3")
+
+    def test_incremental_sync_without_mark_on_github_walks_history(self):
+        self.repository.last_commit_sha = "c1"
+        self.repository.last_commit_at = self.now - timedelta(days=1)
+        self.repository.save()
+        git_repository = MagicMock()
+        git_repository.compare.side_effect = UnknownObjectException(
+            404, {"message": "Not Found"}
+        )
+        git_repository.get_commits.return_value = [
+            make_git_commit("c3", self.now, self.git_author),
+            make_git_commit("c1", self.now - timedelta(days=1), self.git_author),
+        ]
+        service = RepositorySyncService(
+            repository=git_repository, repo_obj=self.repository
+        )
+        result = service.fetch_commits()
+        git_repository.get_commits.assert_called_once_with()
+        self.assertEqual(result.commits, 1)
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "c3")
+
+    def test_sync_resumes_on_new_token_when_quota_runs_out(self):
+        # The merge m has a on its first parent and the older b on its
+        # second, b follows a in the listing but is not its ancestor
+        listing = [
+            make_git_commit("m", self.now, self.git_author),
+            make_git_commit("a", self.now - timedelta(days=1), self.git_author),
+            make_git_commit("b", self.now - timedelta(days=2), self.git_author),
+        ]
+        scheduler = MagicMock()
+        scheduler.acquire.side_effect = [None, None, QuotaExhausted(None), None]
+        resumed = scheduler.client_for.return_value.get_repo.return_value
+        resumed.get_commits.return_value = listing
+        git_repository = MagicMock()
+        git_repository.get_commits.return_value = listing
+        service = RepositorySyncService(
+            repository=git_repository,
+            repo_obj=self.repository,
+            token="first",
+            scheduler=scheduler,
+            detail_workers=1,
+        )
+        # Fetch details one commit at a time so the quota runs out mid-walk
+        service.detail_batch = 1
+        result = service.fetch_commits()
+        self.assertEqual(result.commits, 3)
+        scheduler.failover.assert_called_once_with("first", self.repository)
+        resumed.get_commits.assert_called_once_with(sha="m")
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "m")
+
+    def test_metadata_only_sync_skips_details(self):
+        listed = make_git_commit("c1", self.now, self.git_author)
+        git_repository, _ = self.sync([listed], metadata_only=True)
+        commit = Commit.objects.get(sha="c1")
+        self.assertFalse(commit.is_enriched)
+        self.assertEqual(commit.total, 0)
+        self.assertFalse(commit.commitfile_set.exists())
+
+        detail = make_git_commit(
+            "c1",
+            self.now,
+            self.git_author,
+            files=[
+                MagicMock(
+                    filename="file.py",
+                    status="added",
+                    additions=1,
+                    deletions=0,
+                    changes=1,
+                    patch="+x",
+                )
+            ],
+        )
+        git_repository.get_commit.return_value = detail
+        service = RepositorySyncService(
+            repository=git_repository, repo_obj=self.repository
+        )
+        self.assertEqual(service.enrich_commits([commit]), (1, []))
+        commit.refresh_from_db()
+        self.assertTrue(commit.is_enriched)
+        self.assertEqual(commit.total, 2)
+        self.assertEqual(commit.commitfile_set.get().patch, "+x")
+
+    def test_enrichment_skips_commits_whose_detail_fails(self):
+        git_repository, _ = self.sync(
+            [
+                make_git_commit("gone", self.now, self.git_author),
+                make_git_commit("c1", self.now - timedelta(days=1), self.git_author),
+            ],
+            metadata_only=True,
+        )
+
+        def get_commit(sha):
+            if sha == "gone":
+                raise UnknownObjectException(404, {"message": "No commit found"})
+            return make_git_commit(sha, self.now, self.git_author)
+
+        git_repository.get_commit.side_effect = get_commit
+        service = RepositorySyncService(
+            repository=git_repository, repo_obj=self.repository
+        )
+        written, failed = service.enrich_commits(
+            list(Commit.objects.order_by("-commited_at"))
+        )
+        self.assertEqual(written, 1)
+        self.assertEqual([commit.sha for commit, _ in failed], ["gone"])
+        self.assertEqual(
+            list(Commit.objects.order_by("sha").values_list("sha", "is_enriched")),
+            [("c1", True), ("gone", False)],
+        )
+
+    def test_metadata_only_sync_keeps_existing_stats(self):
+        self.sync([make_git_commit("c1", self.now, self.git_author)], full=True)
+        self.sync(
+            [make_git_commit("c1", self.now, self.git_author)],
+            full=True,
+            metadata_only=True,
+        )
+        commit = Commit.objects.get(sha="c1")
+        self.assertTrue(commit.is_enriched)
+        self.assertEqual(commit.total, 2)
+
+    def test_full_sync_ignores_mark(self):
+        self.repository.last_commit_sha = "c1"
+        self.repository.last_commit_at = self.now - timedelta(days=1)
+        self.repository.save()
+        git_repository, result = self.sync(
+            [
+                make_git_commit("c1", self.now - timedelta(days=1), self.git_author),
+                make_git_commit("c0", self.now - timedelta(days=2), self.git_author),
+            ],
+            full=True,
+        )
+        git_repository.get_commits.assert_called_once_with()
+        self.assertEqual(result.commits, 2)
+
+    def test_interrupted_sync_resumes_from_checkpoint(self):
+        def interrupted_listing():
+            yield make_git_commit("c3", self.now, self.git_author)
+            yield make_git_commit("c2", self.now - timedelta(days=1), self.git_author)
+            raise RuntimeError("connection lost")
+
+        git_repository = MagicMock()
+        git_repository.get_commits.return_value = interrupted_listing()
+        service = RepositorySyncService(
+            repository=git_repository,
+            repo_obj=self.repository,
+            batch_size=1,
+        )
+        # Write every commit as soon as it is listed
+        service.detail_batch = 1
+        with self.assertRaises(CommandError):
+            service.fetch_commits()
+        checkpoint = SyncCheckpoint.objects.get(repository=self.repository)
+        self.assertEqual((checkpoint.head_sha, checkpoint.cursor_sha), ("c3", "c2"))
+        self.repository.refresh_from_db()
+        self.assertIsNone(self.repository.last_commit_sha)
+
+        git_repository.get_commits.return_value = [
+            make_git_commit("c3", self.now, self.git_author),
+            make_git_commit("c2", self.now - timedelta(days=1), self.git_author),
+            make_git_commit("c1", self.now - timedelta(days=2), self.git_author),
+        ]
+        result = service.fetch_commits(resume=True)
+        git_repository.get_commits.assert_called_with(sha="c3")
+        self.assertEqual(result.commits, 1)
+        self.assertEqual(Commit.objects.count(), 3)
+        checkpoint.refresh_from_db()
+        self.assertFalse(checkpoint.is_resumable)
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "c3")
+
+
+    def test_resumed_sync_keeps_commits_of_merged_branches(self):
+        # The merge m has a on its first parent and the older b on its
+        # second, b follows a in the listing but is not its ancestor
+        def interrupted_listing():
+            yield make_git_commit("m", self.now, self.git_author)
+            yield make_git_commit("a", self.now - timedelta(days=1), self.git_author)
+            raise RuntimeError("connection lost")
+
+        git_repository = MagicMock()
+        git_repository.get_commits.return_value = interrupted_listing()
+        service = RepositorySyncService(
+            repository=git_repository, repo_obj=self.repository, batch_size=1
+        )
+        service.detail_batch = 1
+        with self.assertRaises(CommandError):
+            service.fetch_commits()
+
+        git_repository.get_commits.return_value = [
+            make_git_commit("m", self.now, self.git_author),
+            make_git_commit("a", self.now - timedelta(days=1), self.git_author),
+            make_git_commit("b", self.now - timedelta(days=3), self.git_author),
+            make_git_commit("c0", self.now - timedelta(days=4), self.git_author),
+        ]
+        result = service.fetch_commits(resume=True)
+        git_repository.get_commits.assert_called_with(sha="m")
+        self.assertEqual(result.commits, 2)
+        self.assertEqual(
+            sorted(Commit.objects.values_list("sha", flat=True)),
+            ["a", "b", "c0", "m"],
+        )
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "m")
+
+class IngestPushTestCase(TestCase):
+    def setUp(self):
+        self.addCleanup(author_resolver.clear)
+        self.author = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=67890,
+            name="testrepo",
+            full_name="testrepo/full",
+            owner=self.author,
+            html_url="http://example.com/repo",
+            default_branch="main",
+            last_commit_sha="a" * 40,
+            last_commit_at=timezone.now() - timedelta(days=1),
+        )
+        self.git_author = make_git_author(12345, "testauthor")
+        self.git_repository = MagicMock()
+        self.service = RepositorySyncService(
+            repository=self.git_repository, repo_obj=self.repository
+        )
+
+    def payload(self, before, after, forced=False):
+        return {
+            "ref": "refs/heads/main",
+            "before": before,
+            "after": after,
+            "forced": forced,
+        }
+
+    def test_single_commit_push_is_stored_with_its_files(self):
+        comparison = self.git_repository.compare.return_value
+        comparison.commits = [make_git_commit("b" * 40, timezone.now(), self.git_author)]
+        comparison.files = [
+            MagicMock(
+                filename="file.py",
+                status="modified",
+                additions=3,
+                deletions=1,
+                changes=4,
+                patch="@@ -1 +1,3 @@",
+            )
+        ]
+        result = self.service.ingest_push(self.payload("a" * 40, "b" * 40))
+        self.git_repository.compare.assert_called_once_with("a" * 40, "b" * 40)
+        self.git_repository.get_commits.assert_not_called()
+        self.assertEqual(result.commits, 1)
+        commit = Commit.objects.get(sha="b" * 40)
+        self.assertTrue(commit.is_enriched)
+        self.assertEqual((commit.additions, commit.deletions, commit.total), (3, 1, 4))
+        self.assertEqual(commit.author, self.author)
+        self.assertEqual(commit.commitfile_set.get().patch, "@@ -1 +1,3 @@")
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "b" * 40)
+
+    def test_larger_pushes_fetch_the_details_of_new_commits(self):
+        comparison = self.git_repository.compare.return_value
+        comparison.commits = [
+            make_git_commit(sha * 40, timezone.now(), self.git_author) for sha in "cd"
+        ]
+        self.git_repository.get_commit.side_effect = lambda sha: make_git_commit(
+            sha, timezone.now(), self.git_author
+        )
+        result = self.service.ingest_push(self.payload("a" * 40, "d" * 40))
+        self.assertEqual(result.commits, 2)
+        self.assertEqual(self.git_repository.get_commit.call_count, 2)
+        self.assertEqual(
+            list(
+                Commit.objects.order_by("sha").values_list(
+                    "is_enriched", "additions", "deletions"
+                )
+            ),
+            [(True, 1, 1), (True, 1, 1)],
+        )
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, "d" * 40)
+        self.assertEqual(
+            (self.repository.commit_count, self.repository.total_additions), (2, 2)
+        )
+
+    def test_forced_push_drops_rewritten_commits(self):
+        old = timezone.now() - timedelta(days=1)
+        writer = CommitWriter(self.repository)
+        for sha in "ea":
+            writer.add(
+                Commit(
+                    repository=self.repository,
+                    sha=sha * 40,
+                    message=f"commit {sha}",
+                    date=old,
+                    commited_at=old,
+                    author=self.author,
+                    url="http://example.com/commit",
+                    additions=5,
+                    deletions=5,
+                ),
+                [],
+            )
+        writer.flush()
+        rewritten, comparison = MagicMock(), MagicMock()
+        rewritten.commits = [make_git_commit("a" * 40, old, self.git_author)]
+        comparison.commits = [make_git_commit("b" * 40, timezone.now(), self.git_author)]
+        comparison.files = []
+        self.git_repository.compare.side_effect = lambda base, head: (
+            rewritten if base == "b" * 40 else comparison
+        )
+        self.service.ingest_push(self.payload("a" * 40, "b" * 40, forced=True))
+        self.git_repository.compare.assert_any_call("b" * 40, "a" * 40)
+        self.assertEqual(
+            sorted(Commit.objects.values_list("sha", flat=True)), ["b" * 40, "e" * 40]
+        )
+        self.repository.refresh_from_db()
+        self.assertEqual(
+            (self.repository.commit_count, self.repository.total_additions), (2, 5)
+        )
+        self.assertEqual(
+            sum(CommitRollup.objects.values_list("commits", flat=True)), 2
+        )
+        self.assertEqual(self.repository.last_commit_sha, "b" * 40)
+
+    def test_missed_pushes_fall_back_to_incremental_sync(self):
+        self.git_repository.compare.return_value.commits = []
+        self.service.ingest_push(self.payload("e" * 40, "f" * 40))
+        # The sync compares the mark with the branch, not the pushed range
+        self.git_repository.compare.assert_called_once_with("a" * 40, "main")
+
+
+class WebhookJobTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password")
+        GitToken.objects.create(
+            user=self.user, label="token", token="sometoken", service="github"
+        )
+        self.author = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=67890,
+            name="testrepo",
+            full_name="testrepo/full",
+            owner=self.author,
+            html_url="http://example.com/repo",
+            default_branch="main",
+            webhook_id=1234,
+        )
+        self.repository.users.add(self.user)
+        self.queue = JobQueue(max_attempts=2, backoff=10, coalesce_window=0)
+        self.addCleanup(client_registry.clear)
+
+    def post_push(self, before, after, delivery_id):
+        return self.client.post(
+            reverse("tracker:webhook_listener"),
+            data=json.dumps(
+                {
+                    "ref": "refs/heads/main",
+                    "before": before,
+                    "after": after,
+                    "commits": [{"id": after}],
+                }
+            ),
+            content_type="application/json",
+            headers={
+                "X-GitHub-Event": "push",
+                "X-GitHub-Hook-ID": "1234",
+                "X-GitHub-Delivery": delivery_id,
+            },
+        )
+
+    @override_settings(WEBHOOK_COALESCE_WINDOW=0)
+    def test_webhook_queues_push_and_returns_202(self):
+        response = self.post_push("a", "b", "delivery-1")
+        self.assertEqual(response.status_code, 202)
+        job = WebhookJob.objects.get()
+        self.assertEqual(job.repository, self.repository)
+        self.assertEqual(job.deliveries.get().delivery_id, "delivery-1")
+        self.assertEqual(job.payload["after"], "b")
+        self.assertEqual(self.queue.depth()["due"], 1)
+
+    def test_redelivery_and_push_bursts_share_one_job(self):
+        self.post_push("a", "b", "delivery-1")
+        self.post_push("a", "b", "delivery-1")
+        self.post_push("b", "c", "delivery-2")
+        job = WebhookJob.objects.get()
+        # One sync covering both pushes, held back for the coalesce window
+        self.assertEqual((job.payload["before"], job.payload["after"]), ("a", "c"))
+        self.assertEqual([c["id"] for c in job.payload["commits"]], ["b", "c"])
+        self.assertFalse(job.payload["forced"])
+        self.assertEqual(self.queue.depth()["due"], 0)
+        self.assertEqual(
+            self.queue.savings(), {"duplicates": 1, "coalesced": 1, "saved": 2}
+        )
+
+    def test_claimed_jobs_are_not_coalesced(self):
+        first = self.queue.enqueue(
+            self.repository, "push", {"before": "a", "after": "b"}
+        )
+        self.queue.claim()
+        second = self.queue.enqueue(
+            self.repository, "push", {"before": "b", "after": "c"}
+        )
+        self.assertNotEqual(first, second)
+        # A push not continuing the queued one is merged as a forced push
+        third = self.queue.enqueue(
+            self.repository, "push", {"before": "x", "after": "d"}
+        )
+        self.assertEqual(third, second)
+        third.refresh_from_db()
+        self.assertEqual(third.payload["before"], "b")
+        self.assertTrue(third.payload["forced"])
+
+    def test_claim_retry_and_give_up(self):
+        job = self.queue.enqueue(self.repository, "push", {})
+        claimed = self.queue.claim()
+        self.assertEqual(claimed, job)
+        self.assertIsNone(self.queue.claim())
+        self.queue.fail(claimed, "boom")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (WebhookJob.STATUS_PENDING, 1))
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=5))
+        # Not due until the backoff passed
+        self.assertIsNone(self.queue.claim())
+        WebhookJob.objects.update(run_after=timezone.now())
+        self.queue.fail(self.queue.claim(), "boom")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), (WebhookJob.STATUS_FAILED, "boom"))
+
+    def test_jobs_of_dead_workers_are_claimed_again(self):
+        job = self.queue.enqueue(self.repository, "push", {})
+        first = self.queue.claim()
+        WebhookJob.objects.update(claimed_at=timezone.now() - timedelta(hours=1))
+        second = self.queue.claim()
+        self.assertEqual(second, job)
+        self.assertNotEqual(first.claim_token, second.claim_token)
+        # The first worker's late result is ignored
+        self.queue.complete(first)
+        job.refresh_from_db()
+        self.assertEqual(job.status, WebhookJob.STATUS_RUNNING)
+
+
+class ProcessJobsCommandTestCase(TransactionTestCase):
+    def setUp(self):
+        owner = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        queue = JobQueue(coalesce_window=0)
+        for i in range(6):
+            repository = Repository.objects.create(
+                git_id=67890 + i,
+                name=f"testrepo{i}",
+                full_name=f"testrepo/full{i}",
+                owner=owner,
+                html_url="http://example.com/repo",
+                default_branch="main",
+            )
+            queue.enqueue(repository, "push", {"before": "a", "after": str(i)})
+
+    @patch("tracker.services.jobs.PushJobRunner.run")
+    def test_workers_drain_the_queue(self, run):
+        run.side_effect = lambda job: time.sleep(0.01)
+        out = StringIO()
+        call_command("process_jobs", workers=3, once=True, stdout=out)
+        self.assertEqual(run.call_count, 6)
+        self.assertEqual(
+            WebhookJob.objects.filter(status=WebhookJob.STATUS_DONE).count(), 6
+        )
+        self.assertIn("Queue depth: 0 pending, 0 running, 6 done", out.getvalue())
+        self.assertIn("Syncs saved: 0", out.getvalue())
+
+    @patch("tracker.services.jobs.PushJobRunner.run")
+    def test_jobs_are_deferred_while_repository_is_busy(self, run):
+        run.side_effect = LeaseBusy(Repository.objects.first(), "sync_repo")
+        out = StringIO()
+        call_command("process_jobs", workers=2, once=True, stdout=out)
+        self.assertEqual(run.call_count, 6)
+        # Deferred jobs keep all their attempts and wait for the backoff
+        self.assertEqual(
+            WebhookJob.objects.filter(
+                status=WebhookJob.STATUS_PENDING,
+                attempts=0,
+                run_after__gt=timezone.now(),
+            ).count(),
+            6,
+        )
+        self.assertIn("deferred", out.getvalue())
+
+
+class AuthorResolverTestCase(TestCase):
+    def setUp(self):
+        self.known = Author.objects.create(
+            username="known",
+            git_id=1,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+
+    def test_page_of_authors_is_resolved_in_bulk(self):
+        resolver = AuthorResolver()
+        users = [make_git_author(1, "known"), make_git_author(2, "new")] * 3
+        # Known authors are read with one query, new ones inserted with one
+        with self.assertNumQueries(3):
+            authors = resolver.resolve_many(users + [None])
+        self.assertEqual(authors[1], self.known)
+        self.assertEqual(authors[2].username, "new")
+        self.assertEqual(Author.objects.count(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve(make_git_author(2, "new")), authors[2])
+
+    def test_cache_evicts_least_recently_used(self):
+        resolver = AuthorResolver(max_size=2)
+        for git_id in (1, 2, 1, 3):
+            resolver.resolve(make_git_author(git_id, f"user{git_id}"))
+        self.assertEqual(list(resolver.authors), [1, 3])
+
+
+class PagePipelineTestCase(SimpleTestCase):
+    def test_producer_stays_within_queue_depth(self):
+        produced = []
+
+        def pages():
+            for i in range(20):
+                produced.append(i)
+                yield [i]
+
+        consumed = []
+        for page in PagePipeline(pages(), depth=2):
+            # The producer may hold one more page waiting to be queued
+            time.sleep(0.01)
+            self.assertLessEqual(len(produced) - len(consumed), 4)
+            consumed.extend(page)
+        self.assertEqual(consumed, list(range(20)))
+
+    def test_producer_error_is_raised_in_consumer(self):
+        def pages():
+            yield [1]
+            raise RuntimeError("listing failed")
+
+        with self.assertRaisesMessage(RuntimeError, "listing failed"):
+            list(PagePipeline(pages(), depth=2))
+
+
+class CommitWriterTestCase(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=67890,
+            name="testrepo",
+            full_name="testrepo/full",
+            owner=self.author,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+
+    def build(self, sha, additions):
+        commit = Commit(
+            repository=self.repository,
+            sha=sha,
+            message=f"commit {sha}",
+            date=timezone.now(),
+            commited_at=timezone.now(),
+            author=self.author,
+            url="http://example.com/commit",
+            additions=additions,
+        )
+        files = [CommitFile(filename="file.py", status="modified", additions=additions)]
+        return commit, files
+
+    def test_flush_upserts_batch_in_few_queries(self):
+        writer = CommitWriter(self.repository, batch_size=10)
+        for i in range(5):
+            writer.add(*self.build(f"sha{i}", 1))
+        # Commits, files, the day's rollup and the repository's counters,
+        # plus reading back the ids and the previous rollup values
+        with self.assertNumQueries(9):
+            writer.flush()
+        self.assertEqual(Commit.objects.filter(repository=self.repository).count(), 5)
+        self.assertEqual(CommitFile.objects.count(), 5)
+
+    def test_flush_updates_existing_rows(self):
+        writer = CommitWriter(self.repository)
+        writer.add(*self.build("sha0", 1))
+        writer.flush()
+        writer.add(*self.build("sha0", 7))
+        writer.flush()
+        commit = Commit.objects.get(repository=self.repository, sha="sha0")
+        self.assertEqual(commit.additions, 7)
+        self.assertEqual(commit.commitfile_set.get().additions, 7)
+
+    def test_add_flushes_full_batches(self):
+        writer = CommitWriter(self.repository, batch_size=2)
+        for i in range(3):
+            writer.add(*self.build(f"sha{i}", 1))
+        self.assertEqual(writer.commits_written, 2)
+        writer.flush()
+        self.assertEqual(writer.commits_written, 3)
+
+
+class CommitRollupTestCase(TestCase):
+    def setUp(self):
+        self.addCleanup(stats_cache.cache.clear)
+        self.user = User.objects.create_user(username="testuser", password="password")
+        self.author = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=67890,
+            name="testrepo",
+            full_name="testrepo/full",
+            owner=self.author,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+        self.today = timezone.now().replace(hour=10)
+
+    def write(self, commits, update_fields=None):
+        writer = CommitWriter(self.repository, update_fields=update_fields)
+        for sha, when, additions in commits:
+            writer.add(
+                Commit(
+                    repository=self.repository,
+                    sha=sha,
+                    message=f"commit {sha}",
+                    date=when,
+                    commited_at=when,
+                    author=self.author,
+                    url="http://example.com/commit",
+                    additions=additions,
+                    deletions=1,
+                ),
+                [],
+            )
+        writer.flush()
+
+    def rollups(self):
+        return list(
+            CommitRollup.objects.order_by("day").values_list(
+                "day", "commits", "additions", "deletions"
+            )
+        )
+
+    def test_writer_keeps_rollups_up_to_date(self):
+        yesterday = self.today - timedelta(days=1)
+        self.write([("a", yesterday, 1), ("b", self.today, 2), ("c", self.today, 3)])
+        # Rewriting a commit replaces its contribution instead of adding to it
+        self.write([("c", self.today.replace(hour=12), 10)])
+        self.assertEqual(
+            self.rollups(),
+            [(yesterday.date(), 1, 1, 1), (self.today.date(), 2, 12, 2)],
+        )
+        hours = CommitRollup.objects.get(day=self.today.date()).hours
+        self.assertEqual((hours[10], hours[12]), (1, 1))
+        # Metadata-only passes keep the stored stats
+        self.write([("c", self.today, 0)], CommitWriter.METADATA_UPDATE_FIELDS)
+        self.assertEqual(self.rollups()[1], (self.today.date(), 2, 12, 2))
+
+    def test_rebuild_rollups_matches_the_writer(self):
+        self.write([("a", self.today - timedelta(days=3), 4), ("b", self.today, 5)])
+        written = self.rollups()
+        CommitRollup.objects.update(commits=0, additions=0)
+        Commit.objects.filter(sha="b").update(additions=7)
+        call_command("rebuild_rollups", stdout=StringIO())
+        self.assertEqual(written[0], self.rollups()[0])
+        self.assertEqual(self.rollups()[1], (self.today.date(), 1, 7, 1))
+        # The counters are recounted, not added onto
+        call_command("rebuild_rollups", stdout=StringIO())
+        self.repository.refresh_from_db()
+        self.assertEqual(
+            (
+                self.repository.commit_count,
+                self.repository.contributor_count,
+                self.repository.total_additions,
+                self.repository.total_deletions,
+            ),
+            (2, 1, 11, 2),
+        )
+        call_command("verify_counters", stdout=StringIO())
+
+    def test_writer_maintains_repository_counters(self):
+        first = self.today - timedelta(days=3)
+        self.write([("a", first, 4), ("b", self.today, 5)])
+        self.write([("b", self.today, 6)])
+        self.repository.refresh_from_db()
+        self.assertEqual(
+            (
+                self.repository.commit_count,
+                self.repository.contributor_count,
+                self.repository.total_additions,
+                self.repository.total_deletions,
+                self.repository.first_commit_date,
+                self.repository.last_commit_date,
+            ),
+            (2, 1, 10, 2, first, self.today),
+        )
+
+    def test_verify_counters_repairs_drift(self):
+        self.write([("a", self.today, 4)])
+        call_command("verify_counters", stdout=StringIO())
+        Repository.objects.update(commit_count=7, total_additions=0)
+        with self.assertRaises(CommandError):
+            call_command("verify_counters", stdout=StringIO())
+        # A repository being synced is only repaired once its lease is free
+        lease = RepositoryLease(self.repository)
+        self.assertTrue(lease.try_acquire())
+        with self.assertRaisesMessage(CommandError, "busy"):
+            call_command(
+                "verify_counters",
+                repair=True,
+                lease_wait=0,
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.commit_count, 7)
+        lease.release()
+        out = StringIO()
+        call_command("verify_counters", repair=True, stdout=out)
+        self.assertIn("commit_count 7 != 1", out.getvalue())
+        self.repository.refresh_from_db()
+        self.assertEqual(
+            (self.repository.commit_count, self.repository.total_additions), (1, 4)
+        )
+
+    def chart(self, chart, **headers):
+        return self.client.get(
+            reverse(
+                "tracker:repository_chart",
+                kwargs={"pk": self.repository.pk, "chart": chart},
+            ),
+            **headers,
+        )
+
+    def test_stats_are_cached_until_new_commits_land(self):
+        self.write([("a", self.today, 4)])
+        self.client.force_login(self.user)
+        self.chart("contributors")
+        self.client.get(reverse("tracker:dashboard"))
+        # Only the repository itself is read once the stats are cached
+        with self.assertNumQueries(1):
+            response = self.chart("contributors")
+        self.assertEqual(response.json()["data"], [1])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.write([("b", self.today, 5)])
+        self.assertEqual(self.chart("contributors").json()["data"], [2])
+        response = self.client.get(reverse("tracker:dashboard"))
+        self.assertEqual(response.context["total_commits"], 2)
+
+    def test_stats_query_budget(self):
+        self.write([("a", self.today - timedelta(days=40), 4), ("b", self.today, 5)])
+        self.client.force_login(self.user)
+        # Repository rows and recent commits, the charts are fetched later
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("tracker:dashboard"))
+        self.assertEqual(response.context["top_language"]["language_count"], 0)
+        # The same rows for the author, after looking the author up
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse("tracker:dashboard"), {"author": "testauthor"}
+            )
+        self.assertEqual(response.context["total_repositories"], 1)
+        self.assertEqual(response.context["total_commits"], 2)
+        # Latest sync of the scope and one scan of the recent rollups
+        dashboard_chart = reverse(
+            "tracker:dashboard_chart", kwargs={"chart": "active_repositories"}
+        )
+        with self.assertNumQueries(2):
+            response = self.client.get(dashboard_chart)
+        self.assertEqual(response.json(), {"labels": ["testrepo"], "data": [1]})
+        # The other activity charts are served from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse("tracker:dashboard_chart", kwargs={"chart": "churn"})
+            )
+        self.assertEqual(response.json()["data"], [5, 1])
+        # The repository page only reads the repository, its charts the
+        # repository and its rollups
+        with self.assertNumQueries(1):
+            self.client.get(
+                reverse(
+                    "tracker:repository_analysis", kwargs={"pk": self.repository.pk}
+                )
+            )
+        with self.assertNumQueries(2):
+            response = self.chart("contributors")
+        self.assertEqual(response.json(), {"labels": ["testauthor"], "data": [2]})
+
+    def test_stats_views_read_rollups(self):
+        self.write([("a", self.today - timedelta(days=40), 4), ("b", self.today, 5)])
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("tracker:repository_analysis", kwargs={"pk": self.repository.pk})
+        )
+        self.assertEqual(response.context["commit_count"], 2)
+        self.assertEqual(self.chart("churn").json()["data"], [11])
+        self.assertEqual(
+            self.chart("time_distribution").json(), {"labels": [10], "data": [2]}
+        )
+        response = self.client.get(reverse("tracker:dashboard"))
+        self.assertEqual(response.context["total_commits"], 2)
+        self.assertEqual(
+            list(response.context["repository_comparison"]),
+            [
+                {
+                    "name": "testrepo",
+                    "total_commits": 2,
+                    "total_contributors": 1,
+                    "churn_rate": 11,
+                }
+            ],
+        )
+        response = self.client.get(
+            reverse("tracker:dashboard_chart", kwargs={"chart": "commit_frequency"})
+        )
+        self.assertEqual(response.json()["data"], [1])
+
+    def test_charts_answer_unchanged_data_with_304(self):
+        synced = timezone.now() - timedelta(hours=1)
+        Repository.objects.filter(pk=self.repository.pk).update(last_synced_at=synced)
+        self.write([("a", self.today, 4)])
+        response = self.chart("commit_frequency")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("no-cache", response["Cache-Control"])
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+        response = self.chart("commit_frequency", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        response = self.chart("commit_frequency", HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        # New commits change the ETag even before the sync time moves
+        with self.captureOnCommitCallbacks(execute=True):
+            self.write([("b", self.today, 5)])
+        response = self.chart("commit_frequency", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"], [2])
+        self.assertEqual(self.chart("unknown").status_code, 404)
+
+
+class StatsCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.stats = StatsCache(alias="default", lock_timeout=5, poll_interval=0.01)
+        self.addCleanup(self.stats.cache.clear)
+
+    def test_concurrent_misses_compute_once(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return {"total": 1}
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.stats.get_or_compute("all", "dashboard", compute)
+                )
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"total": 1}] * 4)
+
+    def test_invalidation_is_per_scope(self):
+        self.stats.get_or_compute("all", "dashboard", lambda: 1)
+        self.stats.get_or_compute("repository:1", "stats", lambda: 1)
+        self.stats.invalidate("all")
+        self.assertEqual(self.stats.get_or_compute("all", "dashboard", lambda: 2), 2)
+        self.assertEqual(
+            self.stats.get_or_compute("repository:1", "stats", lambda: 2), 1
+        )
+
+
+class SyncRepoCommandTestCase(TransactionTestCase):
+    def setUp(self):
+        self.addCleanup(author_resolver.clear)
+        self.addCleanup(client_registry.clear)
+        self.user = User.objects.create_user(username="testuser", password="password")
+        GitToken.objects.create(
+            user=self.user, label="token", token="sometoken", service="github"
+        )
+        owner = make_git_author(1, "owner")
+        self.git_repos = []
+        for i in range(4):
+            git_repo = MagicMock(
+                id=100 + i, owner=owner, license=None, private=False, description=""
+            )
+            git_repo.name = f"repo{i}"
+            git_repo.full_name = f"owner/repo{i}"
+            git_repo.html_url = f"http://example.com/repo{i}"
+            git_repo.language = "Python"
+            git_repo.default_branch = "main"
+            git_repo.create_hook.return_value.id = 1000 + i
+            git_repo.created_at = git_repo.updated_at = git_repo.pushed_at = None
+            git_repo.get_commits.return_value = [
+                make_git_commit(f"{i}-sha", timezone.now(), owner)
+            ]
+            self.git_repos.append(git_repo)
+
+    @patch("tracker.services.http_cache.Github")
+    def test_sync_with_workers(self, github):
+        github.return_value.get_user.return_value.get_repos.return_value = (
+            self.git_repos
+        )
+        github.return_value.rate_limiting = (5000, 5000)
+        github.return_value.rate_limiting_resettime = time.time() + 3600
+        out = StringIO()
+        call_command("sync_repo", workers=3, stdout=out)
+        self.assertEqual(Repository.objects.count(), 4)
+        self.assertEqual(Commit.objects.count(), 4)
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(self.user.repositories.count(), 4)
+        self.assertIn("Synced 4 repositories and 4 commits", out.getvalue())
+
+    @patch("tracker.services.http_cache.Github")
+    def test_repositories_seen_by_several_tokens_are_synced_once(self, github):
+        github.return_value.get_user.return_value.get_repos.return_value = (
+            self.git_repos
+        )
+        github.return_value.rate_limiting = (5000, 5000)
+        github.return_value.rate_limiting_resettime = time.time() + 3600
+        other = User.objects.create_user(username="other", password="password")
+        GitToken.objects.create(
+            user=other, label="other", token="othertoken", service="github"
+        )
+        out = StringIO()
+        call_command("sync_repo", workers=2, stdout=out)
+        for git_repo in self.git_repos:
+            git_repo.get_commits.assert_called_once()
+        self.assertEqual(self.user.repositories.count(), 4)
+        self.assertEqual(other.repositories.count(), 4)
+        self.assertIn("Synced 4 repositories and 4 commits", out.getvalue())
+
+    @patch("tracker.services.http_cache.Github")
+    def test_unchanged_repositories_are_skipped(self, github):
+        github.return_value.get_user.return_value.get_repos.return_value = (
+            self.git_repos
+        )
+        github.return_value.rate_limiting = (5000, 5000)
+        github.return_value.rate_limiting_resettime = time.time() + 3600
+        pushed_at = timezone.now() - timedelta(days=1)
+        for git_repo in self.git_repos:
+            git_repo.updated_at = git_repo.pushed_at = pushed_at
+        call_command("sync_repo", stdout=StringIO())
+        self.git_repos[0].pushed_at = timezone.now()
+        out = StringIO()
+        call_command("sync_repo", stdout=out)
+        # Synced since the mark of the first run
+        self.git_repos[0].compare.assert_called_once_with("0-sha", "main")
+        for git_repo in self.git_repos[1:]:
+            git_repo.compare.assert_not_called()
+        self.assertIn("(3 unchanged repositories skipped, 0 busy", out.getvalue())
+        self.assertEqual(self.user.repositories.count(), 4)
+
+    @patch("tracker.services.http_cache.Github")
+    def test_repositories_leased_by_another_sync_are_skipped(self, github):
+        github.return_value.get_user.return_value.get_repos.return_value = (
+            self.git_repos
+        )
+        github.return_value.rate_limiting = (5000, 5000)
+        github.return_value.rate_limiting_resettime = time.time() + 3600
+        call_command("sync_repo", stdout=StringIO())
+        repository = Repository.objects.get(git_id=self.git_repos[0].id)
+        out = StringIO()
+        with RepositoryLease(repository):
+            call_command("sync_repo", stdout=out)
+        self.git_repos[0].compare.assert_not_called()
+        self.git_repos[1].compare.assert_called_once_with("1-sha", "main")
+        self.assertIn(f"Busy - {repository.full_name}", out.getvalue())
+        self.assertIn("1 busy with another sync", out.getvalue())
+
+    @patch("tracker.services.http_cache.Github")
+    def test_repositories_pushed_while_busy_are_synced_next_cycle(self, github):
+        github.return_value.get_user.return_value.get_repos.return_value = (
+            self.git_repos
+        )
+        github.return_value.rate_limiting = (5000, 5000)
+        github.return_value.rate_limiting_resettime = time.time() + 3600
+        pushed_at = timezone.now() - timedelta(days=1)
+        for git_repo in self.git_repos:
+            git_repo.updated_at = git_repo.pushed_at = pushed_at
+        call_command("sync_repo", stdout=StringIO())
+        repository = Repository.objects.get(git_id=self.git_repos[0].id)
+        self.git_repos[0].pushed_at = timezone.now()
+        with RepositoryLease(repository):
+            call_command("sync_repo", stdout=StringIO())
+        self.git_repos[0].compare.assert_not_called()
+        repository.refresh_from_db()
+        self.assertEqual(repository.pushed_at, pushed_at)
+        out = StringIO()
+        call_command("sync_repo", stdout=out)
+        self.git_repos[0].compare.assert_called_once_with("0-sha", "main")
+        self.assertIn("(3 unchanged repositories skipped", out.getvalue())
+        repository.refresh_from_db()
+        self.assertEqual(repository.pushed_at, self.git_repos[0].pushed_at)
+
+    @patch("tracker.services.http_cache.Github")
+    def test_shards_sync_disjoint_slices(self, github):
+        github.return_value.get_user.return_value.get_repos.return_value = (
+            self.git_repos
+        )
+        github.return_value.rate_limiting = (5000, 5000)
+        github.return_value.rate_limiting_resettime = time.time() + 3600
+        synced = []
+        for index in (1, 2):
+            call_command("sync_repo", shard=Shard(index, 2), stdout=StringIO())
+            synced.append(
+                {repo.id for repo in self.git_repos if repo.get_commits.called}
+                - set().union(*synced)
+            )
+        self.assertFalse(synced[0] & synced[1])
+        self.assertEqual(synced[0] | synced[1], {repo.id for repo in self.git_repos})
+        # A shard only touches the memberships of its own slice
+        self.assertEqual(self.user.repositories.count(), 4)
+
+
+class RepositoryLeaseTestCase(TestCase):
+    def setUp(self):
+        owner = Author.objects.create(
+            username="owner",
+            git_id=1,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=2,
+            name="repo",
+            full_name="owner/repo",
+            owner=owner,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+
+    def test_lease_is_exclusive_until_released(self):
+        with RepositoryLease(self.repository):
+            with self.assertRaises(LeaseBusy):
+                RepositoryLease(self.repository).acquire()
+        with RepositoryLease(self.repository):
+            pass
+        self.assertEqual(
+            RepositoryLease.contention(), {"acquisitions": 2, "contentions": 1}
+        )
+        self.assertIsNone(SyncLease.objects.get().token)
+
+    def test_expired_lease_is_taken_over(self):
+        crashed = RepositoryLease(self.repository)
+        self.assertTrue(crashed.try_acquire())
+        SyncLease.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        with RepositoryLease(self.repository):
+            # The late release of the crashed holder leaves the lease alone
+            crashed.release()
+            self.assertIsNotNone(SyncLease.objects.get().token)
+
+
+class SyncPlanTestCase(TestCase):
+    def setUp(self):
+        self.tokens = []
+        for name in ("first", "second"):
+            user = User.objects.create_user(username=name, password="password")
+            self.tokens.append(
+                GitToken.objects.create(
+                    user=user, label=name, token=name, service="github"
+                )
+            )
+        self.repos = [MagicMock(id=100 + i) for i in range(4)]
+
+    def test_repositories_go_to_the_token_with_most_quota(self):
+        plan = SyncPlan()
+        plan.add_listing(self.tokens[0], self.repos[:3])
+        plan.add_listing(self.tokens[1], self.repos)
+        first, second = self.tokens
+        assigned = plan.assign({first: 5000, second: 10})
+        self.assertEqual(
+            [(token, repo.id) for token, repo in assigned],
+            [(first, 100), (first, 101), (first, 102), (second, 103)],
+        )
+        # Equal quotas spread the shared repositories
+        assigned = plan.assign({first: 100, second: 100})
+        self.assertEqual([token for token, _ in assigned].count(first), 2)
+
+    def test_shard_only_plans_its_slice(self):
+        shard = Shard(1, 2)
+        plan = SyncPlan(shard)
+        plan.add_listing(self.tokens[0], self.repos)
+        self.assertEqual(
+            {repo.id for _, repo in plan.assign({})},
+            {repo.id for repo in self.repos if shard.contains(repo.id)},
+        )
+
+
+class ShardTestCase(SimpleTestCase):
+    def test_shards_partition_ids(self):
+        shards = [Shard(index, 3) for index in (1, 2, 3)]
+        for git_id in range(100):
+            self.assertEqual(sum(shard.contains(git_id) for shard in shards), 1)
+
+    def test_parse(self):
+        self.assertEqual(str(Shard.parse("2/4")), "2/4")
+        for value in ("0/4", "5/4", "x"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                Shard.parse(value)
+
+
+class TokenBucketTestCase(SimpleTestCase):
+    def test_take_waits_once_burst_is_spent(self):
+        now = [0.0]
+        sleeps = []
+        bucket = TokenBucket(
+            rate=2, capacity=2, clock=lambda: now[0], sleep=sleeps.append
+        )
+        bucket.take()
+        bucket.take()
+        self.assertEqual(sleeps, [])
+        bucket.take()
+        self.assertEqual(sleeps, [0.5])
+
+
+class RateLimitSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.now = 1_000_000
+        self.sleeps = []
+        clients = ClientRegistry()
+        clients.build_client = lambda token: MagicMock(
+            rate_limiting=(5000, 5000), rate_limiting_resettime=self.now + 3600
+        )
+        self.scheduler = RateLimitScheduler(
+            reserve=10,
+            clock=lambda: self.now,
+            sleep=self.sleeps.append,
+            clients=clients,
+        )
+        self.owner = Author.objects.create(
+            username="owner",
+            git_id=1,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=2,
+            name="repo",
+            full_name="owner/repo",
+            owner=self.owner,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+        self.tokens = []
+        for name in ("first", "second"):
+            user = User.objects.create_user(username=name, password="password")
+            user.repositories.add(self.repository)
+            self.tokens.append(
+                GitToken.objects.create(
+                    user=user, label=name, token=name, service="github"
+                )
+            )
+
+    def set_remaining(self, token, remaining, reset_in=3600):
+        client = self.scheduler.client_for(token)
+        client.rate_limiting = (remaining, 5000)
+        client.rate_limiting_resettime = self.now + reset_in
+        self.scheduler.record(token)
+
+    def test_acquire_raises_when_only_reserve_is_left(self):
+        self.set_remaining(self.tokens[0], 10)
+        with self.assertRaises(QuotaExhausted):
+            self.scheduler.acquire(self.tokens[0])
+
+    def test_high_quota_token_is_not_paced(self):
+        self.set_remaining(self.tokens[0], 4000)
+        bucket = self.scheduler.quota(self.tokens[0]).bucket
+        bucket.sleep = self.sleeps.append
+        for _ in range(self.scheduler.burst * 3):
+            self.scheduler.acquire(self.tokens[0])
+        self.assertIsNone(bucket.rate)
+        self.assertEqual(self.sleeps, [])
+
+    def test_low_quota_token_is_paced_until_reset(self):
+        self.set_remaining(self.tokens[0], 720)
+        bucket = self.scheduler.quota(self.tokens[0]).bucket
+        self.assertEqual(bucket.rate, 0.2)
+        self.set_remaining(self.tokens[0], 4000)
+        self.assertIsNone(bucket.rate)
+
+    def test_failover_picks_token_with_most_quota(self):
+        self.set_remaining(self.tokens[0], 5)
+        self.set_remaining(self.tokens[1], 4000)
+        token = self.scheduler.failover(self.tokens[0], self.repository)
+        self.assertEqual(token, self.tokens[1])
+        self.assertEqual(self.sleeps, [])
+
+    def test_failover_sleeps_until_earliest_reset(self):
+        self.set_remaining(self.tokens[0], 5, reset_in=600)
+        self.set_remaining(self.tokens[1], 5, reset_in=60)
+        token = self.scheduler.failover(self.tokens[0], self.repository)
+        self.assertEqual(token, self.tokens[1])
+        self.assertEqual(self.sleeps, [61])
+
+
+class ClientRegistryTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password")
+        self.client.force_login(self.user)
+        self.token = GitToken.objects.create(
+            user=self.user, label="token", token="first", service="github"
+        )
+        owner = Author.objects.create(
+            username="owner",
+            git_id=1,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=2,
+            name="repo",
+            full_name="owner/repo",
+            owner=owner,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+        self.repository.users.add(self.user)
+        self.addCleanup(client_registry.clear)
+
+    def test_client_and_repository_token_are_reused(self):
+        client = client_registry.client_for(self.token)
+        self.assertIs(client_registry.client_for(self.token), client)
+        self.assertEqual(client_registry.token_for(self.repository), self.token)
+        with self.assertNumQueries(0):
+            self.assertEqual(client_registry.token_for(self.repository), self.token)
+        # A token changed by another process gets a new client
+        self.token.token = "second"
+        self.assertIsNot(client_registry.client_for(self.token), client)
+
+    def test_token_views_invalidate_clients(self):
+        client = client_registry.client_for(self.token)
+        client_registry.token_for(self.repository)
+        self.client.post(
+            reverse("tracker:gittoken_edit", kwargs={"pk": self.token.pk}),
+            {"service": "github", "label": "token", "token": "second", "is_active": ""},
+        )
+        self.assertNotIn(self.token.pk, client_registry.clients)
+        self.assertIsNone(client_registry.token_for(self.repository))
+        self.assertIsNot(client_registry.client_for(self.token), client)
+        self.client.get(
+            reverse("tracker:gittoken_delete", kwargs={"pk": self.token.pk})
+        )
+        self.assertEqual(client_registry.clients, {})
+
+
+class CachedHTTPSConnectionTestCase(TestCase):
+    def setUp(self):
+        cache_stats.reset()
+        self.connection = CachedHTTPSConnection("api.github.com")
+        self.connection.session = MagicMock()
+
+    def get(self, status, headers, text=""):
+        self.connection.session.get.return_value = MagicMock(
+            status_code=status, headers=CaseInsensitiveDict(headers), text=text
+        )
+        self.connection.request(
+            "GET", "/repos/owner/repo/commits", None, {"Authorization": "token abc"}
+        )
+        return self.connection.getresponse()
+
+    def test_304_is_served_from_cache(self):
+        self.get(200, {"ETag": '"v1"', "X-RateLimit-Remaining": "10"}, "[1, 2]")
+        self.assertEqual(ResponseCacheEntry.objects.count(), 1)
+        response = self.get(304, {"X-RateLimit-Remaining": "9"})
+        sent_headers = self.connection.session.get.call_args.kwargs["headers"]
+        self.assertEqual(sent_headers["If-None-Match"], '"v1"')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), "[1, 2]")
+        self.assertEqual(dict(response.getheaders())["X-RateLimit-Remaining"], "9")
+        self.assertEqual((cache_stats.hits, cache_stats.misses), (1, 1))
+
+    def test_entries_are_kept_per_token(self):
+        self.get(200, {"ETag": '"v1"'}, "[1]")
+        self.connection.request(
+            "GET", "/repos/owner/repo/commits", None, {"Authorization": "token xyz"}
+        )
+        self.connection.getresponse()
+        sent_headers = self.connection.session.get.call_args.kwargs["headers"]
+        self.assertNotIn("If-None-Match", sent_headers)
+
+    def test_only_listings_are_cached_and_old_entries_pruned(self):
+        self.get(200, {"ETag": '"v1"'}, "[1]")
+        self.connection.request(
+            "GET",
+            "/repos/owner/repo/commits/" + "a" * 40,
+            None,
+            {"Authorization": "token abc"},
+        )
+        self.connection.getresponse()
+        self.assertEqual(
+            list(ResponseCacheEntry.objects.values_list("url", flat=True)),
+            ["/repos/owner/repo/commits"],
+        )
+        # An entry of a detail URL stored before they stopped being cached
+        ResponseCacheEntry.objects.create(
+            key="old-detail", url="/repos/owner/repo/compare/a...b", body=""
+        )
+        self.assertEqual(prune_response_cache(), 1)
+        ResponseCacheEntry.objects.update(
+            updated_at=timezone.now() - timedelta(days=30)
+        )
+        self.assertEqual(prune_response_cache(), 1)
+        self.assertFalse(ResponseCacheEntry.objects.exists())
+
+    def test_build_client_uses_cached_connection(self):
+        with self.settings(GITHUB_RESPONSE_CACHE=True):
+            client = build_client("abc")
+        requester = client._Github__requester
+        self.assertIs(requester._Requester__connectionClass, CachedHTTPSConnection)
+        self.assertIs(
+            Requester._Requester__httpsConnectionClass, HTTPSRequestsConnectionClass
+        )
+
+
+class StubGitHubHandler(BaseHTTPRequestHandler):
+    """
+    Serves a single repository with a few commits, counting how many commit
+    detail requests are in flight at once.
+    """
+
+    commits = [f"{i:040x}" for i in range(1, 9)]
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def commit_json(self, sha):
+        return {
+            "sha": sha,
+            "url": f"{self.base_url()}/repos/owner/repo/commits/{sha}",
+            "html_url": f"http://example.com/commit/{sha}",
+            "author": None,
+            "committer": None,
+            "commit": {
+                "message": f"commit {sha}",
+                "author": {"date": "2024-01-01T00:00:00Z"},
+                "committer": {"date": "2024-01-01T00:00:00Z"},
+            },
+        }
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/repos/owner/repo":
+            body = {
+                "full_name": "owner/repo",
+                "url": f"{self.base_url()}/repos/owner/repo",
+            }
+        elif path == "/repos/owner/repo/commits":
+            body = [self.commit_json(sha) for sha in self.commits]
+        else:
+            sha = path.rsplit("/", 1)[-1]
+            cls = type(self)
+            with cls.lock:
+                cls.in_flight += 1
+                cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            time.sleep(0.05)
+            with cls.lock:
+                cls.in_flight -= 1
+            body = self.commit_json(sha)
+            body["stats"] = {"additions": 3, "deletions": 1, "total": 4}
+            body["files"] = [
+                {
+                    "filename": "file.py",
+                    "status": "modified",
+                    "additions": 3,
+                    "deletions": 1,
+                    "changes": 4,
+                    "patch": "@@ -1 +1 @@",
+                }
+            ]
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@override_settings(GITHUB_RESPONSE_CACHE=False)
+class CommitDetailStubServerTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubGitHubHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_commit_details_are_fetched_concurrently(self):
+        self.addCleanup(author_resolver.clear)
+        owner = Author.objects.create(
+            username="owner",
+            git_id=1,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        repository = Repository.objects.create(
+            git_id=2,
+            name="repo",
+            full_name="owner/repo",
+            owner=owner,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+        client = build_client(
+            "abc",
+            base_url=f"http://127.0.0.1:{self.server.server_port}",
+            seconds_between_requests=None,
+        )
+        service = RepositorySyncService(
+            repository=client.get_repo("owner/repo"),
+            repo_obj=repository,
+            detail_workers=4,
+        )
+        result = service.fetch_commits()
+        self.assertEqual(result.commits, len(StubGitHubHandler.commits))
+        self.assertGreater(StubGitHubHandler.max_in_flight, 1)
+        for commit in Commit.objects.filter(repository=repository):
+            self.assertEqual((commit.additions, commit.total), (3, 4))
+            self.assertEqual(commit.commitfile_set.get().patch, "@@ -1 +1 @@")
+
+
+class PatchBlobTestCase(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=67890,
+            name="testrepo",
+            full_name="testrepo/full",
+            owner=self.author,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+        self.commits = [
+            Commit.objects.create(
+                repository=self.repository,
+                sha=sha,
+                message="commit",
+                date=timezone.now(),
+                commited_at=timezone.now(),
+                url="http://example.com/commit",
+            )
+            for sha in ("a", "b")
+        ]
+
+    def test_identical_patches_are_stored_once(self):
+        patch = "@@ -1 +1 @@\n-old\n+new\n" * 50
+        for commit in self.commits:
+            CommitFile.objects.create(commit=commit, filename="file.py", patch=patch)
+        self.assertEqual(PatchBlob.objects.count(), 1)
+        blob = PatchBlob.objects.get()
+        self.assertLess(len(bytes(blob.data)), len(patch))
+        for file in CommitFile.objects.all():
+            self.assertIsNone(file.inline_patch)
+            self.assertEqual(file.patch, patch)
+
+    def test_compress_patches_converts_inline_rows(self):
+        for commit in self.commits:
+            CommitFile.objects.bulk_create(
+                [CommitFile(commit=commit, filename="file.py", inline_patch="+x")]
+            )
+        call_command("compress_patches", batch_size=1, stdout=StringIO())
+        self.assertEqual(PatchBlob.objects.count(), 1)
+        self.assertFalse(CommitFile.objects.filter(inline_patch__isnull=False).exists())
+        self.assertEqual(
+            [file.patch for file in CommitFile.objects.all()], ["+x", "+x"]
+        )
+
+
+class GitMirrorSyncServiceTestCase(TestCase):
+    def setUp(self):
+        # Authors cached by an earlier test were rolled back with it
+        self.addCleanup(author_resolver.clear)
+        self.author = Author.objects.create(
+            username="testauthor",
+            git_id=12345,
+            avatar_url="http://example.com/avatar.png",
+            html_url="http://example.com",
+        )
+        self.repository = Repository.objects.create(
+            git_id=67890,
+            name="testrepo",
+            full_name="testrepo/full",
+            owner=self.author,
+            html_url="http://example.com/repo",
+            default_branch="main",
+        )
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.source = self.root / "source"
+        self.author_email = "12345+testauthor@users.noreply.github.com"
+        self.git("init", "--quiet", "--initial-branch=main", str(self.source))
+
+    def git(self, *args):
+        subprocess.run(
+            ["git", *args],
+            cwd=self.root,
+            check=True,
+            capture_output=True,
+            env={
+                "GIT_AUTHOR_NAME": "testauthor",
+                "GIT_AUTHOR_EMAIL": self.author_email,
+                "GIT_COMMITTER_NAME": "Someone",
+                "GIT_COMMITTER_EMAIL": "someone@example.com",
+                "HOME": str(self.root),
+            },
+        )
+
+    def commit(self, message, **files):
+        for name, content in files.items():
+            path = self.source / name
+            if content is None:
+                path.unlink()
+            else:
+                path.write_text(content)
+        self.git("-C", str(self.source), "add", "-A")
+        self.git("-C", str(self.source), "commit", "--quiet", "-m", message)
+
+    def sync(self, full=False):
+        service = GitMirrorSyncService(
+            repository=None,
+            repo_obj=self.repository,
+            remote_url=str(self.source),
+            mirror_root=self.root / "mirrors",
+        )
+        return service.fetch_commits(full=full)
+
+    def test_sync_reads_commits_and_files_from_mirror(self):
+        self.commit("Add files", **{"a.py": "one\ntwo\n", "b.txt": "gone\n"})
+        self.commit("Change files\n\nWith a body", **{"a.py": "one\n2\n", "b.txt": None})
+        result = self.sync()
+        self.assertEqual(result.commits, 2)
+        head = Commit.objects.get(message="Change files\n\nWith a body")
+        self.assertEqual(head.author, self.author)
+        self.assertIsNone(head.committer)
+        self.assertEqual((head.additions, head.deletions, head.total), (1, 2, 3))
+        files = {file.filename: file for file in head.commitfile_set.all()}
+        self.assertEqual(files["a.py"].status, "modified")
+        self.assertEqual(files["b.txt"].status, "removed")
+        self.assertTrue(files["a.py"].patch.startswith("@@ -1,2 +1,2 @@"))
+        first = Commit.objects.get(message="Add files")
+        self.assertEqual(
+            sorted(first.commitfile_set.values_list("filename", "status")),
+            [("a.py", "added"), ("b.txt", "added")],
+        )
+        self.repository.refresh_from_db()
+        self.assertEqual(self.repository.last_commit_sha, head.sha)
+
+    def test_login_only_authors_are_looked_up_once_per_batch(self):
+        self.author_email = "testauthor@users.noreply.github.com"
+        for i in range(3):
+            self.commit(f"Commit {i}", **{"a.py": f"{i}\n"})
+        with CaptureQueriesContext(connection) as queries:
+            self.sync()
+        lookups = [
+            query["sql"]
+            for query in queries.captured_queries
+            if '"username" IN' in query["sql"]
+        ]
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(
+            set(Commit.objects.values_list("author", flat=True)), {self.author.pk}
+        )
+
+    def test_patches_keep_unicode_line_separators(self):
+        self.commit("Separators", **{"a.txt": "one\u2028two\x1cthree\n"})
+        self.sync()
+        patch = CommitFile.objects.get(filename="a.txt").patch
+        self.assertIn("+one\u2028two\x1cthree", patch)
+
+    def test_failing_git_log_does_not_complete_the_sync(self):
+        self.commit("First", **{"a.py": "one\n"})
+        self.repository.default_branch = "renamed"
+        self.repository.save()
+        with self.assertRaisesMessage(CommandError, "git log failed"):
+            self.sync()
+        self.assertFalse(Commit.objects.exists())
+        self.repository.refresh_from_db()
+        self.assertIsNone(self.repository.last_commit_sha)
+
+    def test_incremental_sync_only_reads_new_commits(self):
+        self.commit("First", **{"a.py": "one\n"})
+        self.sync()
+        self.commit("Second", **{"a.py": "two\n"})
+        result = self.sync()
+        self.assertEqual(result.commits, 1)
+        self.assertEqual(Commit.objects.count(), 2)
@@ -6,6 +6,11 @@ app_name = "tracker"
 
 urlpatterns = [
     path("", views.DashboardView.as_view(), name="dashboard"),
+    path(
+        "charts/<slug:chart>/",
+        views.DashboardChartView.as_view(),
+        name="dashboard_chart",
+    ),
     path("tokens/", views.TokenListView.as_view(), name="gittoken_list"),
     path("tokens/create/", views.TokenCreateView.as_view(), name="gittoken_create"),
     path("tokens/<int:pk>/edit/", views.TokenEditView.as_view(), name="gittoken_edit"),
@@ -16,6 +21,11 @@ urlpatterns = [
         views.RepositoryStatsView.as_view(),
         name="repository_analysis",
     ),
+    path(
+        "repository/<int:pk>/analysis/charts/<slug:chart>/",
+        views.RepositoryChartView.as_view(),
+        name="repository_chart",
+    ),
     path(
         "repository/<int:repository_id>/commits/",
         views.CommitListView.as_view(),
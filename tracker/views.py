@@ -5,45 +5,115 @@ from typing import Any
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Avg, Count, F, Max, Min, Sum
-from django.db.models.functions import ExtractHour, TruncDay
+from django.db.models import Count, F, Max, Sum
 from django.db.models.query import QuerySet
-from django.http import HttpRequest, HttpResponse, QueryDict, request
-from django.shortcuts import redirect
+from django.http import (
+    Http404,
+    HttpRequest,
+    HttpResponse,
+    JsonResponse,
+    QueryDict,
+    request,
+)
+from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse_lazy
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.utils.timezone import timedelta
+from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import DetailView, TemplateView
-from github import Github
 
 from core.views import BaseCreateView, BaseListView, BaseUpdateView, ListAction
 from tracker import forms, models
-from tracker.services.repository import RepositorySyncService
+from tracker.services.clients import client_registry
+from tracker.services.jobs import JobQueue
+from tracker.services.rollups import hour_histogram
+from tracker.services.stats_cache import stats_cache
 
 from .models import Author, Commit, Repository
 
 
-class DashboardView(TemplateView):
-    template_name = "dashboard.html"
+def evaluate(data):
+    """
+    Run the querysets of a stats dict, so the result can be cached.
+    """
+    return {
+        key: list(value) if isinstance(value, QuerySet) else value
+        for key, value in data.items()
+    }
+
+
+class ChartDataView(View):
+    """
+    The series of one chart of a stats page as JSON, fetched by the page
+    after it is shown so it never waits on the slowest aggregate.
+    Responses carry an ETag of the scope's stats version and the
+    Last-Modified of its latest sync, so browsers revalidate them and
+    unchanged charts are answered with 304 Not Modified.
+    """
+
+    charts = ()
+
+    def get_scope(self):
+        raise NotImplementedError
+
+    def get_last_synced(self):
+        raise NotImplementedError
+
+    def get_chart(self, chart):
+        """
+        Return {"labels": [...], "data": [...]} of the chart.
+        """
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        chart = kwargs["chart"]
+        if chart not in self.charts:
+            raise Http404(f"Unknown chart {chart}")
+        scope = self.get_scope()
+        last_synced = self.get_last_synced()
+        last_modified = int(last_synced.timestamp()) if last_synced else None
+        # The version moves with every commit written for the scope, the
+        # sync time with every repository metadata sync
+        etag = quote_etag(
+            f"{chart}-{scope}-{stats_cache.version(scope)}-{last_modified or 0}"
+        )
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = JsonResponse(self.get_chart(chart))
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+        # Browsers keep the data but check it is current on every load
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class DashboardStatsMixin:
+    """
+    Stats of every repository, or only of the commits of the author named
+    by the `author` query parameter.
+    """
 
     _author = None
 
     def get_author(self):
-        if self._author is False:
-            return None
         if self._author is None:
             author_username = self.request.GET.get("author")
-            if not author_username:
-                self._author = False
-            else:
-                self._author = Author.objects.filter(username=author_username).first()
-                if not self._author:
-                    self._author = False
-                    messages.error(self.request, "Author not found")
-                else:
-                    messages.success(self.request, f"Showing stats for {author_username}")
-        return self._author
+            self._author = False
+            if author_username:
+                self._author = (
+                    Author.objects.filter(username=author_username).first() or False
+                )
+        return self._author or None
+
+    def get_scope(self):
+        author = self.get_author()
+        return f"author:{author.pk}" if author else "all"
 
     def get_commit_queryset(self):
         author = self.get_author()
@@ -51,102 +121,222 @@ class DashboardView(TemplateView):
             return Commit.objects.filter(author=author)
         return Commit.objects.all()
 
+    def get_rollup_queryset(self):
+        author = self.get_author()
+        if author:
+            return models.CommitRollup.objects.filter(author=author)
+        return models.CommitRollup.objects.all()
+
     def get_repository_queryset(self):
         author = self.get_author()
         if author:
-            return Repository.objects.filter(commit__author=author).distinct()
+            return Repository.objects.filter(
+                pk__in=self.get_rollup_queryset().values("repository")
+            )
         return Repository.objects.all()
 
+    def get_repository_stats(self):
+        """
+        One row per repository with its totals, read from the counters or,
+        when filtering by author, from the author's rollups.
+        """
+        if self.get_author():
+            rows = self.get_rollup_queryset().values(
+                pk=F("repository"),
+                name=F("repository__name"),
+                language=F("repository__language"),
+            ).annotate(
+                total_commits=Sum("commits"),
+                total_contributors=Count("author", distinct=True),
+                churn_rate=Sum("additions") + Sum("deletions"),
+            )
+        else:
+            rows = Repository.objects.values(
+                "pk",
+                "name",
+                "language",
+                total_commits=F("commit_count"),
+                total_contributors=F("contributor_count"),
+                churn_rate=F("total_additions") + F("total_deletions"),
+            )
+        return rows.order_by("-total_commits")
+
+    def get_recent_activity(self, since):
+        """
+        Commits, additions and deletions per day and repository since
+        `since`, the one scan of recent rollups behind the frequency, churn
+        and active repositories.
+        """
+        return (
+            self.get_rollup_queryset()
+            .filter(day__gte=since)
+            .values("day", "repository", "repository__name")
+            .annotate(
+                commit_count=Sum("commits"),
+                additions=Sum("additions"),
+                deletions=Sum("deletions"),
+            )
+            .order_by()
+        )
+
     def get_generic_stats(self):
         data = {}
+        # Totals, languages and the comparison come from the same
+        # per-repository rows
+        repositories = list(self.get_repository_stats())
+
         # Total Repositories
-        data["total_repositories"] = self.get_repository_queryset().count()
+        data["total_repositories"] = len(repositories)
 
         # Total Commits
-        data["total_commits"] = self.get_commit_queryset().count()
+        data["total_commits"] = sum(
+            repository["total_commits"] or 0 for repository in repositories
+        )
+
+        # Commits by Language
+        languages = {}
+        for repository in repositories:
+            language = languages.setdefault(
+                repository["language"],
+                {
+                    "language": repository["language"],
+                    "language_count": 0,
+                    "commit_count": 0,
+                },
+            )
+            # Repositories without a language are not counted, like Count()
+            language["language_count"] += repository["language"] is not None
+            language["commit_count"] += repository["total_commits"] or 0
+        data["commits_by_language"] = sorted(
+            languages.values(), key=lambda language: -language["commit_count"]
+        )
 
         # Top Language
-        data["top_language"] = (
-            self.get_repository_queryset()
-            .values("language")
-            .annotate(language_count=Count("language"))
-            .order_by("-language_count")
-            .first()
+        data["top_language"] = max(
+            languages.values(),
+            key=lambda language: language["language_count"],
+            default=None,
         )
 
         # Average Commits per Repository
-        total_commits = self.get_commit_queryset().count()
-        total_repositories = self.get_repository_queryset().count()
         data["average_commits_per_repo"] = (
-            total_commits / total_repositories if total_repositories else 0
+            data["total_commits"] / len(repositories) if repositories else 0
         )
 
         # Recent Commits
         data["recent_commits"] = (
-            self.get_commit_queryset().select_related("author").order_by("-date")[:10]
-        )
-
-        # Active Repositories
-        last_30_days = timezone.now() - timedelta(days=30)
-        data["active_repositories"] = (
             self.get_commit_queryset()
-            .filter(date__gte=last_30_days)
-            .values("repository__name")
-            .annotate(commit_count=Count("id"))
-            .order_by("-commit_count")[:5]
+            .select_related("author", "repository")
+            .order_by("-date")[:10]
         )
 
-        # Commit Frequency
-        data["commit_frequency"] = (
-            self.get_commit_queryset()
-            .filter(date__gte=last_30_days)
-            .annotate(date_day=TruncDay("date"))
-            .values("date_day")
-            .annotate(commit_count=Count("id"))
-            .order_by("date_day")
-        )
+        # Repository Comparison
+        data["repository_comparison"] = [
+            {
+                "name": repository["name"],
+                "total_commits": repository["total_commits"],
+                "total_contributors": repository["total_contributors"],
+                "churn_rate": repository["churn_rate"],
+            }
+            for repository in repositories
+        ]
 
-        # Churn Rate
-        churn_rate = (
-            self.get_commit_queryset()
-            .filter(date__gte=last_30_days)
-            .aggregate(
-                total_additions=Sum("additions"), total_deletions=Sum("deletions")
+        return data
+
+    def get_activity(self):
+        """
+        Commit frequency, churn and active repositories of the last 30 days.
+        """
+        data = {}
+        days = {}
+        active = {}
+        churn_rate = {"total_additions": 0, "total_deletions": 0}
+        for row in self.get_recent_activity(
+            timezone.localdate() - timedelta(days=30)
+        ):
+            days[row["day"]] = days.get(row["day"], 0) + row["commit_count"]
+            active[row["repository__name"]] = (
+                active.get(row["repository__name"], 0) + row["commit_count"]
             )
-        )
-        data["churn_rate"] = {
-            "total_additions": churn_rate.get("total_additions", 0) or 0,
-            "total_deletions": churn_rate.get("total_deletions", 0) or 0,
-        }
+            churn_rate["total_additions"] += row["additions"]
+            churn_rate["total_deletions"] += row["deletions"]
+        data["commit_frequency"] = [
+            {"date_day": day, "commit_count": days[day]} for day in sorted(days)
+        ]
+        data["churn_rate"] = churn_rate
+        data["active_repositories"] = [
+            {"repository__name": name, "commit_count": commits}
+            for name, commits in sorted(active.items(), key=lambda item: -item[1])[:5]
+        ]
 
-        # Commits by Language
-        data["commits_by_language"] = (
-            self.get_repository_queryset()
-            .values("language")
-            .annotate(commit_count=Count("commit"))
-            .order_by("-commit_count")
-        )
+        return data
 
-        # Repository Comparison
-        data["repository_comparison"] = (
-            self.get_repository_queryset()
-            .annotate(
-                total_commits=Count("commit"),
-                total_contributors=Count("commit__author", distinct=True),
-                churn_rate=Sum("commit__additions") + Sum("commit__deletions"),
-            )
-            .values("name", "total_commits", "total_contributors", "churn_rate")
-            .order_by("-total_commits")
+    def get_summary(self):
+        # Cached until new commits of the scope are synced
+        return stats_cache.get_or_compute(
+            self.get_scope(),
+            "dashboard",
+            lambda: evaluate(self.get_generic_stats()),
         )
 
-        return data
+    def get_last_synced(self):
+        return self.get_repository_queryset().aggregate(
+            last_synced=Max("last_synced_at")
+        )["last_synced"]
+
+
+class DashboardView(DashboardStatsMixin, TemplateView):
+    template_name = "dashboard.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context.update(self.get_generic_stats())
+        author_username = self.request.GET.get("author")
+        if author_username:
+            if self.get_author():
+                messages.success(self.request, f"Showing stats for {author_username}")
+            else:
+                messages.error(self.request, "Author not found")
+        # The charts are fetched from DashboardChartView once shown
+        context.update(self.get_summary())
         return context
 
 
+class DashboardChartView(DashboardStatsMixin, ChartDataView):
+    charts = ("active_repositories", "commit_frequency", "churn", "languages")
+
+    def get_chart(self, chart):
+        if chart == "languages":
+            languages = self.get_summary()["commits_by_language"]
+            return {
+                "labels": [language["language"] for language in languages],
+                "data": [language["commit_count"] for language in languages],
+            }
+        activity = stats_cache.get_or_compute(
+            self.get_scope(), "dashboard_activity", self.get_activity
+        )
+        if chart == "churn":
+            churn_rate = activity["churn_rate"]
+            return {
+                "labels": ["Additions", "Deletions"],
+                "data": [churn_rate["total_additions"], churn_rate["total_deletions"]],
+            }
+        if chart == "commit_frequency":
+            return {
+                "labels": [day["date_day"] for day in activity["commit_frequency"]],
+                "data": [day["commit_count"] for day in activity["commit_frequency"]],
+            }
+        return {
+            "labels": [
+                repository["repository__name"]
+                for repository in activity["active_repositories"]
+            ],
+            "data": [
+                repository["commit_count"]
+                for repository in activity["active_repositories"]
+            ],
+        }
+
+
 class TokenCreateView(LoginRequiredMixin, BaseCreateView):
     '''
     A view to create a new token
@@ -174,6 +364,12 @@ class TokenEditView(LoginRequiredMixin, BaseUpdateView):
         # show only the tokens of the current user
         return self.model.objects.filter(user=self.request.user)
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # drop the pooled client built with the old token
+        client_registry.invalidate(form.instance)
+        return response
+
 
 
 
@@ -216,6 +412,7 @@ def delete_token(request: HttpRequest, pk: int):
     if request.user == token.user or request.user.has_perm("can_delete_all_git_tokens"):
         # add a success message
         messages.success(request, f"Token {token.label} deleted successfully.")
+        client_registry.invalidate(token)
         token.delete()
     else:
         # if the user does not have the permission to delete the token, show an error message
@@ -235,8 +432,15 @@ class RepositoryListView(LoginRequiredMixin, BaseListView):
         "private",
         "language",
         "default_branch",
+        "commit_count",
+        "contributor_count",
+        "last_commit_date",
         "last_synced_at",
     ]
+    field_labels = {
+        "commit_count": "Commits",
+        "contributor_count": "Contributors",
+    }
     # Disable the create button
     can_create = False
     # Disable the edit button
@@ -266,6 +470,9 @@ class RepositoryListView(LoginRequiredMixin, BaseListView):
         ("updated_at", "Updated At"),
         ("pushed_at", "Pushed At"),
         ("last_synced_at", "Last Synced At"),
+        ("commit_count", "Commits"),
+        ("contributor_count", "Contributors"),
+        ("last_commit_date", "Last Commit"),
     ]
 
     def get_queryset(self):
@@ -287,61 +494,91 @@ class RepositoryStatsView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         repository = self.object
-        # Commit Frequency
-        # Get the count of commits per day
-        commit_frequency = (
-            Commit.objects.filter(repository=repository)
-            .values("date__date")
-            .annotate(commit_count=Count("id"))
-            .order_by("date__date")
-        )
-        context["commit_frequency"] = commit_frequency
+        # Read from the counters, the charts are fetched from
+        # RepositoryChartView once shown
+        context["commit_count"] = repository.commit_count
+        context["contributors_count"] = repository.contributor_count
+        return context
 
-		# Total Commits for the repository
-        context["commit_count"] = Commit.objects.filter(repository=repository).count()
 
-        # Top Contributors
-        top_contributors = (
-            # Get the top contributors of the repository
-            Commit.objects.filter(repository=repository, author__isnull=False)
-            .values("author__username")
-            .annotate(commit_count=Count("id"))
-            .order_by("-commit_count")
-        )
-        context["top_contributors"] = top_contributors
-        context["contributors_count"] = len(top_contributors)
+class RepositoryChartView(ChartDataView):
+    charts = ("commit_frequency", "contributors", "churn", "time_distribution")
 
-        # Commit Size Distribution
-        # Find the average, max and min commit size
-        size_distribution = Commit.objects.filter(repository=repository).aggregate(
-            average_size=Avg("total"), max_size=Max("total"), min_size=Min("total")
-        )
-        context["size_distribution"] = size_distribution
+    _repository = None
 
+    def get_repository(self):
+        if self._repository is None:
+            self._repository = get_object_or_404(Repository, pk=self.kwargs["pk"])
+        return self._repository
 
-		# Get total additions and deletions for the repository
-        churn_data = Commit.objects.filter(repository=repository).aggregate(
-            additions=Sum("additions"), deletions=Sum("deletions")
-        )
-		# if the data is not present, set it to 0
-        churn_rate = (churn_data.get("additions") or 0) + (
-            churn_data.get("deletions") or 0
-        )
-        context["churn_rate"] = churn_rate
+    def get_scope(self):
+        return f"repository:{self.get_repository().pk}"
+
+    def get_last_synced(self):
+        return self.get_repository().last_synced_at
+
+    def get_stats(self, repository: Repository):
+        context = {}
+        # The frequency, contributors and time distribution are all added
+        # up from a single read of the repository's rollups
+        days = {}
+        contributors = {}
+        hours = []
+        for day, username, commits, day_hours in (
+            models.CommitRollup.objects.filter(repository=repository)
+            .order_by()
+            .values_list("day", "author__username", "commits", "hours")
+        ):
+            days[day] = days.get(day, 0) + commits
+            if username is not None:
+                contributors[username] = contributors.get(username, 0) + commits
+            hours.append(day_hours)
+
+        # Commit Frequency
+        # Get the count of commits per day
+        context["commit_frequency"] = [
+            {"day": day, "commit_count": days[day]} for day in sorted(days)
+        ]
+
+        # Top Contributors
+        context["top_contributors"] = [
+            {"author__username": username, "commit_count": commits}
+            for username, commits in sorted(
+                contributors.items(), key=lambda contributor: -contributor[1]
+            )
+        ]
 
         # Commit Time Distribution
-        time_distribution = (
-            # Get when the commits were made by the hour
-            Commit.objects.filter(repository=repository)
-            .annotate(hour=ExtractHour(F("commited_at")))
-            .values("hour")
-            .annotate(commit_count=Count("id"))
-            .order_by("hour")
-        )
-        context["time_distribution"] = time_distribution
+        # Get when the commits were made by the hour
+        context["time_distribution"] = hour_histogram(hours)
 
         return context
 
+    def get_chart(self, chart):
+        repository = self.get_repository()
+        if chart == "churn":
+            # Total additions and deletions of the repository
+            return {
+                "labels": ["Total Lines Changed"],
+                "data": [repository.total_additions + repository.total_deletions],
+            }
+        # Cached until new commits of the repository are synced
+        stats = stats_cache.get_or_compute(
+            self.get_scope(),
+            "repository_stats",
+            lambda: evaluate(self.get_stats(repository)),
+        )
+        if chart == "commit_frequency":
+            rows, label = stats["commit_frequency"], "day"
+        elif chart == "contributors":
+            rows, label = stats["top_contributors"], "author__username"
+        else:
+            rows, label = stats["time_distribution"], "hour"
+        return {
+            "labels": [row[label] for row in rows],
+            "data": [row["commit_count"] for row in rows],
+        }
+
 
 class CommitListView(LoginRequiredMixin, BaseListView):
     '''
@@ -453,21 +690,20 @@ def webhook_listener_view(request: HttpRequest):
         raise Exception("Repository not found")
     repository: Repository
     # Find token for the repository
-    token = models.GitToken.objects.filter(
-        user__in=repository.users.all(), is_active=True
-    ).first()
+    token = client_registry.token_for(repository)
     if not token:
         raise Exception("No active token found")
-    # Create a GitHub client
-    client = Github(token.token)
-    # Fetch the repository object from the GitHub API
-    git_repository = client.get_repo(repository.full_name)
     data = json.loads(request.body.decode("utf-8"))
     current_branch = data.get("ref").split("/")[2]
     # if the default branch of the repository does not match the current branch received in webhook payload, raise an exception
     if repository.default_branch != current_branch:
         raise Exception("Tracking branch does not match")
-    # Sync the repository with the local database
-    sync_service = RepositorySyncService(repository=git_repository, repo_obj=repository)
-    sync_service.fetch_commits()
-    return HttpResponse("OK")
+    # Queue the push for process_jobs and answer right away, GitHub gives
+    # up on deliveries that take longer than a few seconds
+    JobQueue().enqueue(
+        repository,
+        event,
+        data,
+        delivery_id=request.headers.get("X-GitHub-Delivery"),
+    )
+    return HttpResponse("Accepted", status=202)